@@ -0,0 +1,130 @@
+'''
+Module for installing stand-in codec executables.
+
+:func:`install` writes ``flac``, ``sox``, ``lame``, ``mp3gain`` and ``eyeD3``
+scripts to a folder that is then put first on ``PATH``. They accept the
+arguments lossless2lossy passes, produce output that loads like the real
+thing, and spend a configurable amount of time doing it, so the scanning,
+scheduling and bookkeeping around them can be measured without real codecs
+or real music.
+
+The cost of each call is read from the environment when it runs:
+
+* ``BENCH_CODEC_SECONDS``: seconds each call takes (default 0)
+* ``BENCH_CODEC_BUSY``: ``1`` to spend that time spinning on the CPU like a
+    real codec, anything else to sleep
+'''
+import os
+import stat
+import sys
+
+from . import library
+
+_PRELUDE = '''#!{python}
+import os
+import struct
+import sys
+import time
+
+
+def cost():
+    seconds = float(os.environ.get('BENCH_CODEC_SECONDS', '0') or 0)
+    if os.environ.get('BENCH_CODEC_BUSY') == '1':
+        end = time.process_time() + seconds
+        while time.process_time() < end:
+            pass
+    elif seconds:
+        time.sleep(seconds)
+
+
+def wav(seconds=0.5, rate=44100):
+    data = b'\\0' * int(seconds * rate) * 4
+    return (b'RIFF' + struct.pack('<I', 36 + len(data)) + b'WAVE'
+            + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 2, rate, rate * 4, 4,
+                                    16)
+            + b'data' + struct.pack('<I', len(data)) + data)
+
+
+args = sys.argv[1:]
+'''
+
+_DECODERS = {
+    # flac --decode ... (--stdout | -o FILE) FILE
+    'flac': '''
+cost()
+out = sys.stdout.buffer
+if '-o' in args:
+    out = open(args[args.index('-o') + 1], 'wb')
+out.write(wav())
+out.flush()
+''',
+    # sox ... FILE -t wav (- | FILE) rate ...
+    'sox': '''
+cost()
+out = sys.stdout.buffer
+target = args[args.index('-t') + 2] if '-t' in args else '-'
+if target != '-':
+    out = open(target, 'wb')
+out.write(wav())
+out.flush()
+''',
+}
+
+_TOOLS = {
+    # lame [options] - FILE
+    'lame': '''
+while sys.stdin.buffer.read(65536):
+    pass
+cost()
+with open(args[-1], 'wb') as f:
+    f.write({mp3!r})
+''',
+    # mp3gain edits files in place; reports nothing
+    'mp3gain': '''
+cost()
+''',
+    'eyeD3': '''
+cost()
+''',
+}
+
+
+def install(bindir):
+    '''
+    Writes the stand-in codecs to ``bindir``.
+
+    :Args:
+        * bindir(str): the folder to write them to, created if needed
+    :Returns:
+        * str: ``bindir``, to put first on ``PATH``
+    '''
+    os.makedirs(bindir, exist_ok=True)
+    prelude = _PRELUDE.format(python=sys.executable)
+    scripts = dict(_DECODERS)
+    for name, body in _TOOLS.items():
+        scripts[name] = body.format(mp3=library.mp3_bytes())
+    for name, body in scripts.items():
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write(prelude + body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP
+                 | stat.S_IXOTH)
+    return bindir
+
+
+def environment(bindir, seconds=0.0, busy=False):
+    '''
+    Returns a copy of ``os.environ`` that runs the stand-in codecs.
+
+    :Args:
+        * bindir(str): the folder passed to :func:`install`
+        * seconds(float): seconds each codec call takes
+        * busy(bool): spin on the CPU instead of sleeping
+    :Returns:
+        * dict(str: str)
+    '''
+    env = dict(os.environ)
+    env['PATH'] = bindir + os.pathsep + env.get('PATH', '')
+    env['BENCH_CODEC_SECONDS'] = str(seconds)
+    env['BENCH_CODEC_BUSY'] = '1' if busy else '0'
+    return env
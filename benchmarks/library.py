@@ -0,0 +1,151 @@
+'''
+Module for generating synthetic music libraries.
+
+The files are as small as possible while still loading as the right
+FileClass: flac files hold only a STREAMINFO block and a few tags, mp3 files
+a handful of silent frames and album art a few bytes. A 100k file library
+takes well under a gigabyte.
+'''
+import os
+import random
+import struct
+
+# Names of the lossy files, lossless files and album art in each album
+TRACK = '{:02} Track {}'
+ART = 'folder.jpg'
+
+# MPEG 1 layer III, 128 kbit/s, 44.1 kHz, no padding: 417 bytes per frame
+_MP3_FRAME = b'\xff\xfb\x90\x64' + b'\0' * 413
+
+
+def flac_bytes(seconds=240.0, sample_rate=44100, bits=16, channels=2,
+               tags=()):
+    '''
+    Returns a flac file with no audio frames whose headers describe
+    ``seconds`` of audio.
+
+    :Args:
+        * seconds(float): the duration recorded in STREAMINFO
+        * sample_rate(int): the sample rate recorded in STREAMINFO
+        * bits(int): bits per sample
+        * channels(int): the number of channels
+        * tags(iter(tuple(str, str))): Vorbis comments
+    :Returns:
+        * bytes
+    '''
+    samples = int(seconds * sample_rate)
+    # min/max block size, min/max frame size, then 64 bits holding the
+    # sample rate, channels, bits per sample and total samples
+    packed = ((sample_rate << 44) | ((channels - 1) << 41)
+              | ((bits - 1) << 36) | samples)
+    streaminfo = (struct.pack('>HH', 4096, 4096) + b'\0' * 6
+                  + struct.pack('>Q', packed)
+                  + os.urandom(16))  # MD5 of the audio
+    vendor = b'lossless2lossy benchmarks'
+    comments = [('{}={}'.format(key, value)).encode('utf-8')
+                for key, value in tags]
+    vorbis = (struct.pack('<I', len(vendor)) + vendor
+              + struct.pack('<I', len(comments))
+              + b''.join(struct.pack('<I', len(comment)) + comment
+                         for comment in comments))
+
+    def block(kind, data, last=False):
+        header = (0x80 if last else 0) | kind
+        return struct.pack('>I', (header << 24) | len(data)) + data
+
+    return (b'fLaC' + block(0, streaminfo) + block(4, vorbis, last=True))
+
+
+def mp3_bytes(frames=4):
+    '''
+    Returns an mp3 file holding ``frames`` silent frames.
+    '''
+    return _MP3_FRAME * frames
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def generate(root, albums=100, tracks=10, depth=2, flat=0, lossy=0.1,
+             art=True, mixed_case=False, seed=0):
+    '''
+    Creates a synthetic library.
+
+    Albums are placed ``depth`` folders below ``root``
+    (``genre-N/.../artist-N/album-N``). A share of the albums hold mp3s
+    instead of flacs, like a library where some albums were only ever
+    bought lossy.
+
+    :Args:
+        * root(str): the folder to create the library in
+        * albums(int): the number of albums
+        * tracks(int): tracks per album
+        * depth(int): folders between ``root`` and each album, at least 1
+        * flat(int): the number of flac files in one extra folder, to
+            model huge unsorted folders
+        * lossy(float): the share of albums holding mp3s
+        * art(bool): put a folder.jpg in every album
+        * mixed_case(bool): give some files upper or mixed case extensions
+        * seed(int): seed for the random choices, so that libraries can be
+            compared between runs
+    :Returns:
+        * int: the number of files created
+    '''
+    choices = random.Random(seed)
+    flac = flac_bytes(tags=(('title', 'Track'), ('artist', 'Artist'),
+                            ('album', 'Album')))
+    mp3 = mp3_bytes()
+    extensions = {'.flac': ('.flac', '.FLAC', '.Flac'),
+                  '.mp3': ('.mp3', '.MP3', '.Mp3')}
+    created = 0
+    depth = max(1, depth)
+
+    for number in range(albums):
+        parents = ['level{}-{}'.format(level, number % (7 + level * 5))
+                   for level in range(depth - 1)]
+        folder = os.path.join(root, *(parents + ['album-{}'.format(number)]))
+        os.makedirs(folder, exist_ok=True)
+
+        extension = '.mp3' if choices.random() < lossy else '.flac'
+        data = mp3 if extension == '.mp3' else flac
+        for track in range(tracks):
+            suffix = extension
+            if mixed_case:
+                suffix = choices.choice(extensions[extension])
+            _write(os.path.join(folder, TRACK.format(track, number) + suffix),
+                   data)
+            created += 1
+        if art:
+            _write(os.path.join(folder, ART), b'\xff\xd8\xff\xe0 not a jpeg')
+            created += 1
+
+    if flat:
+        folder = os.path.join(root, 'unsorted')
+        os.makedirs(folder, exist_ok=True)
+        for track in range(flat):
+            _write(os.path.join(folder, TRACK.format(track, 'unsorted')
+                                + '.flac'), flac)
+            created += 1
+    return created
+
+
+def for_size(root, files, mixed_case=True, seed=0):
+    '''
+    Creates a library of about ``files`` files with a realistic mix of
+    albums, art, lossy albums and one large flat folder.
+
+    :Args:
+        * root(str): the folder to create the library in
+        * files(int): the approximate number of files
+        * mixed_case(bool): give some files upper or mixed case extensions
+        * seed(int): seed for the random choices
+    :Returns:
+        * int: the number of files created
+    '''
+    tracks = 10
+    flat = files // 20
+    albums = max(1, (files - flat) // (tracks + 1))
+    return generate(root, albums=albums, tracks=tracks, depth=3, flat=flat,
+                    mixed_case=mixed_case, seed=seed)
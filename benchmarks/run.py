@@ -0,0 +1,183 @@
+'''
+Times scanning, comparing, loading and a full run on synthetic libraries.
+
+Usage::
+
+    python -m benchmarks.run [--sizes 1000 10000 100000] [--output FILE]
+                             [--compare FILE] [--codec-seconds S] [--busy]
+
+Each size is the approximate number of files in the generated library. The
+results are printed and written as JSON, and ``--compare`` reports how much
+slower or faster each benchmark is than in an earlier results file.
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from lossless2lossy import concurrency
+from lossless2lossy import lossless2lossy
+from lossless2lossy import manifest
+from lossless2lossy import mp3
+from lossless2lossy import sync
+
+from . import codecs
+from . import library
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# Full runs spawn several processes per file, so by default they are only
+# timed on the smaller libraries
+DEFAULT_RUN_LIMIT = 10000
+
+
+def timed(fn):
+    'Returns the result of ``fn()`` and the wall time it took.'
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+
+def all_files(root):
+    for folder, __, files in os.walk(root):
+        for name in files:
+            yield os.path.join(folder, name)
+
+
+def bench_size(workdir, size, run_worker, jobs=None):
+    '''
+    Runs every benchmark on one library size.
+
+    :Returns:
+        * list(dict): one result per benchmark
+    '''
+    srcdir = os.path.join(workdir, 'src-{}'.format(size))
+    destdir = os.path.join(workdir, 'dest-{}'.format(size))
+    os.makedirs(destdir)
+    files, seconds = timed(lambda: library.for_size(srcdir, size))
+    results = [dict(benchmark='generate', files=files, seconds=seconds)]
+
+    def record(name, fn):
+        __, seconds = timed(fn)
+        results.append(dict(benchmark=name, files=files, seconds=seconds))
+        print('{:>8} files  {:<32} {:9.3f} s'.format(files, name, seconds))
+
+    compare = sync.Sync(srcdir, destdir, mp3.Mp3)
+    record('not_in_destination', lambda: list(compare.not_in_destination()))
+    record('not_in_source', lambda: list(compare.not_in_source()))
+    paths = list(all_files(srcdir))
+    record('load_cls_objs', lambda: sync.Sync.load_cls_objs(paths))
+
+    if run_worker:
+        compare.manifest = manifest.Manifest.in_directory(destdir)
+        worker = lossless2lossy.Worker(compare, delete=True,
+                                       limits=concurrency.Limits(jobs))
+
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                try:
+                    worker.run()
+                except SystemExit as e:
+                    if e.code:
+                        raise Exception('Worker.run() failed')
+        record('Worker.run', run)
+
+        # A second scan is answered by the manifest written by the run
+        warm = sync.Sync(srcdir, destdir, mp3.Mp3,
+                         manifest.Manifest.in_directory(destdir))
+        record('not_in_destination (manifest)',
+               lambda: list(warm.not_in_destination()))
+        warm.manifest.close()
+
+    shutil.rmtree(srcdir)
+    shutil.rmtree(destdir)
+    return results
+
+
+def compare_results(previous, current):
+    '''
+    Prints the change of each benchmark against an earlier run.
+
+    :Args:
+        * previous(dict): results loaded from an earlier JSON file
+        * current(dict): the results of this run
+    '''
+    before = dict(((result['benchmark'], result['files']), result['seconds'])
+                  for result in previous['results'])
+    print('\nCompared with {}:'.format(previous['started']))
+    for result in current['results']:
+        key = (result['benchmark'], result['files'])
+        if key in before and before[key] > 0:
+            print('{:>8} files  {:<32} {:+7.1%}'.format(
+                result['files'], result['benchmark'],
+                result['seconds'] / before[key] - 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks lossless2lossy on synthetic libraries.'
+    )
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES),
+                        help='approximate library sizes, in files')
+    parser.add_argument('--run-limit', type=int, default=DEFAULT_RUN_LIMIT,
+                        help=('only time Worker.run() on libraries up to this'
+                              ' size (default: {})'.format(DEFAULT_RUN_LIMIT))
+                        )
+    parser.add_argument('--codec-seconds', type=float, default=0.0,
+                        help='seconds each stand-in codec call takes')
+    parser.add_argument('--busy', action='store_true', default=False,
+                        help='spin on the CPU instead of sleeping in codecs')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='CPU budget for Worker.run()')
+    parser.add_argument('--workdir', default=None,
+                        help='where to generate libraries (default: a'
+                             ' temporary folder)')
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the results to')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='lossless2lossy-bench-',
+                               dir=args.workdir)
+    bindir = codecs.install(os.path.join(workdir, 'bin'))
+    os.environ.update(codecs.environment(bindir, args.codec_seconds,
+                                         args.busy))
+
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': concurrency.available_cpus(),
+        'codec_seconds': args.codec_seconds,
+        'busy': args.busy,
+        'results': [],
+    }
+    try:
+        for size in args.sizes:
+            report['results'].extend(bench_size(
+                workdir, size, size <= args.run_limit, args.jobs))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,15 @@ Module for defining abstract base classes for class objects that represent
 files on the file system
 '''
 import abc
+import collections
+
+# Precomputed ReplayGain values for one file, see Lossy.finalize().
+# ``applied`` is the gain, in the format's own steps, that has already been
+# applied to the audio of the file.
+ReplayGain = collections.namedtuple(
+    'ReplayGain',
+    ('track_gain', 'track_peak', 'album_gain', 'album_peak', 'applied')
+)
 
 
 class FileClass(metaclass=abc.ABCMeta):
@@ -39,6 +48,51 @@ class Lossless(FileClass):
         stdout attribute.
         '''
 
+    @abc.abstractmethod
+    def decode_command(self, outfile='-'):
+        '''
+        * Should return the command line of the process ``decode()`` runs.
+        With ``outfile`` '-' it writes the PCM stream to its stdout. Used by
+        engine.Pipeline.
+        '''
+
+    def decoder(self):
+        '''
+        * Should return the name of the program or method ``decode()`` will
+        use, for reporting.
+        '''
+        return self.__class__.__name__
+
+    def audio_md5(self):
+        '''
+        * Should return a hex string checksum of the decoded audio, or None
+        if the format does not store one. Used to detect files where only
+        the tags have changed.
+        '''
+        return None
+
+    def duration(self):
+        '''
+        * Should return the length of the audio in seconds, or None if it
+        is not known without decoding. Used for planning.
+        '''
+        return None
+
+    def sample_rate(self):
+        '''
+        * Should return the sample rate of the audio in Hz, or None if it
+        is not known without decoding. Used for planning.
+        '''
+        return None
+
+    def cover(self):
+        '''
+        * Should return the front cover picture embedded in the file as a
+        tuple of its bytes and mime type, or None. Used for album art, see
+        artwork.Artwork.
+        '''
+        return None
+
 
 class Lossy(FileClass):
     '''
@@ -53,6 +107,7 @@ class Lossy(FileClass):
     EXTENSIONS = ('.XXX',)  # The first entry should be used for new encodes
     TYPE = 'lossy'
     VALID_TAGS = (None,)
+    ENCODE_OPTIONS = ()  # Encoder arguments, recorded in the sync manifest
 
     @abc.abstractmethod
     def __init__(self, filename):
@@ -62,6 +117,29 @@ class Lossy(FileClass):
         * Should set the attribute ``self.filename``
         '''
 
+    @classmethod
+    def estimated_bitrate(cls):
+        '''
+        * Should return the average bitrate, in kbit/s, that ENCODE_OPTIONS
+        are expected to produce, or None if it cannot be guessed. Used for
+        planning.
+        '''
+        return None
+
+    @classmethod
+    def with_options(cls, options):
+        '''
+        Returns a subclass that encodes with ``options`` instead of
+        ENCODE_OPTIONS, for keeping several destination folders with
+        different settings.
+
+        :Args:
+            * options(iter(str)): encoder arguments
+        :Returns:
+            * type: a subclass of this class
+        '''
+        return type(cls.__name__, (cls,), {'ENCODE_OPTIONS': tuple(options)})
+
     @classmethod
     @abc.abstractmethod
     def encode(self, outfile, popen_object):
@@ -79,9 +157,66 @@ class Lossy(FileClass):
             * EXCEPTION: Encoder error
         '''
 
+    @classmethod
+    @abc.abstractmethod
+    def encode_command(self, outfile):
+        '''
+        Returns the command line of an encoder that reads a PCM stream from
+        its stdin, as ``encode()`` runs it. Must be a classmethod. Used by
+        engine.Pipeline.
+
+        :Args:
+            * outfile(str): output filename. Extensions will be renamed to'
+                ' self.EXTENSION
+        :Returns:
+            * tuple(list(str), str): the command line and the file it writes
+        '''
+
     @abc.abstractmethod
-    def post_encode_hook(self):
+    def finalize(self, tags=None, replaygain=None, cover=None, engine=None):
         '''
-        Triggered once after all files in a directory have been encoded.
-        Useful for applying replaygain using album analysis.
+        Writes the tags of a file, its ReplayGain values and any other
+        metadata the format needs in a single save. Called once for every
+        file of an album before the album is moved into the destination
+        folder.
+
+        :Args:
+            * tags(FileClass): (optional) copy every tag this class accepts
+                from this file
+            * replaygain(ReplayGain): (optional) precomputed values for this
+                file. The audio should not be analysed again.
+            * cover(tuple(bytes, str)): (optional) an image and its mime
+                type to embed as the front cover
+            * engine(engine.Engine): (optional) runs any tool the format
+                needs, so that cancelling the engine kills it
+        :Returns:
+            * int: the gain now applied to the file when ``replaygain`` was
+                given, otherwise None
+        '''
+
+    @abc.abstractmethod
+    def clear_tags(self):
+        '''
+        Removes every tag from the file, including ReplayGain values and
+        embedded pictures. Used on a copy of a file encoded from identical
+        audio, before finalize() gives it its own tags.
+        '''
+
+    @abc.abstractmethod
+    def post_encode_hook(self, replaygain=None, engine=None):
+        '''
+        Triggered once after all files in a directory have been encoded
+        and moved into place, when finalize() could not be given
+        precomputed ReplayGain. Useful for applying replaygain using album
+        analysis.
+
+        :Args:
+            * replaygain(dict(str: ReplayGain)): (optional) precomputed
+                values for every file in the directory. When given, the
+                audio should not be analysed again.
+            * engine(engine.Engine): (optional) runs any tool the hook
+                needs, so that cancelling the engine kills it
+        :Returns:
+            * dict(str: int): the gain now applied to each file when
+                ``replaygain`` was given, otherwise None
         '''
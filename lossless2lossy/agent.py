@@ -0,0 +1,332 @@
+'''
+Module for the lossless2lossy-agent program, which encodes files for a
+coordinator running on another machine.
+
+The agent connects to a coordinator (see :mod:`lossless2lossy.distributed`),
+checks that the coordinator knows the shared secret and proves it knows it
+too, says how many jobs it runs at once, and decodes and encodes every file
+it is sent with the same pipeline a local run uses. It only reads files in
+its source folder and only writes files in its destination folder, whatever
+the coordinator asks. Jobs that have not started when the connection is
+lost are dropped, since the coordinator gives them to another agent. It
+reconnects when the connection is lost, until it is stopped.
+'''
+import argparse
+import concurrent.futures
+import os
+import signal
+import socket
+import threading
+
+from . import concurrency
+from . import distributed
+from . import lossless2lossy
+from . import metrics
+from . import sync
+
+# Seconds to wait before connecting again
+RECONNECT = 5.0
+
+
+def encode(job, stats=None):
+    '''
+    Runs one job: decodes its source file once and encodes it for every
+    output.
+
+    :Args:
+        * job(dict): a ``job`` message
+        * stats(metrics.Metrics): (optional) measures the pipeline
+    :Returns:
+        * None: loudness was not measured
+        * str: the loudness analysis, see loudness.Loudness.to_json()
+    :Raises:
+        * Exception: the file could not be loaded, decoded or encoded
+    '''
+    loaded = sync.Sync.load_cls_objs([job['src']])
+    if not loaded:
+        raise Exception('cannot load "{}"'.format(job['src']))
+    outputs = job['outputs']
+    for output in outputs:
+        os.makedirs(os.path.dirname(output['path']), exist_ok=True)
+    __, result = lossless2lossy.encode_pipeline(
+        loaded[0], [distributed.encode_class_for(output)
+                    for output in outputs],
+        [output['path'] for output in outputs], stats)
+    return result.to_json() if result is not None else None
+
+
+def _inside(path, root):
+    'Tests whether ``path`` is an absolute path in the folder ``root``.'
+    if not isinstance(path, str) or not os.path.isabs(path):
+        return False
+    return os.path.commonpath([os.path.normpath(path), root]) == root
+
+
+def check_job(job, srcdir, destdir):
+    '''
+    Refuses a job that reads a file outside the source folder or writes
+    one outside the destination folder.
+
+    :Args:
+        * job(dict): a ``job`` message
+        * srcdir(str): absolute path to the source folder
+        * destdir(str): absolute path to the destination folder
+    :Raises:
+        * ValueError: the job is refused
+    '''
+    if not _inside(job.get('src'), srcdir):
+        raise ValueError('refusing to read "{}" outside {}'.format(
+            job.get('src'), srcdir))
+    outputs = job.get('outputs')
+    if not isinstance(outputs, list) or not outputs:
+        raise ValueError('a job needs outputs')
+    for output in outputs:
+        path = output.get('path') if isinstance(output, dict) else None
+        if not _inside(path, destdir):
+            raise ValueError('refusing to write "{}" outside {}'.format(
+                path, destdir))
+
+
+class Agent:
+    '''
+    Encodes files for a coordinator.
+
+    Arguments:
+        * host (str): the coordinator's address
+        * port (int): the coordinator's port
+        * srcdir (str): the source folder; jobs reading other files are
+            refused
+        * destdir (str): the destination folder; jobs writing other files
+            are refused
+        * slots (int): (optional) jobs run at once. Defaults to half of the
+            available CPUs, since every job runs a decoder and an encoder.
+        * name (str): (optional) shown by the coordinator, defaults to the
+            host name
+        * process (callable): (optional) called with each job message,
+            returning the loudness analysis. Defaults to :func:`encode`.
+        * heartbeat (float): (optional) seconds between pings
+        * secret (str): the coordinator's shared secret, see
+            distributed.read_secret()
+    '''
+
+    def __init__(self, host, port, srcdir, destdir, slots=None, name=None,
+                 process=None, heartbeat=distributed.HEARTBEAT, secret=None):
+        self.address = (host, port)
+        self.srcdir = os.path.abspath(srcdir)
+        self.destdir = os.path.abspath(destdir)
+        self.secret = secret
+        self.slots = slots or max(1, concurrency.available_cpus() // 2)
+        self.name = name or socket.gethostname()
+        self.process = process or (lambda job: encode(job, self.metrics))
+        self.heartbeat = heartbeat
+        self.metrics = metrics.Metrics()
+        self.completed = 0
+        self._stopped = threading.Event()
+        self._sock = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.slots)
+
+    def stop(self):
+        '''
+        Disconnects and makes :meth:`run` return. Jobs that are running
+        finish, but their results are not sent; the coordinator gives them
+        to another agent.
+        '''
+        self._stopped.set()
+        self._disconnect()
+
+    def _disconnect(self):
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self, reconnect=RECONNECT):
+        '''
+        Works for the coordinator until stopped, reconnecting when the
+        connection is lost.
+
+        :Args:
+            * reconnect(float): seconds to wait before connecting again, or
+                None to return when the connection is lost
+        '''
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self.serve()
+                except OSError as e:
+                    print('** Connection to {}:{} lost: {} **'.format(
+                        self.address[0], self.address[1], e))
+                if reconnect is None:
+                    break
+                self._stopped.wait(reconnect)
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def _handshake(self, sock, lock, reader):
+        '''
+        Answers the coordinator's challenge and checks its answer to ours.
+
+        :Raises:
+            * ConnectionError: the coordinator does not know the secret
+        '''
+        secret = self.secret or ''
+        try:
+            challenge = distributed.receive(reader.readline())
+            nonce = challenge.get('nonce')
+            if challenge['type'] != 'challenge' or not isinstance(nonce, str):
+                raise ValueError('not a lossless2lossy coordinator')
+            if challenge.get('protocol') != distributed.PROTOCOL:
+                raise ValueError('the coordinator speaks another protocol')
+            nonces = (nonce, distributed.new_nonce())
+            distributed.send(sock, lock, {
+                'type': 'hello', 'name': self.name, 'slots': self.slots,
+                'protocol': distributed.PROTOCOL, 'nonce': nonces[1],
+                'proof': distributed.proof(secret, 'agent', nonces)})
+            welcome = distributed.receive(reader.readline())
+            trusted = welcome['type'] == 'welcome' and distributed.verify(
+                secret, 'coordinator', nonces, welcome.get('proof'))
+            if not trusted:
+                raise ValueError('the coordinator does not know the secret')
+        except ValueError as e:
+            raise ConnectionError(str(e))
+
+    def serve(self):
+        '''
+        Connects once and runs jobs until the connection ends.
+
+        :Raises:
+            * OSError: the connection failed, or the coordinator does not
+                know the secret
+        '''
+        sock = socket.create_connection(self.address)
+        self._sock = sock
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def ping():
+            while not done.wait(self.heartbeat):
+                try:
+                    distributed.send(sock, lock, {'type': 'ping'})
+                except OSError:
+                    return
+
+        def run_job(job):
+            if done.is_set():
+                return  # the coordinator has given it to another agent
+            try:
+                check_job(job, self.srcdir, self.destdir)
+                reply = {'type': 'done', 'id': job['id'],
+                         'loudness': self.process(job)}
+            except Exception as e:
+                reply = {'type': 'failed', 'id': job['id'], 'error': str(e)}
+            if done.is_set():
+                return
+            try:
+                distributed.send(sock, lock, reply)
+            except OSError:
+                return
+            if reply['type'] == 'done':
+                with lock:
+                    self.completed += 1
+
+        reader = sock.makefile('rb')
+        # Jobs sent over this connection
+        futures = []
+        try:
+            self._handshake(sock, lock, reader)
+            threading.Thread(target=ping, daemon=True).start()
+            for line in reader:
+                try:
+                    message = distributed.receive(line)
+                except ValueError:
+                    continue
+                if (message['type'] != 'job'
+                        or not isinstance(message.get('id'), int)):
+                    continue
+                futures = [future for future in futures
+                           if not future.done()]
+                futures.append(self._executor.submit(run_job, message))
+        finally:
+            done.set()
+            for future in futures:
+                future.cancel()
+            reader.close()
+            sock.close()
+            self._sock = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Encodes files for a lossless2lossy coordinator. The'
+                     ' source and destination folders must be mounted at'
+                     ' the same paths as on the coordinator.')
+    )
+    parser.add_argument('--jobs', '-j',
+                        type=int,
+                        default=None,
+                        help=('the number of files to encode at once'
+                              ' (default: half of the available CPUs)')
+                        )
+    parser.add_argument('--name',
+                        default=None,
+                        help='the name shown by the coordinator')
+    parser.add_argument('--background',
+                        action='store_true',
+                        default=False,
+                        help='run at low CPU and disk priority')
+    parser.add_argument('--secret-file',
+                        default=None,
+                        metavar='FILE',
+                        help=('read the secret shared with the coordinator'
+                              ' from FILE (default: the {} environment'
+                              ' variable)'.format(
+                                  distributed.SECRET_VARIABLE))
+                        )
+    parser.add_argument('coordinator',
+                        metavar='HOST:PORT',
+                        help='the address of the coordinator')
+    parser.add_argument('srcdir',
+                        metavar='SOURCE',
+                        help=('the source folder; files outside it are'
+                              ' never read'))
+    parser.add_argument('destdir',
+                        metavar='DESTINATION',
+                        help=('the destination folder; files outside it are'
+                              ' never written'))
+    args = parser.parse_args()
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    try:
+        host, port = distributed.parse_address(args.coordinator)
+    except ValueError:
+        parser.error('invalid address "{}"'.format(args.coordinator))
+    try:
+        secret = distributed.read_secret(args.secret_file)
+    except OSError as e:
+        parser.error('cannot read the secret: {}'.format(e))
+    if secret is None:
+        parser.error('set the shared secret with --secret-file or {}'.format(
+            distributed.SECRET_VARIABLE))
+    if args.background:
+        concurrency.background()
+
+    agent = Agent(host or 'localhost', port, args.srcdir, args.destdir,
+                  args.jobs, args.name, secret=secret)
+
+    def stop(signum, frame):
+        signal.signal(signum, signal.SIG_DFL)
+        agent.stop()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print('** Encoding for {}:{} with {} jobs **'.format(
+        host, port, agent.slots))
+    agent.run()
+    print('** Stopped after {} files **'.format(agent.completed))
+
+
+if __name__ == '__main__':
+    main()
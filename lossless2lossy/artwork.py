@@ -0,0 +1,242 @@
+'''
+Module for the cover art of albums.
+
+The cover of a track is the front cover picture embedded in its lossless
+file or, failing that, an image file in its folder (see art.Art).
+:class:`Artwork` downscales covers to a size that suits portable devices and
+keeps every processed image in a cache keyed by a hash of the original bytes
+and the settings, so an image is decoded and resized once, not once for
+every track of the album and every run. Downscaling needs Pillow; without
+it images are used as they are.
+'''
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import threading
+
+from . import metrics as metrics_module
+
+try:
+    from PIL import Image
+except ImportError:  # images are used as they are
+    Image = None
+
+DEFAULT_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'lossless2lossy', 'art')
+# Written into albums that have no image of their own, see Artwork.folder
+FOLDER_NAME = 'folder.jpg'
+JPEG_QUALITY = 90
+# Processed images kept in memory
+MEMORY_ITEMS = 32
+# Image files used as the cover of an album, best first
+PREFERRED = ('folder.jpg', 'cover.jpg', 'album.jpg', 'folder.gif',
+             'cover.gif', 'album.gif', 'thumb.jpg', 'albumartsmall.jpg',
+             'thumb.gif', 'albumartsmall.gif')
+
+# An image and its mime type
+Cover = collections.namedtuple('Cover', ('data', 'mime'))
+
+
+def mime_type(data):
+    '''
+    Guesses the mime type of an image from its first bytes.
+
+    :Returns:
+        * str: the mime type, ``image/jpeg`` if it is not recognised
+    '''
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def folder_cover(folder):
+    '''
+    Reads the preferred image file of a folder.
+
+    :Args:
+        * folder(str): path to a folder
+    :Returns:
+        * None: the folder has no image file
+        * Cover: the image
+    '''
+    try:
+        names = dict((name.lower(), name) for name in os.listdir(folder))
+    except FileNotFoundError:
+        return None
+    for preferred in PREFERRED:
+        if preferred in names:
+            with open(os.path.join(folder, names[preferred]), 'rb') as f:
+                data = f.read()
+            return Cover(data, mime_type(data))
+    return None
+
+
+class Artwork:
+    '''
+    Finds, downscales and caches the covers of albums. Safe to use from
+    several threads; a cover needed by several tracks at once is processed
+    by one of them while the others wait.
+
+    Arguments:
+        * size (int): (optional) the largest width and height in pixels.
+            Larger images are downscaled. Defaults to using images as they
+            are.
+        * embed (bool): (optional) embed the cover in every encoded file
+        * folder (bool): (optional) write the cover as FOLDER_NAME into
+            albums whose source folder has no FOLDER_NAME
+        * cache_dir (str): (optional) where processed images are kept
+            between runs
+
+    Raises:
+        * Exception: ``size`` was given but Pillow is not installed
+    '''
+
+    def __init__(self, size=None, embed=False, folder=False,
+                 cache_dir=DEFAULT_CACHE):
+        if size and Image is None:
+            raise Exception('resizing album art needs Pillow')
+        self.size = size
+        self.embed = embed
+        self.folder = folder
+        self.cache_dir = cache_dir
+        # Replaced by the worker, see metrics.Metrics
+        self.metrics = metrics_module.Metrics()
+        self._lock = threading.Lock()
+        # key: concurrent.futures.Future of the processed bytes, most
+        # recently used last
+        self._memory = collections.OrderedDict()
+
+    def cover(self, lossless_file):
+        '''
+        Returns the processed cover of a track.
+
+        :Args:
+            * lossless_file(Lossless): the track
+        :Returns:
+            * None: the track has no cover
+            * Cover: the processed image
+        '''
+        cover = self._original(lossless_file)
+        if cover is None:
+            return None
+        return self.process(cover)
+
+    @staticmethod
+    def _original(lossless_file):
+        embedded = lossless_file.cover()
+        if embedded is not None:
+            return Cover(*embedded)
+        return folder_cover(os.path.dirname(lossless_file.filename))
+
+    def process(self, cover, jpeg=False):
+        '''
+        Downscales an image that is larger than ``size``.
+
+        :Args:
+            * cover(Cover): the original image
+            * jpeg(bool): (optional) also convert it to JPEG
+        :Returns:
+            * None: the image has to be converted but Pillow is missing
+            * Cover: the processed image, or ``cover`` itself if there was
+                nothing to do
+        '''
+        if jpeg and cover.mime != 'image/jpeg' and Image is None:
+            return None
+        if not self.size and (not jpeg or cover.mime == 'image/jpeg'):
+            return cover
+        key = hashlib.sha1(cover.data).hexdigest() + '-{}-{}-{}'.format(
+            self.size or 0, 'jpeg' if jpeg else 'same', JPEG_QUALITY)
+        with self._lock:
+            future = self._memory.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._memory[key] = future
+                while len(self._memory) > MEMORY_ITEMS:
+                    self._memory.popitem(last=False)
+            else:
+                self._memory.move_to_end(key)
+        if owner:
+            try:
+                future.set_result(self._cached(key, cover.data, jpeg))
+            except Exception as e:
+                with self._lock:
+                    self._memory.pop(key, None)
+                future.set_exception(e)
+        data = future.result()
+        return Cover(data, mime_type(data))
+
+    def _cached(self, key, data, jpeg):
+        'Reads a processed image from the cache, processing it if missing.'
+        path = os.path.join(self.cache_dir, key[:2], key)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        with self.metrics.stage('art', bytes_in=len(data)) as stage:
+            processed = self._resize(data, jpeg)
+            stage.bytes_out = len(processed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(processed)
+        os.replace(tmp, path)
+        return processed
+
+    def _resize(self, data, jpeg):
+        image = Image.open(io.BytesIO(data))
+        format_ = 'JPEG' if jpeg else image.format
+        size = self.size
+        if size and max(image.size) > size:
+            if image.format == 'JPEG':
+                # Let the decoder skip detail that would be thrown away
+                image.draft('RGB', (size, size))
+            image.thumbnail((size, size), Image.LANCZOS)
+        elif format_ == image.format:
+            return data
+        options = {}
+        if format_ == 'JPEG':
+            options['quality'] = JPEG_QUALITY
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format_, **options)
+        return output.getvalue()
+
+    def process_file(self, path):
+        '''
+        Returns the processed bytes of an image file, for copying album art
+        into the destination folder.
+
+        :Args:
+            * path(str): path to the image
+        :Returns:
+            * bytes
+        '''
+        with open(path, 'rb') as f:
+            data = f.read()
+        return self.process(Cover(data, mime_type(data))).data
+
+    def folder_image(self, lossless_files):
+        '''
+        Returns the JPEG to write as FOLDER_NAME for an album.
+
+        :Args:
+            * lossless_files(iter(Lossless)): the album's tracks
+        :Returns:
+            * None: no track has a cover that can be written as a JPEG
+            * bytes: the image
+        '''
+        for lossless_file in lossless_files:
+            cover = self._original(lossless_file)
+            if cover is not None:
+                cover = self.process(cover, jpeg=True)
+            if cover is not None:
+                return cover.data
+        return None
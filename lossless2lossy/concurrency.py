@@ -0,0 +1,221 @@
+'''
+Module for deciding how much work may run at the same time.
+
+Each encode job runs a decoder process and one encoder process per
+destination, so the number of worker threads says little about the load on
+the CPU. Jobs instead reserve slots from a :class:`Budget` sized to the CPUs
+this process may actually use: the affinity mask and, inside a container,
+the cgroup CPU quota. Jobs that mostly move bytes around (copying, tagging,
+deleting) draw from a separate I/O budget so they can overlap encoding
+without adding to the CPU load.
+'''
+import asyncio
+import contextlib
+import math
+import multiprocessing
+import os
+import subprocess
+import threading
+
+# Niceness used by background mode
+BACKGROUND_NICENESS = 10
+
+# Concurrent file operations when not set on the command line
+DEFAULT_IO_JOBS = 4
+
+_CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+_CGROUP_V1_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+_CGROUP_V1_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+def cgroup_cpu_limit(cpu_max=_CGROUP_V2_CPU_MAX, quota=_CGROUP_V1_QUOTA,
+                     period=_CGROUP_V1_PERIOD):
+    '''
+    Returns the number of CPUs allowed by the cgroup CPU quota.
+
+    :Args:
+        * cpu_max(str): (optional) path to the cgroup v2 ``cpu.max`` file
+        * quota(str): (optional) path to the cgroup v1 quota file
+        * period(str): (optional) path to the cgroup v1 period file
+    :Returns:
+        * None: there is no quota
+        * int: the quota rounded up to whole CPUs
+    '''
+    text = _read(cpu_max)
+    if text is not None:
+        fields = text.split()
+        if fields and fields[0] != 'max':
+            length = int(fields[1]) if len(fields) > 1 else 100000
+            return max(1, math.ceil(int(fields[0]) / length))
+        return None
+
+    text = _read(quota)
+    length = _read(period)
+    if text is not None and length is not None and int(text) > 0:
+        return max(1, math.ceil(int(text) / int(length)))
+    return None
+
+
+def available_cpus():
+    '''
+    Returns the number of CPUs this process can use, taking the affinity
+    mask and the cgroup CPU quota into account.
+
+    :Returns:
+        * int: at least 1
+    '''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on this platform
+        cpus = multiprocessing.cpu_count()
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, limit)
+    return max(1, cpus)
+
+
+def background():
+    '''
+    Lowers the CPU and I/O priority of this process. Codec processes started
+    afterwards inherit both.
+    '''
+    try:
+        os.nice(BACKGROUND_NICENESS)
+    except (AttributeError, OSError):
+        pass
+    try:
+        # idle class: only use the disk when nobody else wants it
+        subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())],
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+    except OSError:  # util-linux is not installed
+        pass
+
+
+class Budget:
+    '''
+    A counting semaphore whose holders may take several slots at once.
+
+    A request for more slots than the budget holds is trimmed to the whole
+    budget, so a job that needs many processes still runs, alone. Slots can
+    be waited for in a thread or, with :meth:`acquire_async`, in an event
+    loop.
+
+    Arguments:
+        * size (int): the number of slots
+    '''
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('a budget needs at least one slot')
+        self.size = size
+        self._free = size
+        self._condition = threading.Condition()
+        # (loop, future) of coroutines waiting in acquire_async()
+        self._waiters = []
+
+    def acquire(self, count=1):
+        '''
+        Blocks until ``count`` slots are free and takes them.
+
+        :Args:
+            * count(int): the number of slots
+        :Returns:
+            * int: the number of slots taken, to pass to :meth:`release`
+        '''
+        count = max(1, min(count, self.size))
+        with self._condition:
+            while self._free < count:
+                self._condition.wait()
+            self._free -= count
+        return count
+
+    async def acquire_async(self, count=1):
+        '''
+        Like :meth:`acquire`, but waits without blocking the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        count = max(1, min(count, self.size))
+        while True:
+            with self._condition:
+                if self._free >= count:
+                    self._free -= count
+                    return count
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, count=1):
+        '''
+        Returns slots taken by :meth:`acquire` or :meth:`acquire_async`.
+
+        :Args:
+            * count(int): the number of slots
+        '''
+        with self._condition:
+            self._free += count
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                pass  # the loop is closed
+
+    @contextlib.contextmanager
+    def slots(self, count=1):
+        '''
+        Holds ``count`` slots for the duration of a ``with`` block.
+        '''
+        taken = self.acquire(count)
+        try:
+            yield
+        finally:
+            self.release(taken)
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Limits:
+    '''
+    The CPU and I/O budgets of a run.
+
+    Arguments:
+        * jobs (int): (optional) the number of codec processes that may run
+            at once. Defaults to :func:`available_cpus`, or half of that in
+            background mode.
+        * io_jobs (int): (optional) the number of file operations that may
+            run at once
+        * background_mode (bool): (optional) lower the priority of this
+            process, see :func:`background`
+    '''
+
+    def __init__(self, jobs=None, io_jobs=None, background_mode=False):
+        if jobs is None:
+            jobs = available_cpus()
+            if background_mode:
+                jobs = max(1, jobs // 2)
+        if io_jobs is None:
+            io_jobs = DEFAULT_IO_JOBS
+            if background_mode:
+                io_jobs = 1
+        self.cpu = Budget(jobs)
+        self.io = Budget(io_jobs)
+        if background_mode:
+            background()
+
+    @property
+    def threads(self):
+        'Worker threads needed to keep both budgets busy.'
+        return self.cpu.size + self.io.size
@@ -0,0 +1,475 @@
+'''
+Module for spreading encodes over several machines.
+
+A :class:`Coordinator` listens on a TCP port and hands encode jobs to the
+agents that connect to it (see :mod:`lossless2lossy.agent`). It is passed to
+:class:`lossless2lossy.Worker` in place of running the codecs locally: the
+worker still compares the folders, copies files, writes tags and finishes
+albums, and only the decoding and encoding happen on the agents. Every
+machine must see the source and destination folders at the same paths,
+e.g. through NFS.
+
+The coordinator listens on the loopback interface unless told otherwise.
+The coordinator and each agent prove to each other that they know a shared
+secret (see :func:`read_secret`) without sending it: each side sends a
+random nonce and answers with an HMAC of both nonces, see :func:`proof`.
+An answer overheard on one connection is useless on the next.
+
+Agents and the coordinator exchange JSON objects, one per line:
+
+* ``{"type": "challenge", "protocol": 3, "nonce": ...}``: sent by the
+    coordinator when an agent connects
+* ``{"type": "hello", "name": ..., "slots": N, "protocol": 3, "nonce": ...,
+    "proof": ...}``: the agent's answer, with the number of jobs it runs at
+    once. Any other message is refused until the proof matches.
+* ``{"type": "welcome", "proof": ...}``: the coordinator's answer. The
+    agent runs no job until the proof matches.
+* ``{"type": "job", "id": N, "src": ..., "outputs": [{"format": "mp3",
+    "options": [...], "path": ...}]}``: a file to decode once and encode to
+    every output
+* ``{"type": "done", "id": N, "loudness": ...}``: the job succeeded,
+    with the loudness analysis if the agent has numpy
+* ``{"type": "failed", "id": N, "error": ...}``: the job failed
+* ``{"type": "ping"}``: sent by agents every few seconds
+
+An agent that disconnects or stays silent for too long is lost, and its
+jobs are given to other agents. Every attempt writes to its own hidden
+folder next to the staged file, so a lost agent that is in fact still
+running can never overwrite the output of the agent that replaced it.
+'''
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import secrets
+import shutil
+import socket
+import threading
+
+from . import fileops
+from . import mp3
+
+PROTOCOL = 3
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7470
+# Where the shared secret is read from when no file is given
+SECRET_VARIABLE = 'LOSSLESS2LOSSY_SECRET'
+# Seconds between pings sent by agents
+HEARTBEAT = 10.0
+# Jobs kept in flight over all agents
+DEFAULT_SLOTS = 32
+
+# Names of the encode classes agents can use
+FORMATS = {'mp3': mp3.Mp3}
+
+
+def format_of(encode_class):
+    '''
+    Returns the name of an encode class in FORMATS.
+
+    :Raises:
+        * Exception: agents cannot use the class
+    '''
+    for name, class_ in FORMATS.items():
+        if issubclass(encode_class, class_):
+            return name
+    raise Exception('{} cannot be encoded remotely'.format(
+        encode_class.__name__))
+
+
+def encode_class_for(output):
+    '''
+    Returns the encode class described by a job output.
+
+    :Args:
+        * output(dict): a ``format`` from FORMATS and the encoder
+            ``options``
+    :Returns:
+        * type: a class inheriting from abstract.Lossy
+    '''
+    encode_class = FORMATS[output['format']]
+    options = tuple(output.get('options', encode_class.ENCODE_OPTIONS))
+    if options != tuple(encode_class.ENCODE_OPTIONS):
+        encode_class = encode_class.with_options(options)
+    return encode_class
+
+
+def send(sock, lock, message):
+    'Sends one message as a line of JSON.'
+    data = (json.dumps(message) + '\n').encode('utf-8')
+    with lock:
+        sock.sendall(data)
+
+
+def receive(line):
+    '''
+    Parses one message.
+
+    :Raises:
+        * ValueError: the line is not a JSON object with a ``type``
+    '''
+    message = json.loads(line.decode('utf-8'))
+    if not isinstance(message, dict) or not isinstance(message.get('type'),
+                                                       str):
+        raise ValueError('not a lossless2lossy message')
+    return message
+
+
+def read_secret(path=None):
+    '''
+    Returns the secret shared by the coordinator and its agents: the first
+    line of the file at ``path``, or the SECRET_VARIABLE environment
+    variable. It is not taken from the command line, where other users of
+    the machine could read it.
+
+    :Args:
+        * path(str): (optional) a file holding the secret
+    :Returns:
+        * str: the secret, or None if none was set
+    :Raises:
+        * OSError: the file cannot be read
+    '''
+    if path is not None:
+        with open(path) as f:
+            secret = f.readline().strip()
+    else:
+        secret = os.environ.get(SECRET_VARIABLE, '').strip()
+    return secret or None
+
+
+def new_nonce():
+    'Returns a random nonce for the handshake.'
+    return secrets.token_hex(16)
+
+
+def proof(secret, role, nonces):
+    '''
+    Returns the answer to a handshake: an HMAC of the sender's role and the
+    nonces of both sides, keyed with the shared secret. The role keeps an
+    answer from being sent back to the side that made it.
+
+    :Args:
+        * secret(str): the shared secret
+        * role(str): 'agent' or 'coordinator'
+        * nonces(tuple(str, str)): the coordinator's and the agent's nonce
+    :Returns:
+        * str: the HMAC as hex
+    '''
+    message = '\n'.join((role,) + tuple(nonces)).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message,
+                    hashlib.sha256).hexdigest()
+
+
+def verify(secret, role, nonces, answer):
+    '''
+    Tests whether ``answer`` is the :func:`proof` of ``role``, in constant
+    time.
+    '''
+    if not isinstance(answer, str):
+        return False
+    return hmac.compare_digest(proof(secret, role, nonces).encode('utf-8'),
+                               answer.encode('utf-8'))
+
+
+def parse_address(address, default_host=''):
+    '''
+    Splits ``[HOST:]PORT`` into a (host, port) tuple.
+
+    :Raises:
+        * ValueError: the port is not a number
+    '''
+    host, __, port = str(address).rpartition(':')
+    return (host or default_host, int(port))
+
+
+class _Job:
+
+    def __init__(self, id_, src, outputs):
+        self.id = id_
+        self.src = src
+        # list(tuple(type, str)): encode class and staged path
+        self.outputs = outputs
+        self.attempts = 0
+        self.future = concurrent.futures.Future()
+        self.future.set_running_or_notify_cancel()
+
+    def attempt_path(self, path):
+        'Where the current attempt writes the file staged at ``path``.'
+        folder, name = os.path.split(path)
+        return os.path.join(folder, '.remote-{}-{}'.format(
+            self.id, self.attempts), name)
+
+    def message(self):
+        return {
+            'type': 'job',
+            'id': self.id,
+            'src': self.src,
+            'outputs': [{'format': format_of(encode_class),
+                         'options': list(encode_class.ENCODE_OPTIONS),
+                         'path': self.attempt_path(path)}
+                        for encode_class, path in self.outputs],
+        }
+
+
+class _Agent:
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.name = '{}:{}'.format(*address[:2])
+        self.slots = 1
+        self.jobs = {}
+        self.alive = True
+        self.send_lock = threading.Lock()
+
+
+class Coordinator:
+    '''
+    Hands encode jobs to agents connected over TCP.
+
+    Arguments:
+        * host (str): (optional) the address to listen on, the loopback
+            interface by default. '' listens on every address.
+        * port (int): (optional) the port to listen on, 0 for any free port
+        * slots (int): (optional) jobs the worker keeps queued here; set it
+            to at least the total slots of the agents
+        * retries (int): (optional) how often a job is given to another
+            agent after its agent was lost or it failed
+        * timeout (float): (optional) seconds of silence after which an
+            agent is lost
+        * secret (str): the secret agents must prove they know
+
+    :Raises:
+        * ValueError: no secret was given
+        * OSError: cannot listen on the address
+    '''
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 slots=DEFAULT_SLOTS, retries=3, timeout=HEARTBEAT * 3,
+                 secret=None):
+        if not secret:
+            raise ValueError('agents need a shared secret, see {}'.format(
+                SECRET_VARIABLE))
+        self._secret = secret
+        self.slots = slots
+        self.retries = retries
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._queue = collections.deque()
+        self._agents = set()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._server = socket.create_server((host, port), reuse_port=False)
+        self.address = self._server.getsockname()[:2]
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    @property
+    def agents(self):
+        'The names of the connected agents.'
+        with self._condition:
+            return sorted(agent.name for agent in self._agents)
+
+    def encode(self, src, outputs):
+        '''
+        Has an agent decode ``src`` once and encode it for every output,
+        waiting until it is done.
+
+        :Args:
+            * src(str): path to the lossless file
+            * outputs(list(tuple(type, str))): the encode class and the
+                path of each file to write
+        :Returns:
+            * None: the agent did not measure loudness
+            * str: the loudness analysis, see loudness.Loudness.to_json()
+        :Raises:
+            * Exception: the job failed on every agent that tried it
+            * concurrent.futures.CancelledError: cancel() was called
+        '''
+        return self.submit(src, outputs).result()
+
+    def submit(self, src, outputs):
+        '''
+        Queues a job like :meth:`encode` without waiting for it.
+
+        :Returns:
+            * concurrent.futures.Future: the result of :meth:`encode`
+        '''
+        job = _Job(next(self._ids), src, list(outputs))
+        for encode_class, __ in job.outputs:
+            format_of(encode_class)
+        with self._condition:
+            if self._closed:
+                raise Exception('the coordinator is closed')
+            self._queue.append(job)
+            self._condition.notify_all()
+        return job.future
+
+    def cancel(self):
+        '''
+        Fails every job no agent has started with
+        concurrent.futures.CancelledError. Jobs that are running are left to
+        finish.
+        '''
+        with self._condition:
+            queued = list(self._queue)
+            self._queue.clear()
+        for job in queued:
+            job.future.set_exception(concurrent.futures.CancelledError())
+
+    def close(self):
+        '''
+        Stops listening, disconnects the agents and fails every job that
+        has not finished.
+        '''
+        with self._condition:
+            self._closed = True
+            agents = list(self._agents)
+            self._condition.notify_all()
+        self._server.close()
+        for agent in agents:
+            self._lost(agent, requeue=False)
+        self.cancel()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._server.accept()
+            except OSError:
+                return  # closed
+            agent = _Agent(sock, address)
+            threading.Thread(target=self._serve, args=(agent,),
+                             daemon=True).start()
+
+    def _serve(self, agent):
+        'Reads the messages of one agent until it is lost.'
+        agent.sock.settimeout(self.timeout)
+        reader = agent.sock.makefile('rb')
+        try:
+            nonce = new_nonce()
+            send(agent.sock, agent.send_lock, {
+                'type': 'challenge', 'protocol': PROTOCOL, 'nonce': nonce})
+            hello = receive(reader.readline())
+            nonces = (nonce, hello.get('nonce'))
+            if (hello['type'] != 'hello'
+                or hello.get('protocol') != PROTOCOL
+                or not isinstance(nonces[1], str)
+                or not verify(self._secret, 'agent', nonces,
+                              hello.get('proof'))):
+                raise ValueError('not a lossless2lossy agent')
+            slots = hello.get('slots', 1)
+            if not isinstance(slots, int):
+                raise ValueError('invalid slots')
+            agent.name = str(hello.get('name') or agent.name)
+            agent.slots = max(1, slots)
+            with self._condition:
+                if self._closed:
+                    raise ValueError('closed')
+                self._agents.add(agent)
+            send(agent.sock, agent.send_lock, {
+                'type': 'welcome',
+                'proof': proof(self._secret, 'coordinator', nonces)})
+            threading.Thread(target=self._dispatch, args=(agent,),
+                             daemon=True).start()
+
+            for line in reader:
+                message = receive(line)
+                if message['type'] in ('done', 'failed'):
+                    if not isinstance(message.get('id'), int):
+                        raise ValueError('invalid job id')
+                    self._finished(agent, message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            reader.close()
+            self._lost(agent)
+
+    def _dispatch(self, agent):
+        'Sends jobs to one agent while it has free slots.'
+        while True:
+            with self._condition:
+                while agent.alive and (not self._queue
+                                       or len(agent.jobs) >= agent.slots):
+                    self._condition.wait()
+                if not agent.alive:
+                    return
+                job = self._queue.popleft()
+                job.attempts += 1
+                agent.jobs[job.id] = job
+            try:
+                send(agent.sock, agent.send_lock, job.message())
+            except OSError:
+                self._lost(agent)
+                return
+
+    def _finished(self, agent, message):
+        with self._condition:
+            job = agent.jobs.pop(message.get('id'), None)
+            self._condition.notify_all()
+        if job is None:
+            return  # given to another agent already
+        if message['type'] == 'done':
+            try:
+                for __, path in job.outputs:
+                    attempt = job.attempt_path(path)
+                    fileops.move(attempt, path)
+                    os.rmdir(os.path.dirname(attempt))
+            except OSError as e:
+                self._retry(job, 'finished on {} but {}'.format(
+                    agent.name, e))
+            else:
+                job.future.set_result(message.get('loudness'))
+        else:
+            self._retry(job, '{} on {}'.format(message.get('error'),
+                                               agent.name))
+
+    @staticmethod
+    def _discard_attempt(job):
+        'Removes the folders the current attempt of a job wrote to.'
+        for __, path in job.outputs:
+            shutil.rmtree(os.path.dirname(job.attempt_path(path)),
+                          ignore_errors=True)
+
+    def _retry(self, job, error):
+        'Queues a job again, or fails it once it has run out of retries.'
+        self._discard_attempt(job)
+        with self._condition:
+            if job.attempts <= self.retries and not self._closed:
+                self._queue.appendleft(job)
+                self._condition.notify_all()
+                return
+        job.future.set_exception(Exception(
+            'encoding "{}" failed: {}'.format(job.src, error)))
+
+    def _lost(self, agent, requeue=True):
+        with self._condition:
+            if not agent.alive:
+                return
+            agent.alive = False
+            self._agents.discard(agent)
+            jobs = list(agent.jobs.values())
+            agent.jobs.clear()
+            self._condition.notify_all()
+        try:
+            agent.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        agent.sock.close()
+        for job in jobs:
+            # The next attempt writes to a folder of its own, so removing
+            # this one is safe even if the agent is still writing to it
+            self._discard_attempt(job)
+            if requeue:
+                with self._condition:
+                    retry = job.attempts <= self.retries
+                    if retry:
+                        self._queue.appendleft(job)
+                        self._condition.notify_all()
+                if retry:
+                    continue
+            job.future.set_exception(Exception(
+                'encoding "{}" failed: agent {} was lost'.format(
+                    job.src, agent.name)))
@@ -0,0 +1,168 @@
+'''
+Module for keeping encoded files between runs.
+
+An :class:`EncodeCache` keeps a copy of every file encoded with it, exactly
+as the encoder wrote it, under a key made of the MD5 signature of the
+unencoded audio and the encoder settings (see
+lossless2lossy.Worker.audio_key()). When the same audio has to be encoded
+with the same settings again, for a new destination folder or one that was
+wiped, the file is copied from the cache instead and only its tags are
+written. The loudness analysis is kept with each file, so ReplayGain needs
+no decoding either. Files are reflinked where the filesystem allows, and
+the least recently used ones are removed once the cache grows past its
+size limit.
+'''
+import hashlib
+import json
+import os
+import threading
+
+from . import fileops
+from . import metrics as metrics_module
+
+DEFAULT_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'lossless2lossy', 'encoded')
+DEFAULT_SIZE = 10 * 1000 ** 3  # bytes
+# Eviction removes files until the cache is this share of its limit, so
+# that it does not run again for every file
+EVICT_TO = 0.9
+# Kept next to each file: the loudness analysis
+INFO = '.json'
+_TMP = '.tmp'
+
+
+class EncodeCache:
+    '''
+    A size limited folder of encoded files. Safe to use from several
+    threads and, since files are only ever replaced by renames, from several
+    processes.
+
+    Arguments:
+        * directory (str): (optional) where the files are kept
+        * max_bytes (int): (optional) the size limit
+    '''
+
+    def __init__(self, directory=DEFAULT_CACHE, max_bytes=DEFAULT_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Replaced by the worker, see metrics.Metrics
+        self.metrics = metrics_module.Metrics()
+        # Files copied from the cache
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._evicting = threading.Lock()
+        # Bytes in the cache, counted when the first file is added
+        self._size = None
+
+    def _path(self, audio_key):
+        key = hashlib.sha1(json.dumps(list(audio_key)).encode(
+            'utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, audio_key, path):
+        '''
+        Copies the file encoded from ``audio_key`` to ``path``.
+
+        :Args:
+            * audio_key(tuple): the audio and encoder settings, see
+                lossless2lossy.Worker.audio_key()
+            * path(str): where to put the file
+        :Returns:
+            * None: the file is not in the cache
+            * dict: it was copied. ``loudness`` holds the analysis stored
+                with it, see loudness.Loudness.to_json(), or None.
+        '''
+        cached = self._path(audio_key)
+        with self.metrics.stage('cache') as stage:
+            try:
+                with open(cached + INFO) as f:
+                    info = json.load(f)
+                fileops.link_file(cached, path,
+                                  (fileops.REFLINK, fileops.COPY))
+                # The least recently used files are evicted first
+                os.utime(cached)
+            except (OSError, ValueError):
+                if os.path.lexists(path):
+                    os.unlink(path)
+                return None
+            stage.bytes_in = stage.bytes_out = os.path.getsize(path)
+        with self._lock:
+            self.hits += 1
+        return info
+
+    def put(self, audio_key, path, loudness=None):
+        '''
+        Adds a copy of a freshly encoded file, before its tags are written.
+        Failures are ignored: the cache only ever saves time.
+
+        :Args:
+            * audio_key(tuple): the audio and encoder settings
+            * path(str): the encoded file
+            * loudness(str): (optional) its loudness analysis, see
+                loudness.Loudness.to_json()
+        '''
+        cached = self._path(audio_key)
+        if os.path.exists(cached):
+            return
+        tmp = '{}.{}.{}{}'.format(cached, os.getpid(), threading.get_ident(),
+                                  _TMP)
+        with self.metrics.stage('cache') as stage:
+            try:
+                os.makedirs(os.path.dirname(cached), exist_ok=True)
+                fileops.link_file(path, tmp, (fileops.REFLINK, fileops.COPY))
+                with open(tmp + INFO, 'w') as f:
+                    json.dump({'loudness': loudness}, f)
+                # The analysis first: a file without it is never used
+                os.replace(tmp + INFO, cached + INFO)
+                os.replace(tmp, cached)
+            except OSError:
+                for leftover in (tmp, tmp + INFO):
+                    if os.path.lexists(leftover):
+                        os.unlink(leftover)
+                return
+            size = stage.bytes_out = os.path.getsize(cached)
+
+        with self._lock:
+            counted = self._size is not None
+            if counted:
+                self._size += size
+            over = not counted or self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _entries(self):
+        'Returns the (mtime, size, path) of every cached file.'
+        entries = []
+        for folder, __, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(INFO) or name.endswith(_TMP):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the cache is below
+        EVICT_TO of its limit, if it is over the limit.
+        '''
+        with self._evicting:
+            entries = self._entries()
+            total = sum(size for __, size, __ in entries)
+            if total > self.max_bytes:
+                for __, size, path in sorted(entries):
+                    if total <= self.max_bytes * EVICT_TO:
+                        break
+                    for name in (path, path + INFO):
+                        try:
+                            os.unlink(name)
+                        except FileNotFoundError:
+                            pass
+                    total -= size
+            with self._lock:
+                self._size = total
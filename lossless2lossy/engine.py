@@ -0,0 +1,544 @@
+'''
+Module for running codec processes from a single thread.
+
+Encoding a file takes a pipeline of processes: a decoder whose PCM stream is
+copied to one encoder per destination, and to the loudness meter on the way.
+A :class:`Pipeline` is driven by an asyncio event loop, which copies the
+stream and reaps the processes as they become ready, so an :class:`Engine`,
+one event loop in one thread, keeps every pipeline of a run in flight
+without a thread for each stream or process. The loop only moves bytes:
+forking the processes and the listeners that analyse the stream, such as
+the loudness meter, run in the loop's executor so that one pipeline never
+holds up the others.
+
+When a process of a pipeline fails, the other processes are killed and
+reaped and the first failure is raised. :meth:`Engine.cancel` does the same
+to every pipeline, and to the commands started with :func:`run_command`,
+so that a run can stop at once, on a second signal or when its time is up,
+without leaving codec processes behind.
+
+Processes are started with :class:`subprocess.Popen` and reaped with
+``wait4()`` once their pidfd says they have exited, rather than with
+asyncio's subprocess support, whose child watchers park a thread on every
+process. Their CPU time is charged to a stage like that of every other
+codec process, see metrics.Metrics.
+'''
+import asyncio
+import functools
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from . import metrics
+
+# Bytes of the PCM stream copied at a time
+CHUNK_SIZE = 64 * 1024
+# Seconds between checks for an exited process without pidfds
+POLL_INTERVAL = 0.05
+
+
+class ProcessError(Exception):
+    '''
+    A codec process exited with an error.
+
+    Arguments:
+        * cmd (list(str)): its command line
+        * returncode (int): its exit code, or minus the signal that
+            killed it
+        * stderr (bytes): (optional) what it wrote to stderr
+    '''
+
+    def __init__(self, cmd, returncode, stderr=b''):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        lines = stderr.decode('utf-8', 'replace').strip().splitlines()
+        super().__init__('{} error ({}){}'.format(
+            os.path.basename(cmd[0]), returncode,
+            ': ' + lines[-1] if lines else ''))
+
+
+async def _reap(pid):
+    '''
+    Waits for a child process to exit without blocking the event loop.
+
+    :Returns:
+        * tuple(int, resource.struct_rusage): its wait status and resource
+            usage
+    '''
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):  # not Linux 5.3 or later
+        pidfd = None
+    if pidfd is None:
+        while True:
+            reaped, status, usage = os.wait4(pid, os.WNOHANG)
+            if reaped:
+                return status, usage
+            await asyncio.sleep(POLL_INTERVAL)
+
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    try:
+        loop.add_reader(pidfd, lambda: exited.done()
+                        or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+    __, status, usage = os.wait4(pid, 0)
+    return status, usage
+
+
+async def _reader(pipe):
+    'Returns an asyncio.StreamReader reading from a pipe.'
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader
+
+
+async def _read_all(pipe):
+    'Reads a pipe until it is closed.'
+    reader = await _reader(pipe)
+    return await reader.read()
+
+
+class _Sink(asyncio.Protocol):
+    '''
+    The writing end of a pipe to an encoder. :meth:`write` waits while the
+    encoder falls behind.
+    '''
+
+    def __init__(self):
+        self.transport = None
+        self.error = None
+        self._writable = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pause_writing(self):
+        self._writable = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        self._wake()
+
+    def connection_lost(self, exc):
+        self.error = exc or BrokenPipeError()
+        self._wake()
+
+    def _wake(self):
+        if self._writable is not None and not self._writable.done():
+            self._writable.set_result(None)
+        self._writable = None
+
+    async def write(self, data):
+        '''
+        :Raises:
+            * ConnectionError: the encoder stopped reading
+        '''
+        if self.error is not None:
+            raise self.error
+        self.transport.write(data)
+        if self._writable is not None:
+            await self._writable
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        'Closes the pipe once everything written has been sent.'
+        if self.transport is not None:
+            self.transport.close()
+
+
+class Process:
+    '''
+    A child process reaped by the event loop, which also collects what it
+    writes to stderr. Started with :meth:`start`.
+
+    Arguments:
+        * cmd (list(str)): the command line
+        * stdin: (optional) passed to subprocess.Popen
+        * stdout: (optional) passed to subprocess.Popen, defaults to
+            /dev/null
+
+    Once it has started, ``popen`` is its subprocess.Popen object. Once it
+    has exited, ``returncode``, ``stderr``, ``cpu_seconds`` and
+    ``wall_seconds`` are set.
+    '''
+
+    def __init__(self, cmd, stdin=None, stdout=subprocess.DEVNULL):
+        self.cmd = list(cmd)
+        self.popen = None
+        self.returncode = None
+        self.stderr = b''
+        self.cpu_seconds = 0.0
+        self.wall_seconds = 0.0
+        self._stdin = stdin
+        self._stdout = stdout
+        self._started = None
+        self._stderr = None
+        self._exited = None
+
+    async def start(self):
+        '''
+        Forks and executes the process in the loop's executor, which keeps
+        the loop free while the parent's memory is copied.
+
+        :Raises:
+            * OSError: the process could not be started
+            * asyncio.CancelledError: the start was cancelled. The process
+                was started anyway and is left to be killed and reaped.
+        '''
+        loop = asyncio.get_running_loop()
+        spawn = loop.run_in_executor(None, functools.partial(
+            subprocess.Popen, self.cmd, stdin=self._stdin,
+            stdout=self._stdout, stderr=subprocess.PIPE))
+        cancelled = False
+        # The process starts whether or not this is cancelled, so it must
+        # be known to be killed and reaped
+        while not spawn.done():
+            try:
+                await asyncio.wait([spawn])
+            except asyncio.CancelledError:
+                cancelled = True
+        self.popen = spawn.result()
+        self._started = time.perf_counter()
+        self._stderr = asyncio.ensure_future(_read_all(self.popen.stderr))
+        self._exited = asyncio.ensure_future(self._reap())
+        if cancelled:
+            raise asyncio.CancelledError()
+
+    async def _reap(self):
+        status, usage = await _reap(self.popen.pid)
+        # Set on the Popen too, so that it never waits for the pid itself
+        self.returncode = self.popen.returncode = (
+            os.waitstatus_to_exitcode(status))
+        self.cpu_seconds = usage.ru_utime + usage.ru_stime
+        self.wall_seconds = time.perf_counter() - self._started
+        self.stderr = await self._stderr
+        return self.returncode
+
+    async def wait(self):
+        '''
+        Waits for the process to exit. Cancelling the wait does not stop
+        the process from being reaped.
+
+        :Returns:
+            * int: its exit code, 0
+        :Raises:
+            * ProcessError: it failed
+        '''
+        returncode = await asyncio.shield(self._exited)
+        if returncode != 0:
+            raise ProcessError(self.cmd, returncode, self.stderr)
+        return returncode
+
+    def kill(self):
+        'Kills the process, unless it has not started or has been reaped.'
+        if self.popen is not None and self.returncode is None:
+            # Not Popen.kill(), which may reap the process behind our back
+            try:
+                os.kill(self.popen.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    async def reaped(self):
+        'Waits until the process has been reaped, however it exited.'
+        if self._exited is None:
+            return
+        while not self._exited.done():
+            try:
+                await asyncio.shield(self._exited)
+            except asyncio.CancelledError:
+                # Killed processes exit at once, there is nothing to leave
+                # behind for
+                if not self._exited.done():
+                    continue
+                raise
+
+
+async def _run_process(process):
+    '''
+    Runs a process to completion, killing and reaping it when cancelled.
+    '''
+    try:
+        await process.start()
+        await process.wait()
+    except BaseException:
+        process.kill()
+        await process.reaped()
+        raise
+
+
+def run_command(cmd, engine=None):
+    '''
+    Runs a command, such as a tagging tool, from a thread and waits for it.
+    Its CPU time is charged to the stage running in the calling thread, see
+    metrics.charge_children().
+
+    :Args:
+        * cmd(list(str)): the command line
+        * engine(Engine): (optional) runs the process, so that
+            :meth:`Engine.cancel` kills it. Without one it runs in an event
+            loop of its own in this thread.
+    :Raises:
+        * ProcessError: the command failed
+        * concurrent.futures.CancelledError: the engine was cancelled
+    '''
+    process = Process(cmd)
+    try:
+        if engine is None:
+            asyncio.run(_run_process(process))
+        else:
+            engine.run(_run_process, process)
+    finally:
+        metrics.charge_children(process.cpu_seconds)
+
+
+async def _first_failure(coroutines):
+    '''
+    Runs coroutines until they have all finished or one of them fails. The
+    others are then cancelled and the failure is raised. A process killed
+    by SIGPIPE is only reported when nothing else failed, since it stopped
+    because its reader failed.
+    '''
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    failures = [task.exception() for task in tasks
+                if not task.cancelled() and task.exception() is not None]
+    failures.sort(key=lambda failure: isinstance(failure, ProcessError)
+                  and failure.returncode == -signal.SIGPIPE)
+    if failures:
+        raise failures[0]
+
+
+class Pipeline:
+    '''
+    A decoder whose PCM stream is copied to one or more encoders, and handed
+    to listeners on the way. With one encoder and no listeners the encoder
+    reads straight from the decoder.
+
+    Arguments:
+        * decoder (list(str)): the decoder's command line. It writes the PCM
+            stream to its stdout.
+        * encoders (list(list(str))): the command line of each encoder. They
+            read the PCM stream from their stdin.
+        * listeners (iter(callable)): (optional) called with every chunk of
+            the stream
+
+    Once it has run, ``processes`` holds the decoder followed by the
+    encoders that were started, see :class:`Process`, ``bytes`` the length
+    of the stream if it was copied and ``listener_cpu`` the CPU seconds the
+    listeners took.
+    '''
+
+    def __init__(self, decoder, encoders, listeners=()):
+        self.decoder = list(decoder)
+        self.encoders = [list(encoder) for encoder in encoders]
+        self.listeners = list(listeners)
+        self.processes = []
+        self.bytes = 0
+        self.listener_cpu = 0.0
+
+    async def run(self):
+        '''
+        Runs the processes until every one of them has exited.
+
+        :Raises:
+            * ProcessError: a process failed. The others have been killed,
+                and every process has been reaped.
+            * asyncio.CancelledError: the pipeline was cancelled. Every
+                process has been killed and reaped.
+            * Exception: a process could not be started, or a listener
+                failed
+        '''
+        try:
+            decoder = Process(self.decoder, stdout=subprocess.PIPE)
+            self.processes.append(decoder)
+            await decoder.start()
+            jobs = []
+            if self.listeners or len(self.encoders) != 1:
+                for cmd in self.encoders:
+                    encoder = Process(cmd, stdin=subprocess.PIPE)
+                    self.processes.append(encoder)
+                    await encoder.start()
+                jobs.append(self._copy(decoder, self.processes[1:]))
+            else:
+                encoder = Process(self.encoders[0],
+                                  stdin=decoder.popen.stdout)
+                self.processes.append(encoder)
+                try:
+                    await encoder.start()
+                finally:
+                    # The decoder gets SIGPIPE if the encoder stops reading
+                    decoder.popen.stdout.close()
+            jobs.extend(process.wait() for process in self.processes)
+            await _first_failure(jobs)
+        except BaseException:
+            for process in self.processes:
+                process.kill()
+            for process in self.processes:
+                await process.reaped()
+            raise
+
+    def _listen(self, data):
+        'Hands a chunk of the stream to every listener, in the executor.'
+        started = time.thread_time()
+        for listener in self.listeners:
+            listener(data)
+        self.listener_cpu += time.thread_time() - started
+
+    async def _copy(self, decoder, encoders):
+        '''
+        Copies the decoder's stream to every encoder and listener. The
+        listeners take each chunk in the executor, in order, while the
+        encoders are being written to.
+        '''
+        loop = asyncio.get_running_loop()
+        reader = await _reader(decoder.popen.stdout)
+        sinks = []
+        try:
+            for encoder in encoders:
+                sink = _Sink()
+                await loop.connect_write_pipe(lambda: sink,
+                                              encoder.popen.stdin)
+                sinks.append(sink)
+            while sinks:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self.bytes += len(data)
+                pending = [sink.write(data) for sink in sinks]
+                if self.listeners:
+                    pending.append(loop.run_in_executor(None, self._listen,
+                                                        data))
+                results = await asyncio.gather(*pending,
+                                               return_exceptions=True)
+                written = results[:len(sinks)]
+                for result in results[len(sinks):]:
+                    if isinstance(result, BaseException):
+                        raise result
+                for result in written:
+                    if (isinstance(result, BaseException)
+                        and not isinstance(result, ConnectionError)):
+                        raise result
+                # An encoder that stopped reading reports its own error.
+                # Keep feeding the others.
+                sinks = [sink for sink, result in zip(sinks, written)
+                         if result is None]
+        finally:
+            for sink in sinks:
+                sink.close()
+
+
+class Engine:
+    '''
+    Runs pipelines, or any other coroutines, in an event loop in a thread
+    of its own, so that a single thread drives every codec process of a run.
+    Safe to use from several threads.
+    '''
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        # Only used in the loop's thread
+        self._tasks = set()
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='engine', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        '''
+        Starts ``fn(*args)`` in the event loop, like
+        concurrent.futures.Executor.submit().
+
+        :Args:
+            * fn(callable): a coroutine function, such as Pipeline.run
+            * args: arguments passed to ``fn``
+        :Returns:
+            * concurrent.futures.Future: its result. Cancelled if
+                :meth:`cancel` is called before it finishes.
+        '''
+        return asyncio.run_coroutine_threadsafe(self._track(fn, args),
+                                                self._loop)
+
+    def run(self, fn, *args):
+        '''
+        Runs ``fn(*args)`` in the event loop and waits for it.
+
+        :Args:
+            * fn(callable): a coroutine function, such as Pipeline.run
+            * args: arguments passed to ``fn``
+        :Returns:
+            * the result of ``fn``
+        :Raises:
+            * concurrent.futures.CancelledError: :meth:`cancel` was called
+            * Exception: the exception raised by ``fn``
+        '''
+        return self.submit(fn, *args).result()
+
+    async def _track(self, fn, args):
+        if self._cancelled:
+            raise asyncio.CancelledError()
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await fn(*args)
+        finally:
+            self._tasks.discard(task)
+
+    def cancel(self):
+        '''
+        Cancels everything that is running and everything submitted until
+        :meth:`reset` is called. The processes of cancelled pipelines are
+        killed and reaped. For stopping a run at once, e.g. on a signal or
+        when it is out of time. Safe to call from any thread and from a
+        signal handler.
+        '''
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._cancel)
+
+    def _cancel(self):
+        self._cancelled = True
+        for task in list(self._tasks):
+            task.cancel()
+
+    def reset(self):
+        '''
+        Lets coroutines submitted from now on run again after
+        :meth:`cancel`.
+        '''
+        self._loop.call_soon_threadsafe(setattr, self, '_cancelled', False)
+
+    def close(self):
+        '''
+        Cancels everything that is still running, waits until its processes
+        have been reaped and stops the thread.
+        '''
+        if self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(),
+                                         self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _shutdown(self):
+        self._cancel()
+        current = asyncio.current_task()
+        # Also the tasks reaping processes that were killed
+        await asyncio.gather(*(asyncio.all_tasks() - {current}),
+                             return_exceptions=True)
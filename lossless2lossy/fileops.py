@@ -0,0 +1,273 @@
+'''
+Module for copying files that are passed through to the destination folder
+unchanged, such as lossy files and album art.
+
+Copies are done in the kernel with :func:`os.copy_file_range` where the
+filesystem supports it, which also lets filesystems like btrfs and NFS share
+or copy the data server side, then :func:`os.sendfile`, then by reading and
+writing in Python. Timestamps are copied with the data so that an unchanged
+file is never copied twice.
+
+Files can also be linked instead of copied, see :func:`link_file`.
+'''
+import errno
+import fcntl
+import hashlib
+import os
+
+CHUNK_SIZE = 1024 * 1024
+
+# Ways of putting a file in the destination folder, in the order they are
+# tried. Each one falls back to the ones after it.
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+SYMLINK = 'symlink'
+COPY = 'copy'
+LINK_MODES = (REFLINK, HARDLINK, SYMLINK, COPY)
+
+# ioctl sharing the extents of one file with another (linux/fs.h)
+FICLONE = 0x40049409
+
+# Errors meaning "this way of copying is not supported here, try another"
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTSUP, errno.EBADF, errno.EPERM, errno.ETXTBSY,
+                errno.ENOTTY, errno.EMLINK)
+
+
+def _copy_file_range(fsrc, fdst, size, copied):
+    while copied < size:
+        sent = os.copy_file_range(fsrc, fdst, size - copied)
+        if not sent:
+            break
+        copied += sent
+    return copied
+
+
+def _sendfile(fsrc, fdst, size, copied):
+    while copied < size:
+        sent = os.sendfile(fdst, fsrc, copied, min(size - copied, 1 << 30))
+        if not sent:
+            break
+        copied += sent
+    return copied
+
+
+def _copy_fds(fsrc, fdst, size):
+    '''
+    Copies ``size`` bytes between two open file descriptors, using the
+    fastest method that works.
+    '''
+    copied = 0
+    for method, name in ((_copy_file_range, 'copy_file_range'),
+                         (_sendfile, 'sendfile')):
+        if not hasattr(os, name):
+            continue
+        try:
+            copied = method(fsrc, fdst, size, copied)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            # Continue from where the failed method stopped
+            os.lseek(fsrc, copied, os.SEEK_SET)
+            os.lseek(fdst, copied, os.SEEK_SET)
+            continue
+        if copied >= size:
+            return
+        break
+
+    # The file grew, or neither system call is available
+    os.lseek(fsrc, copied, os.SEEK_SET)
+    os.lseek(fdst, copied, os.SEEK_SET)
+    while True:
+        data = os.read(fsrc, CHUNK_SIZE)
+        if not data:
+            break
+        os.write(fdst, data)
+
+
+def copy_file(src, dst):
+    '''
+    Copies the contents and timestamps of a file.
+
+    :Args:
+        * src(str): path to the file to copy
+        * dst(str): path to the copy, replaced if it exists
+    '''
+    _unlink_if_linked(src, dst)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        stat = os.fstat(fsrc.fileno())
+        _copy_fds(fsrc.fileno(), fdst.fileno(), stat.st_size)
+    copy_times(src, dst, stat)
+
+
+def is_link(src, dst):
+    '''
+    Checks whether ``dst`` is a symbolic or hard link to ``src``.
+
+    :Args:
+        * src(str): path to a file
+        * dst(str): path to another file, which may not exist
+    :Returns:
+        * bool
+    '''
+    if os.path.islink(dst):
+        return True
+    try:
+        return os.path.samefile(src, dst)
+    except OSError:
+        return False
+
+
+def _unlink_if_linked(src, dst):
+    'Writing through a link to ``src`` would overwrite the source file.'
+    if is_link(src, dst):
+        os.unlink(dst)
+
+
+def _reflink(src, dst):
+    _unlink_if_linked(src, dst)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+    copy_times(src, dst)
+
+
+def _replace_with(link, src, dst):
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    link(src, dst)
+
+
+def link_file(src, dst, modes=LINK_MODES):
+    '''
+    Puts a file into the destination folder using the first of ``modes``
+    that the filesystems allow:
+
+    * reflink: a copy on write clone sharing the data of ``src`` (btrfs,
+        XFS). Changing either file does not affect the other.
+    * hardlink: another name for ``src``
+    * symlink: a symbolic link to the absolute path of ``src``
+    * copy: a copy made by :func:`copy_file`
+
+    :Args:
+        * src(str): path to the file
+        * dst(str): path of the new file, replaced if it exists
+        * modes(iter(str)): (optional) the modes to try, in order
+    :Returns:
+        * str: the mode that was used
+    :Raises:
+        * OSError: none of the modes worked
+    '''
+    methods = {
+        REFLINK: _reflink,
+        HARDLINK: lambda src, dst: _replace_with(os.link, src, dst),
+        SYMLINK: lambda src, dst: _replace_with(os.symlink,
+                                                os.path.abspath(src), dst),
+        COPY: copy_file,
+    }
+    error = None
+    for mode in modes:
+        try:
+            methods[mode](src, dst)
+            return mode
+        except OSError as e:
+            if mode == COPY or e.errno not in _UNSUPPORTED:
+                raise
+            error = e
+    raise error
+
+
+def move(src, dst):
+    '''
+    Moves a file, replacing ``dst`` in one step so that nothing ever sees a
+    half written file. Between filesystems the file is first copied next to
+    ``dst`` under a temporary name.
+
+    :Args:
+        * src(str): path to the file
+        * dst(str): its new path, replaced if it exists
+    '''
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    folder, name = os.path.split(dst)
+    tmp = os.path.join(folder, '.{}.{}.tmp'.format(name, os.getpid()))
+    try:
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), tmp)
+        else:
+            copy_file(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+    os.unlink(src)
+
+
+def fallbacks(mode):
+    '''
+    Returns the link modes to try for ``mode``: the mode itself followed by
+    each mode after it in LINK_MODES.
+
+    :Args:
+        * mode(str): one of LINK_MODES
+    :Returns:
+        * tuple(str)
+    '''
+    return LINK_MODES[LINK_MODES.index(mode):]
+
+
+def copy_times(src, dst, stat=None):
+    '''
+    Gives ``dst`` the access and modification times of ``src``.
+
+    :Args:
+        * src(str): path to the original file
+        * dst(str): path to the copy
+        * stat(os.stat_result): (optional) the stat of ``src``
+    '''
+    stat = stat or os.stat(src)
+    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def digest(path):
+    '''
+    Returns a hash of the contents of a file.
+
+    :Args:
+        * path(str): path to the file
+    :Returns:
+        * str: hexadecimal digest
+    '''
+    hasher = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def same_content(src, dst):
+    '''
+    Checks whether two files hold the same bytes. Sizes are compared first
+    so that most changed files are never read.
+
+    :Args:
+        * src(str): path to a file
+        * dst(str): path to another file, which may not exist
+    :Returns:
+        * bool: both files exist and have the same contents
+    '''
+    try:
+        if os.path.getsize(src) != os.path.getsize(dst):
+            return False
+    except OSError:
+        return False
+    return digest(src) == digest(dst)
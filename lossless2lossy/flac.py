@@ -8,6 +8,9 @@ import mutagenx.flac
 
 from . import abstract
 
+# The picture type of a front cover in a FLAC PICTURE block
+FRONT_COVER = 3
+
 
 class Flac(mutagenx.flac.FLAC, abstract.Lossless):
     EXTENSIONS = ('.flac',)
@@ -20,18 +23,71 @@ class Flac(mutagenx.flac.FLAC, abstract.Lossless):
         else:
             raise TypeError('not a flac file')
 
+    def audio_md5(self):
+        '''
+        Returns the MD5 signature of the unencoded audio stored in the
+        STREAMINFO block, or None if the encoder did not compute one.
+        '''
+        md5 = self.info.md5_signature
+        if not md5:
+            return None
+        return '{:032x}'.format(md5)
+
+    def duration(self):
+        'Returns the length of the audio in seconds from STREAMINFO.'
+        return self.info.length
+
+    def sample_rate(self):
+        'Returns the sample rate of the audio in Hz from STREAMINFO.'
+        return self.info.sample_rate
+
+    def cover(self):
+        '''
+        Returns the front cover picture, or the first picture if there is
+        none, as a tuple of its bytes and mime type.
+        '''
+        pictures = sorted(self.pictures,
+                          key=lambda picture: picture.type != FRONT_COVER)
+        if not pictures:
+            return None
+        return (pictures[0].data, pictures[0].mime)
+
+    def decoder(self):
+        '''
+        Returns the name of the decoder :meth:`decode` will use. Files that
+        are already 16 bit / 44.1 kHz are decoded by ``flac``; everything
+        else needs ``sox`` to resample and dither.
+        '''
+        info = self.info
+        if info.bits_per_sample == 16 and info.sample_rate == 44100:
+            return 'flac'
+        return 'sox'
+
     def decode(self, outfile='-'):
         '''
         Returns a subprocess object with a decoded PCM stream piped to its
         stdout attribute.
         '''
-        gopts = ['--single-threaded']
-        infile_opts = ['-G', '-b 16']
-        outfile_opts = ['rate', '44100', 'dither', '-s']
-        cmd = (['sox'] + gopts + infile_opts + [self.filename]
-               + ['-t', 'wav', outfile] + outfile_opts)
-
-        popen = subprocess.Popen(cmd,
+        popen = subprocess.Popen(self.decode_command(outfile),
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.PIPE)
         return popen
+
+    def decode_command(self, outfile='-'):
+        '''
+        Returns the command line of the decoder, see :meth:`decoder`.
+        '''
+        if self.decoder() == 'flac':
+            cmd = ['flac', '--decode', '--silent', '--force']
+            if outfile == '-':
+                cmd.append('--stdout')
+            else:
+                cmd.extend(['-o', outfile])
+            cmd.append(self.filename)
+        else:
+            gopts = ['--single-threaded']
+            infile_opts = ['-G', '-b 16']
+            outfile_opts = ['rate', '44100', 'dither', '-s']
+            cmd = (['sox'] + gopts + infile_opts + [self.filename]
+                   + ['-t', 'wav', outfile] + outfile_opts)
+        return cmd
@@ -1,34 +1,249 @@
 import argparse
+import asyncio
+import collections
 import os
+import signal
 import sys
 import shutil
 import multiprocessing
 import functools
+import itertools
+import threading
+import time
 from  concurrent.futures import ThreadPoolExecutor as Executor
 
 from . import sync
 from . import mp3
 from . import abstract
+from . import manifest
+from . import scheduler
+from . import engine as engine_module
+from . import concurrency
+from . import fileops
+from . import plan
+from . import metrics
+from . import watch
+from . import walk
+from . import distributed
+from . import encode_cache
+from . import art
+from . import artwork as artwork_module
+
+try:
+    from . import loudness
+except ImportError:  # numpy is not installed, mp3gain analyses the audio
+    loudness = None
+
+
+def encode_pipeline(lossless_file, encode_classes, paths, stats=None):
+    '''
+    Decodes a lossless file once and encodes the PCM stream with several
+    encode classes at the same time. When numpy is installed the loudness
+    of the audio is measured on the way.
+
+    :Args:
+        * lossless_file(Lossless): an object that inherits from
+            abstract.Lossless
+        * encode_classes(list(type)): classes that inherit from
+            abstract.Lossy
+        * paths(list(str)): the file each encode class writes
+        * stats(metrics.Metrics): (optional) measures the decode and encode
+            stages
+    :Returns:
+        * tuple(list(Lossy), loudness.Loudness): the encoded files, in the
+            order of ``encode_classes``, and the loudness analysis, or None
+            if numpy is not installed
+    :Raises:
+        * engine.ProcessError: the decoder or an encoder failed. The other
+            processes have been killed.
+    '''
+    return asyncio.run(encode_async(lossless_file, encode_classes, paths,
+                                    stats))
+
+
+async def encode_async(lossless_file, encode_classes, paths, stats=None):
+    '''
+    Does what :func:`encode_pipeline` does in a running event loop, such as
+    that of an engine.Engine. Cancelling it kills and reaps the processes.
+    '''
+    stats = stats or metrics.Metrics()
+    src = lossless_file.filename
+    duration = lossless_file.duration()
+    encoders = [encode_class.encode_command(path)
+                for encode_class, path in zip(encode_classes, paths)]
+    meter = None
+    listeners = []
+    if loudness is not None:
+        # Measure loudness while the PCM stream is being encoded
+        meter = loudness.Meter()
+        listeners.append(meter.feed)
+    pipeline = engine_module.Pipeline(lossless_file.decode_command(),
+                                      [cmd for cmd, __ in encoders],
+                                      listeners)
+    # The decode stage lasts as long as the whole pipeline and is named
+    # after the decoder, e.g. decode_sox. Coroutines share the loop's
+    # thread, so the stage is added up rather than measured with
+    # Metrics.stage().
+    started = time.perf_counter()
+    try:
+        await pipeline.run()
+    finally:
+        cpu = pipeline.listener_cpu
+        if pipeline.processes:
+            cpu += pipeline.processes[0].cpu_seconds
+        stats.add('decode_' + lossless_file.decoder(), 1,
+                  time.perf_counter() - started, cpu,
+                  os.path.getsize(src), pipeline.bytes, duration or 0.0)
+    for process, (__, outfile) in zip(pipeline.processes[1:], encoders):
+        stats.add('encode', 1, process.wall_seconds, process.cpu_seconds,
+                  0, os.path.getsize(outfile), duration or 0.0)
+    results = [encode_class(outfile) for encode_class, (__, outfile)
+               in zip(encode_classes, encoders)]
+    return results, (meter.result() if meter is not None else None)
+
+
+def _loudness_from_json(analysis):
+    'Loads a stored loudness analysis, if numpy is installed.'
+    if analysis is None or loudness is None:
+        return None
+    return loudness.Loudness.from_json(analysis)
+
+
+# An encode in progress, see Worker.start_encode(): the file, its
+# destinations, their staged paths, the results and loudness analysis
+# copied from the encode cache, their cache keys, the indexes of the files
+# still to encode and when encoding started
+_Encode = collections.namedtuple(
+    '_Encode', ('lossless_file', 'targets', 'dsts', 'staged', 'results',
+                'analyses', 'keys', 'missing', 'started'))
+
+
+# A file encoded during a run, for copying it to files with identical audio:
+# its destination, path, album folder, encode job and the job that finishes
+# its album, once known. See Worker.copy_encoded()
+_Encoded = collections.namedtuple(
+    '_Encoded', ('target', 'dst', 'folder', 'task', 'album'))
+
+
+class Stopped(Exception):
+    '''
+    Raised by Worker.process() when Worker.stop() was called before it
+    finished.
+    '''
+
+    def __init__(self):
+        super().__init__('stopped before finishing, run again to resume')
 
 
 class Worker:
+    '''
+    Encodes, copies and deletes files so that one or more destination
+    folders match a source folder.
+
+    New files are written to the staging folder of each destination (see
+    sync.Sync.staging_path()) and moved into place once their whole album
+    is finished, so an interrupted run never leaves a partial file or half
+    an album behind. Finished files of unfinished albums are kept in the
+    staging folder and used by the next run.
 
-    def __init__(self, sync_obj, delete=False):
+    Tracks with identical audio, such as the same song on an album and on
+    a compilation, are encoded once per run; the other tracks get a copy of
+    that file with their own tags, see copy_encoded().
+
+    Lossless files that were moved or renamed in the source folder take
+    their encoded files along instead of being encoded again, and an album
+    that was moved as a whole has its folder renamed in one step, see
+    move() and move_album(). This needs a manifest.
+
+    Arguments:
+        * sync_obj (sync.Sync): compares the source folder with the
+            primary destination folder
+        * delete (bool): delete files that are not in the source folder
+        * targets (iter(sync.Sync)): (optional) additional destination
+            folders, each with its own encode class and settings, kept in
+            sync with the same source folder. Each changed lossless file is
+            decoded once and the PCM stream is shared by every target.
+        * limits (concurrency.Limits): (optional) the CPU and I/O budgets.
+            Encodes reserve a CPU slot for every codec process they run.
+            Defaults to one codec process per available CPU.
+        * link_mode (str): (optional) how album art and lossy files are put
+            into the destination folder, one of fileops.LINK_MODES. Modes
+            that are not possible fall back to the ones after them. Lossy
+            files are only ever reflinked or copied, since their tags are
+            rewritten in the destination folder.
+        * remote (distributed.Coordinator): (optional) hands every encode to
+            agents on other machines instead of running the codecs here.
+            Tagging, copies and album finishing still happen here.
+        * artwork (artwork.Artwork): (optional) downscales album art that is
+            copied, and embeds covers in encoded files or writes them as
+            folder images, as it is configured
+        * encode_cache (encode_cache.EncodeCache): (optional) copies files
+            encoded by earlier runs from the cache instead of encoding them
+            again, and adds the files it encodes
+        * lookahead (int): (optional) the number of unfinished jobs queued
+            ahead of the workers. The longest encodes among them are started
+            first, so a long track is not left to run on its own at the end.
+    '''
+
+    def __init__(self, sync_obj, delete=False, targets=(), limits=None,
+                 link_mode=fileops.COPY, remote=None, artwork=None,
+                 encode_cache=None, lookahead=scheduler.DEFAULT_LOOKAHEAD):
         self.sync_obj = sync_obj
+        self.targets = [sync_obj] + list(targets)
         self.delete = delete
         self.encode_class = sync_obj.encode_class
+        self.limits = limits or concurrency.Limits()
+        # Every stage of every target is measured in one place
+        self.metrics = sync_obj.metrics
+        for target in self.targets:
+            target.metrics = self.metrics
+        self.link_mode = link_mode
+        self.remote = remote
+        self.artwork = artwork
+        if artwork is not None:
+            artwork.metrics = self.metrics
+            if artwork.folder:
+                for target in self.targets:
+                    target.cover_name = artwork_module.FOLDER_NAME
+        self.encode_cache = encode_cache
+        if encode_cache is not None:
+            encode_cache.metrics = self.metrics
+        self.max_workers = self.limits.threads
+        if remote is not None:
+            # Threads waiting for agents do not use the CPU budget
+            self.max_workers += remote.slots
         self.executor = Executor(
-                            max_workers=multiprocessing.cpu_count()
+                            max_workers=self.max_workers
                         )
+        # Drives the codec processes of every encode job
+        self.engine = engine_module.Engine()
+        self.lookahead = lookahead
         self.printlock = multiprocessing.Lock()
+        # loudness analysis of files encoded during this run
+        self._loudness = {}
+        self._loudness_lock = threading.Lock()
+        # passthrough files that were already identical in the destination
+        self.copies_skipped = 0
+        # seconds each file encoded during this run took, by destination
+        # path, and the encoding time saved by copying files with identical
+        # audio instead
+        self._encode_seconds = {}
+        self.dedup_seconds = 0.0
+        # set by stop()
+        self._stopping = threading.Event()
+        self._graph = None
 
-    def copy(self, job):
+    def copy(self, job, target=None):
         '''
-        Copies a file to a new location as determined by
-        sync.Sync.src_to_dest()
+        Copies or links a file to the staging folder, keeping its
+        timestamps, to be moved to the location determined by
+        sync.Sync.src_to_dest() by commit_album(). A destination file with
+        the same size and contents is left alone.
 
         :Args:
             * jobs(FileClass)): a FileClass object
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
 
         :Returns:
             * src: original path to the file
@@ -36,62 +251,715 @@ class Worker:
             * lossy_file_coppied: None or the path to the
                 last lossless file copied.
         '''
+        target = target or self.sync_obj
         lossy_file_coppied = None
         src = job.filename
-        dst = self.sync_obj.src_to_dest(src)
-        dst_dir = os.path.dirname(dst)
+        dst = target.src_to_dest(src)
+        staged = target.staging_path(dst)
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
 
-        if not os.path.isdir(dst_dir):
-            os.makedirs(dst_dir, exist_ok=True)
+        modes = fileops.fallbacks(self.link_mode)
+        lossy = isinstance(job, abstract.Lossy)
+        # Album art is downscaled rather than copied
+        resize = (isinstance(job, art.Art) and self.artwork is not None
+                  and self.artwork.size)
+        if lossy:
+            # Tags and ReplayGain are written to lossy files in the
+            # destination folder, which must never reach the source file.
+            modes = [mode for mode in modes
+                     if mode not in (fileops.HARDLINK, fileops.SYMLINK)]
 
-        shutil.copyfile(src, dst)
+        with self.limits.io.slots(), self.metrics.stage('copy') as stage:
+            linked = fileops.is_link(src, dst)
+            if resize:
+                up_to_date = False
+            elif linked:
+                up_to_date = not lossy
+            else:
+                # An identical copy is replaced when linking saves space
+                up_to_date = (self.link_mode == fileops.COPY
+                              and fileops.same_content(src, dst))
+            if up_to_date:
+                if not linked:
+                    fileops.copy_times(src, dst)
+                with self.printlock:
+                    self.copies_skipped += 1
+            elif resize:
+                data = self.artwork.process_file(src)
+                with open(staged, 'wb') as f:
+                    f.write(data)
+                fileops.copy_times(src, staged)
+                stage.bytes_out = len(data)
+            else:
+                mode = fileops.link_file(src, staged, modes)
+                if mode == fileops.COPY:
+                    stage.bytes_in = stage.bytes_out = os.path.getsize(
+                        staged)
+        if up_to_date:
+            target.record(src)
+        else:
+            target.stage(src)
+        self.set_loudness(dst, None, target=target)
 
-        if isinstance(job, abstract.Lossy):
+        if lossy:
             lossy_file_coppied = dst
         return (src, dst, lossy_file_coppied)
 
-    def encode(self, job):
+    def encode(self, job, target=None):
         '''
         Encodes each file in jobs to a lossy format.
 
         :Args:
             * jobs(Lossless): an object that inherits from
                 abstract.Lossless
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
         :Returns:
             * dst(str): filename of the encoded file
             * encoded(Lossy): Lossy class object representing the encoded
                 file
         '''
+        return self.encode_many(job, [target or self.sync_obj])[0]
+
+    def encode_many(self, job, targets):
+        '''
+        Decodes a lossless file once and encodes it for several targets at
+        the same time, and waits for it. The files are written to the
+        staging folder of each target and deleted again if anything fails.
+        They are tagged by finalize_album().
+
+        :Args:
+            * jobs(Lossless): an object that inherits from
+                abstract.Lossless
+            * targets(list(sync.Sync)): the destinations
+        :Returns:
+            * list(tuple(str, Lossy)): the destination filename and the
+                Lossy class object of each staged file, in the order of
+                ``targets``
+        '''
+        result = self.start_encode(job, targets)
+        if isinstance(result, scheduler.Deferred):
+            result = result.resolve()
+        return result
+
+    def start_encode(self, job, targets):
+        '''
+        Starts an encode like encode_many() without waiting for the codecs,
+        for process(). Files in the encode cache are copied, the others are
+        encoded by a pipeline in ``self.engine``, or by an agent.
+
+        :Returns:
+            * list(tuple(str, Lossy)): the result of encode_many(), when
+                every file was in the encode cache
+            * scheduler.Deferred: finishes the encode with
+                :meth:`_finish_encode` once the codecs are done
+        '''
         lossless_file = job
         src = lossless_file.filename
-        dst = self.sync_obj.src_to_dest(src)
-        pcm = lossless_file.decode()
-        encoded = self.encode_class.encode(dst, pcm)
-        # copy tags
-        for tag in lossless_file:
-            if tag in encoded.VALID_TAGS:
-                encoded[tag] = lossless_file[tag]
-        encoded.save()
+        dsts = [target.src_to_dest(src) for target in targets]
+        staged = [target.staging_path(dst)
+                  for target, dst in zip(targets, dsts)]
+        try:
+            return self._start_encode(lossless_file, targets, dsts, staged)
+        except BaseException:
+            self._discard_staged(staged)
+            raise
+
+    @staticmethod
+    def _discard_staged(staged):
+        for path in staged:
+            if os.path.lexists(path):
+                os.unlink(path)
+
+    def _start_encode(self, lossless_file, targets, dsts, staged):
+        src = lossless_file.filename
+        results = [None] * len(targets)
+        analyses = [None] * len(targets)
+        cache = self.encode_cache
+        keys = [None] * len(targets)
+        if cache is not None:
+            keys = [self.audio_key(lossless_file, target)
+                    for target in targets]
+        # Files encoded before are copied from the cache without decoding
+        for index, key in enumerate(keys):
+            if key is None:
+                continue
+            os.makedirs(os.path.dirname(staged[index]), exist_ok=True)
+            with self.limits.io.slots():
+                cached = cache.get(key, staged[index])
+            if cached is not None:
+                results[index] = targets[index].encode_class(staged[index])
+                results[index].clear_tags()
+                analyses[index] = _loudness_from_json(cached['loudness'])
+
+        missing = [index for index, result in enumerate(results)
+                   if result is None]
+        encode = _Encode(lossless_file, targets, dsts, staged, results,
+                         analyses, keys, missing, time.monotonic())
+        if not missing:
+            return self._finish_encode(None, encode)
+        encode_classes = [targets[index].encode_class for index in missing]
+        paths = [staged[index] for index in missing]
+        if self.remote is not None:
+            # An agent on another machine runs the codecs
+            future = self.remote.submit(src,
+                                        list(zip(encode_classes, paths)))
+        else:
+            future = self.engine.submit(self._encode_async, lossless_file,
+                                        encode_classes, paths)
+        return scheduler.Deferred(future, self._finish_encode, encode)
+
+    async def _encode_async(self, lossless_file, encode_classes, paths):
+        '''
+        Runs in ``self.engine``: waits for one CPU slot for the decoder and
+        one for each encoder, then runs the pipeline.
+
+        :Returns:
+            * tuple(list(Lossy), loudness.Loudness, float): the result of
+                encode_async() and the seconds it took
+        '''
+        taken = await self.limits.cpu.acquire_async(1 + len(paths))
+        try:
+            started = time.monotonic()
+            encoded, result = await encode_async(
+                lossless_file, encode_classes, paths, self.metrics)
+            return encoded, result, time.monotonic() - started
+        finally:
+            self.limits.cpu.release(taken)
+
+    def _finish_encode(self, future, encode):
+        '''
+        Keeps the files encoded by :meth:`start_encode` in the encode cache
+        and stages them, or deletes them if the encode failed.
+
+        :Args:
+            * future(concurrent.futures.Future): the encode, or None when
+                every file came from the encode cache
+            * encode(_Encode): the encode
+        :Returns:
+            * list(tuple(str, Lossy)): the result of encode_many()
+        '''
+        try:
+            return self._stage_encoded(future, encode)
+        except BaseException:
+            self._discard_staged(encode.staged)
+            raise
+
+    def _stage_encoded(self, future, encode):
+        lossless_file = encode.lossless_file
+        src = lossless_file.filename
+        duration = lossless_file.duration()
+        results, analyses = encode.results, encode.analyses
+        if future is None:
+            encoded, result, elapsed = [], None, 0.0
+        elif self.remote is not None:
+            analysis = future.result()
+            elapsed = time.monotonic() - encode.started
+            self.metrics.add('remote', 1, elapsed,
+                             audio_seconds=duration or 0.0)
+            encoded = [encode.targets[index].encode_class(
+                encode.staged[index]) for index in encode.missing]
+            result = _loudness_from_json(analysis)
+        else:
+            encoded, result, elapsed = future.result()
+
+        for index, encoded_file in zip(encode.missing, encoded):
+            results[index] = encoded_file
+            analyses[index] = result
+            target = encode.targets[index]
+            key = encode.keys[index]
+            with self.printlock:
+                self._encode_seconds[encode.dsts[index]] = elapsed
+            if key is not None:
+                with self.limits.io.slots():
+                    self.encode_cache.put(key, encode.staged[index],
+                                          result.to_json()
+                                          if result is not None else None)
+            if (duration and target.manifest is not None
+                and self.remote is None):
+                # Measured speed, for estimating future runs
+                target.manifest.add_throughput(lossless_file.decoder(),
+                                               target.encode_settings,
+                                               duration, elapsed)
+
+        # Tags are written once the whole album is finished, see
+        # finalize_album()
+        for target, dst, analysis in zip(encode.targets, encode.dsts,
+                                         analyses):
+            self.set_loudness(dst, analysis, target=target)
+            target.stage(src, lossless_file.audio_md5())
+        return list(zip(encode.dsts, results))
+
+    @staticmethod
+    def audio_key(lossless_file, target):
+        '''
+        Returns what an encode depends on: the audio, as identified by the
+        MD5 signature of the unencoded samples, and the encoder settings.
+        Files with the same key encode to the same audio.
+
+        :Args:
+            * lossless_file(Lossless): the file to encode
+            * target(sync.Sync): the destination
+        :Returns:
+            * None: the file has no MD5 signature
+            * tuple: the key
+        '''
+        md5 = lossless_file.audio_md5()
+        if md5 is None:
+            return None
+        return (md5, lossless_file.sample_rate(), target.encode_settings)
+
+    def copy_encoded(self, job, target, original, original_target):
+        '''
+        Stages a copy of a file encoded earlier in this run from identical
+        audio, instead of encoding it again. The copy's tags are removed, so
+        finalize_album() gives it its own. Its loudness, and the gain
+        already applied to it, are those of the original.
+
+        :Args:
+            * job(Lossless): an object that inherits from abstract.Lossless
+            * target(sync.Sync): the destination
+            * original(str): the original's path in the destination folder
+                of ``original_target``. Its staged file is copied while its
+                album is unfinished, so process() schedules this job after
+                the original's encode if both are in the same album and
+                after the original's whole album otherwise.
+            * original_target(sync.Sync): the original's destination
+        :Returns:
+            * dst(str): filename of the copied file
+            * encoded(Lossy): Lossy class object representing the staged
+                file
+        '''
+        lossless_file = job
+        src = lossless_file.filename
+        dst = target.src_to_dest(src)
+        staged = target.staging_path(dst)
+        copied = original_target.staging_path(original)
+        if not os.path.lexists(copied):
+            copied = original
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+        with self.limits.io.slots(), self.metrics.stage(
+                'dedup', audio_seconds=lossless_file.duration() or 0.0):
+            try:
+                fileops.link_file(copied, staged,
+                                  (fileops.REFLINK, fileops.COPY))
+                encoded = target.encode_class(staged)
+                encoded.clear_tags()
+            except BaseException:
+                if os.path.lexists(staged):
+                    os.unlink(staged)
+                raise
+        analysis = self._get_loudness(original, original_target)
+        if analysis is None:
+            self.set_loudness(dst, None, target=target)
+        else:
+            self.set_loudness(dst, analysis[0], analysis[1], target=target)
+        target.stage(src, lossless_file.audio_md5())
+        with self.printlock:
+            self.dedup_seconds += self._encode_seconds.get(original, 0.0)
+        return (dst, encoded)
+
+    def set_loudness(self, dst, result, applied=0, target=None):
+        '''
+        Remembers the loudness of an encoded file for album ReplayGain, in
+        memory and in the manifest.
+
+        :Args:
+            * dst(str): path to the file in the destination folder
+            * result(loudness.Loudness): the analysis, or None to forget a
+                previous analysis
+            * applied(int): gain already applied to the file
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
+        '''
+        target = target or self.sync_obj
+        with self._loudness_lock:
+            if result is None:
+                self._loudness.pop(dst, None)
+            else:
+                self._loudness[dst] = (result, applied)
+        manifest = target.manifest
+        if manifest is not None:
+            stats = None if result is None else result.to_json()
+            manifest.set_loudness(dst, stats, applied)
+
+    def _get_loudness(self, dst, target):
+        with self._loudness_lock:
+            if dst in self._loudness:
+                return self._loudness[dst]
+        manifest = target.manifest
+        # Rows stored by a run that had numpy cannot be loaded without it
+        if manifest is not None and loudness is not None:
+            row = manifest.loudness(dst)
+            if row is not None:
+                return (loudness.Loudness.from_json(row[0]), row[1])
+        return None
+
+    def album_replaygain(self, folder, target=None):
+        '''
+        Computes album ReplayGain for a folder from the stored analysis of
+        each of its tracks, without decoding anything. Tracks in the
+        staging folder count as part of the album.
+
+        :Args:
+            * folder(str): path to an album in the destination folder
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
+        :Returns:
+            * None: numpy is missing, or a track has not been analysed
+            * dict(str: abstract.ReplayGain): values for each track
+        '''
+        if loudness is None:
+            return None
+        target = target or self.sync_obj
+        extension = target.encode_class.EXTENSIONS[0]
+        # The album's tracks: finished ones and those about to be committed
+        names = set()
+        for path in (folder, target.staging_path(folder)):
+            if os.path.isdir(path):
+                names.update(os.listdir(path))
+        tracks = {}
+        for name in sorted(names):
+            if os.path.splitext(name)[1].lower() != extension:
+                continue
+            filename = os.path.join(folder, name)
+            track = self._get_loudness(filename, target)
+            if track is None:
+                return None
+            tracks[filename] = track
+
+        album = loudness.Loudness.album(track for track, __ in tracks.values())
+        album_gain = album.gain
+        return dict(
+            (filename, abstract.ReplayGain(track.gain, track.peak,
+                                           album_gain, album.peak, applied))
+            for filename, (track, applied) in tracks.items()
+        )
+
+    def retag(self, job, target=None):
+        '''
+        Puts a copy of the existing encoded file of a lossless file in the
+        staging folder, for finalize_album() to copy the new tags onto,
+        without re-encoding the audio. Used when sync.Sync.audio_unchanged()
+        reports that only the tags changed.
+
+        :Args:
+            * jobs(Lossless): an object that inherits from
+                abstract.Lossless
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
+        :Returns:
+            * dst(str): filename of the retagged file
+            * encoded(Lossy): Lossy class object representing the staged
+                file
+        '''
+        target = target or self.sync_obj
+        lossless_file = job
+        src = lossless_file.filename
+        dst = target.src_to_dest(src)
+        staged = target.staging_path(dst)
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+        with self.limits.io.slots(), self.metrics.stage('tag'):
+            try:
+                fileops.link_file(dst, staged,
+                                  (fileops.REFLINK, fileops.COPY))
+                encoded = target.encode_class(staged)
+            except BaseException:
+                if os.path.lexists(staged):
+                    os.unlink(staged)
+                raise
+        target.stage(src, lossless_file.audio_md5())
+        return (dst, encoded)
+
+    def move(self, job, target, origin):
+        '''
+        Puts the encoded file of a lossless file that was moved or renamed
+        in the source folder into the staging folder, instead of encoding it
+        again. The file is taken from its old place when files that are not
+        in the source folder are deleted, and copied otherwise.
+        finalize_album() then writes the file's tags, which may have
+        changed, and its new album's ReplayGain.
+
+        :Args:
+            * job(Lossless): an object that inherits from abstract.Lossless
+            * target(sync.Sync): the destination
+            * origin(sync.Move): where the file was moved from, see
+                sync.Sync.find_move()
+        :Returns:
+            * dst(str): filename of the moved file
+            * encoded(Lossy): Lossy class object representing the staged
+                file
+        '''
+        lossless_file = job
+        src = lossless_file.filename
+        dst = target.src_to_dest(src)
+        staged = target.staging_path(dst)
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+        with self.limits.io.slots(), self.metrics.stage('move'):
+            try:
+                if self.delete:
+                    fileops.move(origin.dest, staged)
+                else:
+                    fileops.link_file(origin.dest, staged,
+                                      (fileops.REFLINK, fileops.COPY))
+                encoded = target.encode_class(staged)
+            except BaseException:
+                if os.path.lexists(staged):
+                    os.unlink(staged)
+                raise
+        self._moved(origin, dst, target)
+        target.stage(src, lossless_file.audio_md5())
         return (dst, encoded)
 
-    def post_encode_hook(self, lossy):
+    def move_album(self, folder, target, origin, moves):
+        '''
+        Renames an album's folder in the destination folder when the whole
+        album was moved or renamed in the source folder, see
+        sync.Sync.find_folder_move(). Scheduled by process() before
+        finalize_album(), which writes the tags of the tracks whose source
+        files changed.
+
+        :Args:
+            * folder(str): the album's new folder in the destination folder
+            * target(sync.Sync): the destination
+            * origin(str): its old folder
+            * moves(list(tuple(FileClass, sync.Move))): every file of the
+                album and where it was moved from
+        :Returns:
+            * list(tuple(str, str)): the new and old path of every file
+        '''
+        with self.limits.io.slots(), self.metrics.stage('move'):
+            os.makedirs(os.path.dirname(folder), exist_ok=True)
+            os.rename(origin, folder)
+        moved = []
+        for file_, move in moves:
+            dst = target.src_to_dest(file_.filename)
+            self._moved(move, dst, target)
+            audio = None
+            if isinstance(file_, abstract.Lossless):
+                audio = file_.audio_md5()
+            target.record(file_.filename, audio)
+            moved.append((dst, move.dest))
+        target.manifest.commit()
+        return moved
+
+    def _moved(self, origin, dst, target):
+        '''
+        Moves what is known about a moved file: its loudness and, when it
+        was taken from its old place, its manifest entry.
+        '''
+        analysis = self._get_loudness(origin.dest, target)
+        if analysis is not None:
+            self.set_loudness(dst, analysis[0], analysis[1], target=target)
+        if self.delete:
+            self.set_loudness(origin.dest, None, target=target)
+            target.manifest.forget(origin.src)
+
+    def _find_moves(self, s_folder, loaded_file_classes, wanted, moved):
+        '''
+        Finds the files of a source directory that were moved or renamed,
+        and the targets whose folder for the whole directory can be
+        renamed. Files are only renamed, rather than copied, when files that
+        are not in the source folder are deleted.
+
+        :Args:
+            * s_folder(str): the directory in the source folder
+            * loaded_file_classes(list(FileClass)): its changed files
+            * wanted(dict(str: list(tuple(sync.Sync, str)))): the targets
+                that need each file, and the kind of action
+            * moved(set(str)): files and folders in the destination folders
+                that are moved. Those found are added.
+        :Returns:
+            * dict(sync.Sync: tuple(str, list(tuple(FileClass, sync.Move)))):
+                the old folder of each target whose folder is renamed, and
+                the move of every file
+            * dict(tuple(str, sync.Sync): sync.Move): the move of each
+                lossless file that is moved on its own
+        '''
+        folders = {}
+        files = {}
+        for target in self.targets:
+            if target.manifest is None:
+                continue
+            changed = [(file_, kind) for file_ in loaded_file_classes
+                       for other, kind in wanted[file_.filename]
+                       if other is target]
+            found = []
+            claimed = set(moved)
+            for file_, kind in changed:
+                if kind != sync.ADD:
+                    continue
+                move = target.find_move(file_, claimed)
+                if move is not None:
+                    claimed.add(move.dest)
+                    found.append((file_, move))
+            if not found:
+                continue
+
+            origin = None
+            if self.delete and len(found) == len(changed):
+                origin = target.find_folder_move(
+                    s_folder, [(file_.filename, move)
+                               for file_, move in found])
+            if origin is not None:
+                folders[target] = (origin, found)
+                moved.add(origin)
+                moved.update(move.dest for __, move in found)
+                continue
+            # Copies are cheap, only encodes are worth saving one by one
+            for file_, move in found:
+                if isinstance(file_, abstract.Lossless):
+                    files[(file_.filename, target)] = move
+                    moved.add(move.dest)
+        return folders, files
+
+    def post_encode_hook(self, lossy, target=None):
         '''
-        Runs the post_encode_hook method on *lossy*
+        Runs the post_encode_hook method on *lossy*, passing it album
+        ReplayGain computed from stored loudness analysis when every track
+        of the album has been analysed.
 
         :Args:
             * lossy(Lossy): an object that inherits from
                 abstract.Lossy
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
+        '''
+        target = target or self.sync_obj
+        folder = os.path.dirname(lossy.filename)
+        replaygain = self.album_replaygain(folder, target)
+        applied = lossy.post_encode_hook(replaygain, engine=self.engine)
+        if applied:
+            for filename, steps in applied.items():
+                self.set_loudness(filename,
+                                  self._get_loudness(filename, target)[0],
+                                  steps, target=target)
+        with self.printlock:
+            print('ReplayGain:"{}/"\n'.format(folder))
+
+    def finalize_album(self, folder, target=None, sources=(),
+                       replaygain=True):
+        '''
+        Writes the tags, ReplayGain values, cover and ID3 v1.1 tags of an
+        album's staged files with a single save per file, so that
+        commit_album()
+        moves finished files into place and the destination folder sees
+        one write per track. Tracks of the album that are already in the
+        destination folder get their new album gain the same way, through
+        a copy in the staging folder. Scheduled by process() to depend on
+        the album's jobs.
+
+        :Args:
+            * folder(str): the album's folder in the destination folder
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
+            * sources(iter(tuple(str, Lossless))): the destination path of
+                each encoded or retagged track and the lossless file whose
+                tags it gets
+            * replaygain(bool): (optional) whether the album's lossy files
+                changed and need ReplayGain
+        :Returns:
+            * bool: True if ReplayGain was written or not needed, False if
+                it could not be precomputed and post_encode_hook() must
+                analyse the album once it is committed
         '''
-        def replaygain_callback(result, folder=None):
-            # check for exception
-            result.result()
+        target = target or self.sync_obj
+        sources = dict(sources)
+        values = self.album_replaygain(folder, target) if replaygain else None
+        artwork = self.artwork
+        if artwork is not None and artwork.folder and sources:
+            self._write_folder_image(folder, target, sources.values())
+        with self.limits.io.slots(), self.metrics.stage('tag'):
+            for dst in sorted(set(sources) | set(values or ())):
+                staged = target.staging_path(dst)
+                if not os.path.lexists(staged):
+                    if not os.path.lexists(dst):
+                        continue
+                    fileops.link_file(dst, staged,
+                                      (fileops.REFLINK, fileops.COPY))
+                lossy = target.encode_class(staged)
+                file_values = values.get(dst) if values else None
+                cover = None
+                if (dst in sources and artwork is not None
+                    and artwork.embed):
+                    cover = artwork.cover(sources[dst])
+                applied = lossy.finalize(sources.get(dst), file_values,
+                                         cover, engine=self.engine)
+                if applied is not None:
+                    self.set_loudness(dst,
+                                      self._get_loudness(dst, target)[0],
+                                      applied, target=target)
+        if values:
             with self.printlock:
                 print('ReplayGain:"{}/"\n'.format(folder))
+        return values is not None or not replaygain
 
-        folder = os.path.dirname(lossy.filename)
-        callback = functools.partial(replaygain_callback, folder=folder)
-        task = self.executor.submit(lossy.post_encode_hook)
-        task.add_done_callback(callback)
+    def _write_folder_image(self, folder, target, lossless_files):
+        '''
+        Stages the album's cover as artwork.FOLDER_NAME, unless the source
+        folder has an image of that name, which is copied instead.
+        '''
+        lossless_files = list(lossless_files)
+        s_folder = os.path.dirname(lossless_files[0].filename)
+        name = artwork_module.FOLDER_NAME
+        if name in (other.lower() for other in os.listdir(s_folder)):
+            return
+        data = self.artwork.folder_image(lossless_files)
+        if data is None:
+            return
+        staged = target.staging_path(os.path.join(folder, name))
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+        with open(staged, 'wb') as f:
+            f.write(data)
+
+    def commit_album(self, folder, target=None):
+        '''
+        Moves the finished files of an album from the staging folder into
+        the destination folder, one after the other without waiting for
+        anything in between, and records them in the manifest. Scheduled by
+        process() to depend on finalize_album().
+
+        :Args:
+            * folder(str): the album's folder in the destination folder
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
+        :Returns:
+            * list(str): the files that were moved into place
+        '''
+        target = target or self.sync_obj
+        staged_folder = target.staging_path(folder)
+        moved = []
+        if not os.path.isdir(staged_folder):
+            return moved
+        with self.limits.io.slots(), self.metrics.stage('commit'):
+            os.makedirs(folder, exist_ok=True)
+            for name in sorted(os.listdir(staged_folder)):
+                staged = os.path.join(staged_folder, name)
+                if os.path.isdir(staged) and not os.path.islink(staged):
+                    continue  # another album
+                dst = os.path.join(folder, name)
+                fileops.move(staged, dst)
+                if target.manifest is not None:
+                    target.manifest.unstage(dst)
+                moved.append(dst)
+        if target.manifest is not None:
+            target.manifest.commit()
+        return moved
+
+    def finish_album(self, lossy_file, target=None):
+        '''
+        Runs the post_encode_hook on an album once all of its tracks have
+        been moved into place. Scheduled by process() to depend on
+        commit_album() when finalize_album() could not write ReplayGain.
+
+        :Args:
+            * lossy_file(str): path to any lossy file in the album
+            * target(sync.Sync): (optional) the destination, defaults to
+                ``self.sync_obj``
+        '''
+        # mp3gain runs one process at a time
+        with self.limits.cpu.slots(), self.metrics.stage('post_encode_hook'):
+            self.post_encode_hook(sync.Sync.load_file(lossy_file), target)
 
     def delete_files(self, job):
         '''
@@ -103,8 +971,10 @@ class Worker:
             * str: path to the deleted file
         '''
         file_ = job
-        if os.path.isfile(file_):
-            os.unlink(file_)
+        # a symlink whose source file was deleted is not a file any more
+        if os.path.isfile(file_) or os.path.islink(file_):
+            with self.metrics.stage('delete'):
+                os.unlink(file_)
             return file_
 
     def delete_subs(self, job):
@@ -118,92 +988,454 @@ class Worker:
         '''
         sub_dir = job
         if os.path.isdir(sub_dir):
-            shutil.rmtree(sub_dir)
+            with self.metrics.stage('delete'):
+                shutil.rmtree(sub_dir)
             return sub_dir
 
-    def run(self):
+    def process(self, roots=None):
         '''
-        Runs the program
+        Encodes, copies and deletes files so that the destination folders
+        match the source folder, or only the parts of it below ``roots``.
+        Albums are finished (ReplayGain, post encode hook) exactly as in a
+        full run, so a partial run can be used for any directory whose
+        contents changed.
+
+        :Args:
+            * roots(iter(tuple(str, bool))): (optional) directories of the
+                source folder to compare, each with whether its
+                subdirectories are compared too, see sync.diff_all().
+                Defaults to the whole source folder.
+        :Returns:
+            * collections.Counter: the number of files encoded by each
+                decoder, copied from a file encoded from identical audio
+                (``'deduplicated'``), moved along with their source files
+                (``'moved'``), retagged (``'retagged'``), copied
+                (``'copied'``) and left finished in the staging folder by an
+                earlier run (``'resumed'``)
+        :Raises:
+            * Stopped: stop() was called
+            * Exception: the first job that failed, once the jobs that were
+                already running have finished
         '''
-        compare = self.sync_obj
-        not_in_dest = compare.not_in_destination()
-        total_files_encoded = 0
-        total_files_copied = 0
+        deletions = []
+        # Partly written files are deleted, finished ones are used below
+        for target in self.targets:
+            target.clean_staging()
+
+        def changes():
+            # Deletions are held back until everything has been encoded
+            for target, action in sync.diff_all(self.targets,
+                                                deletes=self.delete,
+                                                roots=roots):
+                if action.kind in (sync.DELETE, sync.DELETE_DIR):
+                    deletions.append(action)
+                else:
+                    yield target, action
+
+        # Jobs wait in the graph, not in the executor's queue, so that the
+        # longest ready encode is the next to start
+        graph = self._graph = scheduler.TaskGraph(
+            self.executor, limit=max(self.max_workers * 2, self.lookahead),
+            workers=self.max_workers)
+        self.engine.reset()
+        if self._stopping.is_set():
+            graph.cancel()
+        totals = collections.Counter()
+
+        def report(task, message, total):
+            if task.exception() is None:
+                with self.printlock:
+                    for dst, __ in task.result():
+                        print(message.format(dst))
+                        totals[total] += 1
+
+        def report_copy(task):
+            if task.exception() is None:
+                with self.printlock:
+                    print('Copied: "{}"\n'.format(task.result()[1]))
+                    totals['copied'] += 1
+
+        def one(fn):
+            # Wraps single file jobs so every job returns a list of results
+            return lambda *args: [fn(*args)]
+
+        def finish(finalized, lossy_file, target):
+            if not finalized.result():
+                self.finish_album(lossy_file, target)
+
+        # audio_key(): _Encoded, for encoding identical audio only once
+        encoded = {}
+        # Files and folders in the destination folders that were moved
+        # rather than deleted
+        moved = set()
 
         try:
-            for subdir in not_in_dest:
+            for s_folder, group in itertools.groupby(
+                    changes(),
+                    key=lambda change: os.path.dirname(change[1].src)):
+                # Stop feeding new albums as soon as anything fails
+                if self._stopping.is_set():
+                    raise Stopped()
+                failure = graph.failure()
+                if failure is not None:
+                    raise failure
+
+                # Every target that needs each source file, and why
+                wanted = collections.OrderedDict()
+                for target, action in group:
+                    wanted.setdefault(action.src, []).append(
+                        (target, action.kind))
+                with self.metrics.stage('load'):
+                    loaded_file_classes = sync.Sync.load_cls_objs(wanted)
+                # Files moved or renamed in the source folder keep the files
+                # they were synced to
+                folder_moves, file_moves = self._find_moves(
+                    s_folder, loaded_file_classes, wanted, moved)
+
                 copy_jobs = []
                 encode_jobs = []
-                loaded_file_classes = sync.Sync.load_cls_objs(subdir)
+                retag_jobs = []
+                move_jobs = []
+                resumed = []
                 for file_ in loaded_file_classes:
                     # Only encode lossless files. Lossy files and album art are
-                    # copied.
-                    if isinstance(file_, abstract.Lossless):
-                        encode_jobs.append(file_)
-                    else:
-                        copy_jobs.append(file_)
-
-                if copy_jobs:
-                    lossy_copied = False
-                    for copy_job in copy_jobs:
-                        __, dst, lossy = self.copy(copy_job)
-                        with self.printlock:
-                            print('Copied: "{}"\n'.format(dst))
-                        if (not lossy_copied) and (lossy):
-                            lossy_copied = lossy
-                        total_files_copied += 1
-                    if lossy_copied:
-                        lossy_file = sync.Sync.load_file(lossy_copied)
-                        self.post_encode_hook(lossy_file)
-
-                if encode_jobs:
-                    executor_futures = []
-                    for encode_job in encode_jobs:
-                        executor_futures.append(
-                            self.executor.submit(self.encode, encode_job)
-                        )
-
-                    # Wait for all encode jobs to finish before
-                    # post_encode_hook
-                    for job in executor_futures:
-                        result = job.result()
-                        with self.printlock:
-                            print('Encoded: {}\n'.format(result[0]))
-                        total_files_encoded += 1
-                        last_encoded_file = result[1]
-
-                    self.post_encode_hook(last_encoded_file)
-
-            # Wait for all threads to finish
-            self.executor.shutdown(wait=True)
-
-            if (self.delete is True):
-                # Look for files that have been deleted from the source folder
-                not_in_source = compare.not_in_source()
-                for subs, files in not_in_source:
-                    if subs:
-                        for sub in subs:
-                            result = self.delete_subs(sub)
-                            with self.printlock:
-                                print('Deleted: "{}"/\n'.format(result))
-                    if files:
-                        for file_ in files:
-                            result = self.delete_files(file_)
-                            with self.printlock:
-                                print('Deleted: "{}"\n'.format(result))
+                    # copied. Lossless files whose audio is unchanged only
+                    # need their tags copied again. A file is decoded once
+                    # for every target that needs it encoded. Files an
+                    # interrupted run already finished are used as they are.
+                    encode_targets = []
+                    for target, kind in wanted[file_.filename]:
+                        move = file_moves.get((file_.filename, target))
+                        if target in folder_moves:
+                            continue
+                        elif target.staged(file_.filename):
+                            resumed.append((file_, target))
+                        elif move is not None:
+                            move_jobs.append((file_, target, move))
+                        elif not isinstance(file_, abstract.Lossless):
+                            copy_jobs.append((file_, target))
+                        elif (kind == sync.UPDATE
+                              and target.audio_unchanged(file_)):
+                            retag_jobs.append((file_, target))
+                        else:
+                            encode_targets.append(target)
+                    if encode_targets:
+                        encode_jobs.append((file_, encode_targets))
+
+                # Per target: the album's jobs, and a file to load for the
+                # post encode hook
+                albums = collections.OrderedDict(
+                    (target, ([], None)) for target in self.targets
+                )
+                # Per target: the lossless file whose tags each staged track
+                # gets
+                sources = collections.defaultdict(list)
+
+                for resumed_job, target in resumed:
+                    dst = target.src_to_dest(resumed_job.filename)
+                    with self.printlock:
+                        print('Resumed: "{}"\n'.format(dst))
+                        totals['resumed'] += 1
+                    if isinstance(resumed_job, (abstract.Lossless,
+                                                abstract.Lossy)):
+                        albums[target] = (albums[target][0], dst)
+                    if isinstance(resumed_job, abstract.Lossless):
+                        sources[target].append((dst, resumed_job))
+
+                # Copies run in the background alongside the encodes, as
+                # many at a time as the I/O budget allows.
+                for copy_job, target in copy_jobs:
+                    task = graph.submit(self.copy, copy_job, target)
+                    task.add_done_callback(report_copy)
+                    tracks, lossy_file = albums[target]
+                    tracks.append(task)
+                    if ((not lossy_file)
+                        and isinstance(copy_job, abstract.Lossy)):
+                        lossy_file = target.src_to_dest(copy_job.filename)
+                        albums[target] = (tracks, lossy_file)
+
+                # Audio already encoded during this run is copied. A copy
+                # waits for the original's encode when both are in this
+                # album, since this album's tags are only written once the
+                # copy is made, and for the original's whole album
+                # otherwise.
+                registered = []
+                for encode_job, targets in encode_jobs:
+                    fresh = []
+                    for target in targets:
+                        original = encoded.get(
+                            self.audio_key(encode_job, target))
+                        if (original is not None
+                            and original.target is target
+                            and original.folder == target.src_to_dest(
+                                s_folder)):
+                            after = original.task
+                        elif original is not None and original.album:
+                            after = original.album
+                        else:
+                            fresh.append(target)
+                            continue
+                        task = graph.submit(one(self.copy_encoded),
+                                            encode_job, target, original.dst,
+                                            original.target, after=[after])
+                        task.add_done_callback(functools.partial(
+                            report, message='Encoded: {} (duplicate)\n',
+                            total='deduplicated'))
+                        dst = target.src_to_dest(encode_job.filename)
+                        albums[target][0].append(task)
+                        albums[target] = (albums[target][0], dst)
+                        sources[target].append((dst, encode_job))
+                    if not fresh:
+                        continue
+
+                    decoder = encode_job.decoder()
+                    task = graph.submit(
+                        self.start_encode, encode_job, fresh,
+                        priority=(encode_job.duration() or 0) * len(fresh))
+                    task.add_done_callback(functools.partial(
+                        report, message='Encoded: {} (' + decoder + ')\n',
+                        total=decoder))
+                    for target in fresh:
+                        dst = target.src_to_dest(encode_job.filename)
+                        albums[target][0].append(task)
+                        albums[target] = (albums[target][0], dst)
+                        sources[target].append((dst, encode_job))
+                        key = self.audio_key(encode_job, target)
+                        if key is not None and key not in encoded:
+                            encoded[key] = _Encoded(
+                                target, dst, target.src_to_dest(s_folder),
+                                task, None)
+                            registered.append(key)
 
+                for move_job, target, move in move_jobs:
+                    task = graph.submit(one(self.move), move_job, target, move)
+                    task.add_done_callback(functools.partial(
+                        report, message='Moved: {}\n', total='moved'))
+                    dst = target.src_to_dest(move_job.filename)
+                    albums[target][0].append(task)
+                    albums[target] = (albums[target][0], dst)
+                    sources[target].append((dst, move_job))
+
+                # A renamed folder only needs the tags that changed
+                for target, (origin, moves) in folder_moves.items():
+                    task = graph.submit(self.move_album,
+                                        target.src_to_dest(s_folder), target,
+                                        origin, moves)
+                    task.add_done_callback(functools.partial(
+                        report, message='Moved: {}\n', total='moved'))
+                    albums[target][0].append(task)
+                    sources[target].extend(
+                        (target.src_to_dest(file_.filename), file_)
+                        for file_, move in moves
+                        if not move.exact
+                        and isinstance(file_, abstract.Lossless))
+
+                for retag_job, target in retag_jobs:
+                    task = graph.submit(one(self.retag), retag_job, target)
+                    task.add_done_callback(functools.partial(
+                        report, message='Tags Updated: {}\n',
+                        total='retagged'))
+                    albums[target][0].append(task)
+                    sources[target].append(
+                        (target.src_to_dest(retag_job.filename), retag_job))
+
+                # Once every track is finished, the album's tags and
+                # ReplayGain are written, then it is moved into place.
+                # ReplayGain needs every track of the album. Only when it
+                # cannot be computed from stored loudness is the committed
+                # album analysed again.
+                touched = set(target for changes_ in wanted.values()
+                              for target, __ in changes_)
+                finished = {}
+                for target, (tracks, lossy_file) in albums.items():
+                    if target not in touched:
+                        continue
+                    d_folder = target.src_to_dest(s_folder)
+                    finalize = graph.submit(self.finalize_album, d_folder,
+                                            target, sources[target],
+                                            bool(lossy_file), after=tracks)
+                    commit = finished[target] = graph.submit(
+                        self.commit_album, d_folder, target, after=[finalize])
+                    if lossy_file:
+                        finished[target] = graph.submit(
+                            finish, finalize, lossy_file, target,
+                            after=[commit])
+                # Later albums only need the finished album, and the encode
+                # results are not kept for the rest of the run
+                for key in registered:
+                    encoded[key] = encoded[key]._replace(
+                        task=None, album=finished[encoded[key].target])
+
+                for target in self.targets:
+                    if target.manifest is not None:
+                        target.manifest.commit()
+
+            # Wait for all jobs to finish
+            graph.wait()
+            for target in self.targets:
+                if target.manifest is not None:
+                    target.manifest.commit()
+                target.clean_staging()
+            if self._stopping.is_set():
+                raise Stopped()
+
+            # Delete files that have been deleted from the source folder,
+            # unless they were moved
+            for action in deletions:
+                if action.dest in moved:
+                    continue
+                if action.kind == sync.DELETE_DIR:
+                    result = self.delete_subs(action.dest)
+                    with self.printlock:
+                        print('Deleted: "{}"/\n'.format(result))
+                else:
+                    result = self.delete_files(action.dest)
+                    with self.printlock:
+                        print('Deleted: "{}"\n'.format(result))
+            # Every file that vanished from the source folder has been seen
+            # by now, and moved or deleted
+            if self.delete and roots is None:
+                for target in self.targets:
+                    if target.manifest is not None:
+                        target.manifest.forget_vanished()
+                        target.manifest.commit()
+
+        except Exception as e:
+            if not self._stopping.is_set():
+                # A job failed: the others are not worth finishing, their
+                # codec processes are killed
+                graph.cancel()
+                self.engine.cancel()
+            # Let the jobs that already started finish before giving up, so
+            # none of them is still writing when the caller moves on
+            try:
+                graph.wait()
+            except Exception:
+                pass
+            if self._stopping.is_set() and not isinstance(e, Stopped):
+                raise Stopped() from e
+            raise
+        finally:
+            self._graph = None
+        return totals
+
+    def stop(self, cancel=False):
+        '''
+        Makes process() stop as soon as the jobs that are running have
+        finished. Jobs that have not started are cancelled and their
+        albums are left in the staging folder for the next run. Safe to
+        call from a signal handler or another thread.
+
+        :Args:
+            * cancel(bool): (optional) also kill the decoders and encoders
+                that are running, so process() stops at once. Their files
+                are encoded again by the next run.
+        '''
+        self._stopping.set()
+        fns = []
+        if self._graph is not None:
+            fns.append(self._graph.cancel)
+        if self.remote is not None:
+            fns.append(self.remote.cancel)
+        if cancel:
+            fns.append(self.engine.cancel)
+        # Not in this thread: it may be holding the graph's lock
+        for fn in fns:
+            threading.Thread(target=fn).start()
+
+    def close(self):
+        '''
+        Waits for running jobs and closes the engine, the manifests and the
+        coordinator.
+        '''
+        self.executor.shutdown(wait=True)
+        self.engine.close()
+        if self.remote is not None:
+            self.remote.close()
+        for target in self.targets:
+            if target.manifest is not None:
+                target.manifest.close()
+
+    def print_summary(self, totals):
+        '''
+        Prints the totals returned by :meth:`process`.
+        '''
+        print('** All operations completed successfully **')
+        decoders = sorted((name, count) for name, count in totals.items()
+                          if name not in ('retagged', 'copied', 'resumed',
+                                          'deduplicated', 'moved'))
+        print('\n\tFiles Encoded: {}'.format(
+            sum(count for __, count in decoders)))
+        for name, count in decoders:
+            print('\t    decoded by {}: {}'.format(name, count))
+        if self.encode_cache is not None:
+            print('\t    copied from the encode cache: {}'.format(
+                self.encode_cache.hits))
+        print('\tIdentical Audio Copied: {}'.format(totals['deduplicated']))
+        if totals['deduplicated']:
+            print('\t    encoding time saved: {}'.format(
+                plan.format_duration(self.dedup_seconds)))
+        print('\tFiles Moved: {}'.format(totals['moved']))
+        print('\tTags Updated: {}'.format(totals['retagged']))
+        print('\tFiles Copied: {}'.format(totals['copied']))
+        print('\t    already identical: {}'.format(self.copies_skipped))
+        print('\tResumed: {}\n'.format(totals['resumed']))
+
+    def run(self):
+        '''
+        Runs the program
+        '''
+        try:
+            totals = self.process()
+        except Stopped as e:
+            print('** Stopped **')
+            print(e)
+            sys.exit(1)
         except Exception as e:
             print('** Encountered an Error **')
             print(e)
             sys.exit(1)
+        finally:
+            self.close()
 
-        print('** All operations completed successfully **')
-        print('\n\tFiles Encoded: {}'.format(total_files_encoded))
-        print('\tFiles Copied: {}\n'.format(total_files_copied))
-
+        self.print_summary(totals)
         sys.exit(0)
 
 
+def run_plan(targets, delete, limits, output='text',
+             lookahead=scheduler.DEFAULT_LOOKAHEAD):
+    '''
+    Prints the plan for a run and exits.
+
+    :Args:
+        * targets(list(sync.Sync)): the destinations
+        * delete(bool): count files that would be deleted
+        * limits(concurrency.Limits): the budgets the run would use
+        * output(str): ``text`` or ``json``
+        * lookahead(int): (optional) as passed to Worker
+    '''
+    try:
+        work = plan.Plan(targets, delete, limits,
+                         lookahead=lookahead).build()
+        print(work.to_json() if output == 'json' else work.report())
+        shortfalls = work.shortfalls()
+    except Exception as e:
+        print('** Encountered an Error **')
+        print(e)
+        sys.exit(1)
+    finally:
+        for target in targets:
+            if target.manifest is not None:
+                target.manifest.close()
+
+    for entry in shortfalls:
+        sys.stderr.write('Not enough space on "{}": {} needed, {} free\n'
+                         .format(entry['destdir'],
+                                 plan.format_size(entry['required']),
+                                 plan.format_size(entry['free'])))
+    sys.exit(1 if shortfalls else 0)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Encodes lossless files to lossy files.'
@@ -214,6 +1446,223 @@ def main():
                         help=('deletes all files in the encoded folder that'
                               ' no longer exist in the source folder')
                         )
+    parser.add_argument('--rescan',
+                        action='store_true',
+                        default=False,
+                        help=('ignore the sync manifest kept in the encoded'
+                              ' folder and compare every file again')
+                        )
+    parser.add_argument('--no-manifest',
+                        dest='manifest',
+                        action='store_false',
+                        default=True,
+                        help=('do not read or write a sync manifest in the'
+                              ' encoded folder')
+                        )
+    parser.add_argument('--link-mode',
+                        choices=fileops.LINK_MODES,
+                        default=fileops.COPY,
+                        help=('how album art and lossy files are put into the'
+                              ' encoded folder. reflink falls back to'
+                              ' hardlink, then symlink, then copy. Lossy'
+                              ' files are only reflinked or copied.'
+                              ' (default: copy)')
+                        )
+    parser.add_argument('--profile',
+                        action='append',
+                        default=[],
+                        metavar='FORMAT:OPTIONS:DEST',
+                        help=('also keep DEST in sync, encoded to FORMAT with'
+                              ' the encoder OPTIONS (e.g.'
+                              ' "mp3:-V2:/media/phone"). Each lossless file'
+                              ' is decoded once for every destination. May'
+                              ' be repeated.')
+                        )
+    parser.add_argument('--jobs', '-j',
+                        type=int,
+                        default=None,
+                        help=('the number of decoder and encoder processes'
+                              ' that may run at once (default: the number of'
+                              ' CPUs available, honouring affinity and cgroup'
+                              ' limits)')
+                        )
+    parser.add_argument('--io-jobs',
+                        type=int,
+                        default=None,
+                        help=('the number of files that may be copied or'
+                              ' tagged at once (default: {})'.format(
+                                  concurrency.DEFAULT_IO_JOBS))
+                        )
+    parser.add_argument('--scan-jobs',
+                        type=int,
+                        default=walk.DEFAULT_JOBS,
+                        metavar='N',
+                        help=('the number of source folders listed and'
+                              ' stat\'d at once; raise it for network'
+                              ' filesystems (default: {})'.format(
+                                  walk.DEFAULT_JOBS))
+                        )
+    parser.add_argument('--lookahead',
+                        type=int,
+                        default=scheduler.DEFAULT_LOOKAHEAD,
+                        metavar='JOBS',
+                        help=('the number of queued jobs the longest encode'
+                              ' is chosen from, so long tracks start first'
+                              ' (default: {})'.format(
+                                  scheduler.DEFAULT_LOOKAHEAD))
+                        )
+    parser.add_argument('--background',
+                        action='store_true',
+                        default=False,
+                        help=('run at low CPU and disk priority and use half'
+                              ' of the available CPUs, for sharing a busy'
+                              ' machine')
+                        )
+    parser.add_argument('--plan',
+                        nargs='?',
+                        const='text',
+                        choices=['text', 'json'],
+                        default=None,
+                        help=('report what would be done, how long it should'
+                              ' take and whether it fits, as text or JSON,'
+                              ' without changing any files. Exits with an'
+                              ' error if a destination is short of space.')
+                        )
+    parser.add_argument('--metrics-json',
+                        default=None,
+                        metavar='FILE',
+                        help=('write the time, CPU time, bytes and audio'
+                              ' seconds of every stage of the run to FILE'
+                              ' as JSON')
+                        )
+    parser.add_argument('--metrics-textfile',
+                        default=None,
+                        metavar='FILE',
+                        help=('write the same numbers to FILE for the'
+                              ' Prometheus node exporter textfile collector')
+                        )
+    parser.add_argument('--watch',
+                        action='store_true',
+                        default=False,
+                        help=('keep running and sync the folders that change'
+                              ' in the source folder as they change')
+                        )
+    parser.add_argument('--quiet-seconds',
+                        type=float,
+                        default=watch.DEFAULT_QUIET,
+                        metavar='SECONDS',
+                        help=('with --watch, wait until nothing has changed'
+                              ' for SECONDS before syncing (default:'
+                              ' {:g})'.format(watch.DEFAULT_QUIET))
+                        )
+    parser.add_argument('--reconcile-interval',
+                        type=float,
+                        default=watch.DEFAULT_RECONCILE,
+                        metavar='SECONDS',
+                        help=('with --watch, compare the whole source folder'
+                              ' every SECONDS in case a change was missed'
+                              ' (default: {:g})'.format(
+                                  watch.DEFAULT_RECONCILE))
+                        )
+    parser.add_argument('--poll',
+                        action='store_true',
+                        default=False,
+                        help=('with --watch, scan the source folder for'
+                              ' changes instead of using inotify, e.g. on'
+                              ' network filesystems. Also used when inotify'
+                              ' is not available.')
+                        )
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=watch.DEFAULT_POLL_INTERVAL,
+                        metavar='SECONDS',
+                        help=('seconds between scans when polling (default:'
+                              ' {:g})'.format(watch.DEFAULT_POLL_INTERVAL))
+                        )
+    parser.add_argument('--time-limit',
+                        type=float,
+                        default=None,
+                        metavar='SECONDS',
+                        help=('stop after SECONDS, killing the encodes in'
+                              ' progress; finished albums are kept and the'
+                              ' next run resumes the rest')
+                        )
+    parser.add_argument('--art-size',
+                        type=int,
+                        default=None,
+                        metavar='PIXELS',
+                        help=('downscale album art larger than PIXELS wide or'
+                              ' high, for copies, embedded covers and folder'
+                              ' images. Needs Pillow.')
+                        )
+    parser.add_argument('--embed-art',
+                        action='store_true',
+                        default=False,
+                        help=('embed the cover of each track, from its flac'
+                              ' file or its folder, in the encoded file')
+                        )
+    parser.add_argument('--art-folder',
+                        action='store_true',
+                        default=False,
+                        help=('write the cover as {} into encoded albums whose'
+                              ' source folder has none, e.g. when the art is'
+                              ' only embedded in the flac files'.format(
+                                  artwork_module.FOLDER_NAME))
+                        )
+    parser.add_argument('--art-cache',
+                        default=artwork_module.DEFAULT_CACHE,
+                        metavar='DIR',
+                        help=('where downscaled album art is kept between'
+                              ' runs (default: {})'.format(
+                                  artwork_module.DEFAULT_CACHE))
+                        )
+    parser.add_argument('--encode-cache',
+                        nargs='?',
+                        const=encode_cache.DEFAULT_CACHE,
+                        default=None,
+                        metavar='DIR',
+                        help=('keep a copy of every encoded file in DIR and'
+                              ' copy files from it instead of encoding the'
+                              ' same audio with the same settings again, e.g.'
+                              ' when filling a new device (default DIR: {})'
+                              .format(encode_cache.DEFAULT_CACHE))
+                        )
+    parser.add_argument('--encode-cache-size',
+                        type=float,
+                        default=encode_cache.DEFAULT_SIZE / 1000.0 ** 3,
+                        metavar='GB',
+                        help=('with --encode-cache, remove the least recently'
+                              ' used files once the cache is larger than this'
+                              ' (default: {:g})'.format(
+                                  encode_cache.DEFAULT_SIZE / 1000.0 ** 3))
+                        )
+    parser.add_argument('--coordinator',
+                        default=None,
+                        metavar='[HOST:]PORT',
+                        help=('listen on PORT for lossless2lossy-agent'
+                              ' programs and let them do the encoding. Every'
+                              ' machine must see the source and encoded'
+                              ' folders at the same paths. HOST defaults to'
+                              ' {}; use 0.0.0.0 for agents on other'
+                              ' machines.'.format(distributed.DEFAULT_HOST))
+                        )
+    parser.add_argument('--secret-file',
+                        default=None,
+                        metavar='FILE',
+                        help=('with --coordinator, read the secret agents'
+                              ' must know from FILE (default: the {}'
+                              ' environment variable)'.format(
+                                  distributed.SECRET_VARIABLE))
+                        )
+    parser.add_argument('--coordinator-jobs',
+                        type=int,
+                        default=distributed.DEFAULT_SLOTS,
+                        metavar='N',
+                        help=('with --coordinator, the number of files handed'
+                              ' to agents at once; at least the total --jobs'
+                              ' of the agents (default: {})'.format(
+                                  distributed.DEFAULT_SLOTS))
+                        )
     parser.add_argument('lossyFormat',
                         choices=['mp3'],
                         default='mp3',
@@ -228,17 +1677,146 @@ def main():
                              'will go')
 
     args = parser.parse_args()
+    for option, value in (('--jobs', args.jobs), ('--io-jobs', args.io_jobs),
+                          ('--coordinator-jobs', args.coordinator_jobs),
+                          ('--lookahead', args.lookahead),
+                          ('--scan-jobs', args.scan_jobs),
+                          ('--art-size', args.art_size)):
+        if value is not None and value < 1:
+            parser.error('{} must be at least 1'.format(option))
+    for option, value in (('--quiet-seconds', args.quiet_seconds),
+                          ('--encode-cache-size', args.encode_cache_size),
+                          ('--reconcile-interval', args.reconcile_interval),
+                          ('--poll-interval', args.poll_interval),
+                          ('--time-limit', args.time_limit)):
+        if value is not None and value <= 0:
+            parser.error('{} must be more than 0'.format(option))
 
     lossy_map = {'mp3': mp3.Mp3}
     lossy_class = lossy_map[args.lossyFormat]
 
+    targets = []
     try:
         compare = sync.Sync(args.source[0], args.encoded[0], lossy_class)
+        for profile in args.profile:
+            try:
+                format_, options, destdir = profile.split(':', 2)
+                profile_class = lossy_map[format_]
+            except (ValueError, KeyError):
+                raise Exception(
+                    'invalid profile "{}", expected FORMAT:OPTIONS:DEST with'
+                    ' FORMAT one of: {}'.format(profile,
+                                                ', '.join(sorted(lossy_map)))
+                )
+            if options.split():
+                profile_class = profile_class.with_options(options.split())
+            targets.append(sync.Sync(args.source[0], destdir, profile_class))
     except Exception as e:
         parser.error(e)
 
-    worker = Worker(compare, args.delete)
-    worker.run()
+    for target in [compare] + targets:
+        target.scan_jobs = args.scan_jobs
+        if args.manifest:
+            target.manifest = manifest.Manifest.in_directory(target.destdir)
+            if args.rescan:
+                target.manifest.clear()
+
+    limits = concurrency.Limits(args.jobs, args.io_jobs, args.background)
+    if args.plan:
+        run_plan([compare] + targets, args.delete, limits, args.plan,
+                 args.lookahead)
+
+    artwork = None
+    if args.art_size or args.embed_art or args.art_folder:
+        try:
+            artwork = artwork_module.Artwork(args.art_size, args.embed_art,
+                                             args.art_folder, args.art_cache)
+        except Exception as e:
+            parser.error(e)
+
+    remote = None
+    if args.coordinator:
+        try:
+            secret = distributed.read_secret(args.secret_file)
+        except OSError as e:
+            parser.error('cannot read the secret: {}'.format(e))
+        if secret is None:
+            parser.error('--coordinator needs a shared secret, set it with'
+                         ' --secret-file or {}'.format(
+                             distributed.SECRET_VARIABLE))
+        try:
+            host, port = distributed.parse_address(args.coordinator,
+                                                   distributed.DEFAULT_HOST)
+            remote = distributed.Coordinator(host, port,
+                                             args.coordinator_jobs,
+                                             secret=secret)
+        except (ValueError, OSError) as e:
+            parser.error('cannot listen on "{}": {}'.format(
+                args.coordinator, e))
+        print('** Waiting for agents on {}:{} **'.format(*remote.address))
+
+    cache = None
+    if args.encode_cache:
+        cache = encode_cache.EncodeCache(
+            args.encode_cache, int(args.encode_cache_size * 1000 ** 3))
+
+    worker = Worker(compare, args.delete, targets, limits, args.link_mode,
+                    remote, artwork, cache, args.lookahead)
+
+    def write_metrics():
+        if args.metrics_json:
+            worker.metrics.write_json(args.metrics_json)
+        if args.metrics_textfile:
+            worker.metrics.write_textfile(args.metrics_textfile)
+
+    runner = None
+    signals = []
+
+    def stop(signum, frame):
+        # Finish what is running, keep what is finished. A second signal
+        # kills the encodes in progress, a third one the program.
+        signals.append(signum)
+        if len(signals) == 1:
+            sys.stderr.write(
+                '** Stopping, finishing the files in progress **\n')
+            worker.stop()
+        else:
+            signal.signal(signum, signal.SIG_DFL)
+            sys.stderr.write('** Stopping now **\n')
+            worker.stop(cancel=True)
+        if runner is not None:
+            runner.stop()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    if args.time_limit:
+        def out_of_time():
+            sys.stderr.write('** Out of time, stopping now **\n')
+            worker.stop(cancel=True)
+            if runner is not None:
+                runner.stop()
+
+        timer = threading.Timer(args.time_limit, out_of_time)
+        timer.daemon = True
+        timer.start()
+
+    if args.watch:
+        # Watch before the first sync, so nothing changed during it is missed
+        watcher = watch.watcher(compare.srcdir, args.poll, args.poll_interval)
+        runner = watch.Watch(worker, watcher, quiet=args.quiet_seconds,
+                             reconcile=args.reconcile_interval,
+                             after=write_metrics)
+        try:
+            runner.run()
+        finally:
+            worker.close()
+        return
+
+    try:
+        worker.run()
+    finally:
+        write_metrics()
 
 if __name__ == '__main__':
     main()
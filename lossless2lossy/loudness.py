@@ -0,0 +1,367 @@
+'''
+Module for measuring loudness according to ITU-R BS.1770 / EBU R128 and
+deriving ReplayGain 2 values.
+
+A :class:`Meter` is fed the WAV stream produced by
+:meth:`abstract.Lossless.decode` while it is being encoded, so no extra
+decode is needed. The result of each track is a :class:`Loudness` object
+holding a histogram of gating block loudness. Histograms of several tracks
+can be merged to get the album loudness without looking at the audio again,
+so adding a track to an album only costs the analysis of that track.
+
+Requires numpy.
+'''
+import functools
+import json
+import math
+import struct
+
+import numpy
+
+# ReplayGain 2 reference level in LUFS
+REFERENCE = -18.0
+
+_ABSOLUTE_GATE = -70.0
+_RELATIVE_GATE = -10.0
+_BINS_PER_LU = 10
+_IMPULSE_LENGTH = 4096
+_BLOCK_FRAMES = 32768
+
+# BS.1770 channel weights for L, R, C, LFE, Ls, Rs
+_SURROUND_WEIGHTS = (1.0, 1.0, 1.0, 0.0, 1.41, 1.41)
+
+
+def _k_weighting(rate):
+    '''
+    Returns the coefficients of the two biquad filters that make up the
+    K-weighting curve at ``rate``.
+    '''
+    # High shelf modelling the acoustic effect of the head
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = math.pow(10.0, gain / 20.0)
+    vb = math.pow(vh, 0.4996667741545416)
+    a0 = 1.0 + k / q + k * k
+    shelf = ((vh + vb * k / q + k * k) / a0,
+             2.0 * (k * k - vh) / a0,
+             (vh - vb * k / q + k * k) / a0), \
+            (1.0,
+             2.0 * (k * k - 1.0) / a0,
+             (1.0 - k / q + k * k) / a0)
+
+    # RLB high pass
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1.0 + k / q + k * k
+    high_pass = (1.0, -2.0, 1.0), \
+                (1.0,
+                 2.0 * (k * k - 1.0) / a0,
+                 (1.0 - k / q + k * k) / a0)
+    return (shelf, high_pass)
+
+
+@functools.lru_cache()
+def _impulse_response(rate):
+    '''
+    Returns the K-weighting filter's impulse response at ``rate``, truncated
+    to ``_IMPULSE_LENGTH`` samples, by which point it has decayed well below
+    the resolution of 24 bit audio.
+    '''
+    signal = [0.0] * _IMPULSE_LENGTH
+    signal[0] = 1.0
+    for (b0, b1, b2), (__, a1, a2) in _k_weighting(rate):
+        x1 = x2 = y1 = y2 = 0.0
+        filtered = []
+        for x in signal:
+            y = b0 * x + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+            x2, x1 = x1, x
+            y2, y1 = y1, y
+            filtered.append(y)
+        signal = filtered
+    response = numpy.array(signal)
+    response.flags.writeable = False
+    return response
+
+
+def _energy_to_lufs(energy):
+    return -0.691 + 10.0 * math.log10(energy)
+
+
+class Loudness:
+    '''
+    The loudness of a track or album.
+
+    Arguments:
+        * histogram (dict(int: (int, float))): maps a loudness bin to the
+            number of gating blocks in it and the sum of their energies.
+            Bins are 0.1 LU wide, starting at the absolute gate of -70 LUFS.
+        * peak (float): the sample peak relative to full scale
+    '''
+
+    def __init__(self, histogram, peak):
+        self.histogram = histogram
+        self.peak = peak
+
+    @classmethod
+    def album(cls, tracks):
+        '''
+        Merges the loudness of several tracks.
+
+        :Args:
+            * tracks(iter(Loudness)): the tracks of an album
+        :Returns:
+            * Loudness: the loudness of the album
+        '''
+        histogram = {}
+        peak = 0.0
+        for track in tracks:
+            peak = max(peak, track.peak)
+            for index, (count, energy) in track.histogram.items():
+                total = histogram.get(index, (0, 0.0))
+                histogram[index] = (total[0] + count, total[1] + energy)
+        return cls(histogram, peak)
+
+    @property
+    def integrated(self):
+        '''
+        The gated integrated loudness in LUFS, or None if the audio is
+        silent or shorter than one gating block.
+        '''
+        histogram = self.histogram
+        count = sum(count for count, __ in histogram.values())
+        if not count:
+            return None
+        energy = sum(energy for __, energy in histogram.values())
+        gate = _energy_to_lufs(energy / count) + _RELATIVE_GATE
+        first = math.floor((gate - _ABSOLUTE_GATE) * _BINS_PER_LU)
+
+        gated = [value for index, value in histogram.items()
+                 if index >= first]
+        count = sum(count for count, __ in gated)
+        energy = sum(energy for __, energy in gated)
+        return _energy_to_lufs(energy / count)
+
+    @property
+    def gain(self):
+        'The ReplayGain 2 gain in dB.'
+        integrated = self.integrated
+        if integrated is None:
+            return 0.0
+        return REFERENCE - integrated
+
+    def to_json(self):
+        return json.dumps({
+            'peak': self.peak,
+            'histogram': [[index, count, energy] for index, (count, energy)
+                          in sorted(self.histogram.items())],
+        })
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        histogram = dict((index, (count, energy))
+                         for index, count, energy in data['histogram'])
+        return cls(histogram, data['peak'])
+
+
+class Meter:
+    '''
+    Measures the loudness of a WAV stream fed to it in chunks of any size.
+
+    Streams that are not PCM WAV are ignored and :meth:`result` returns None.
+    '''
+
+    def __init__(self):
+        self._buffer = b''
+        self._header_done = False
+        self._failed = False
+        self._channels = None
+        self._rate = None
+        self._sample_width = None
+        self._weights = None
+        self._frames = []
+        self._buffered_frames = 0
+        self._tail = None
+        self._responses = {}
+        self._block_size = None
+        self._block_energy = 0.0
+        self._block_count = 0
+        self._blocks = []
+        self._peak = 0.0
+
+    def feed(self, data):
+        '''
+        Analyses the next chunk of the stream.
+
+        :Args:
+            * data(bytes): the next chunk of the WAV stream
+        '''
+        if self._failed:
+            return
+        self._buffer += data
+        if not self._header_done:
+            try:
+                if not self._read_header():
+                    return
+            except ValueError:
+                self._failed = True
+                self._buffer = b''
+                return
+
+        frame_size = self._channels * self._sample_width
+        usable = len(self._buffer) - len(self._buffer) % frame_size
+        if not usable:
+            return
+        samples = self._to_float(self._buffer[:usable])
+        self._buffer = self._buffer[usable:]
+        self._frames.append(samples.reshape(-1, self._channels))
+        self._buffered_frames += len(self._frames[-1])
+        if self._buffered_frames >= _BLOCK_FRAMES:
+            self._process()
+
+    def _read_header(self):
+        '''
+        Parses the RIFF header. Returns False if more data is needed.
+
+        :Raises:
+            * ValueError: the stream is not PCM WAV
+        '''
+        buffer = self._buffer
+        if len(buffer) < 12:
+            return False
+        if buffer[:4] != b'RIFF' or buffer[8:12] != b'WAVE':
+            raise ValueError('not a WAV stream')
+        offset = 12
+        while True:
+            if len(buffer) < offset + 8:
+                return False
+            chunk_id = buffer[offset:offset + 4]
+            size = struct.unpack('<I', buffer[offset + 4:offset + 8])[0]
+            offset += 8
+            if chunk_id == b'data':
+                break
+            if len(buffer) < offset + size:
+                return False
+            if chunk_id == b'fmt ':
+                (format_, channels, rate, __, __,
+                 bits) = struct.unpack('<HHIIHH', buffer[offset:offset + 16])
+                if format_ == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE
+                    format_ = struct.unpack(
+                        '<H', buffer[offset + 24:offset + 26])[0]
+                if format_ != 1 or bits not in (16, 24, 32):
+                    raise ValueError('unsupported WAV format')
+                self._channels = channels
+                self._rate = rate
+                self._sample_width = bits // 8
+            offset += size + size % 2
+
+        if self._channels is None:
+            raise ValueError('WAV stream has no fmt chunk')
+        if self._channels == len(_SURROUND_WEIGHTS):
+            self._weights = numpy.array(_SURROUND_WEIGHTS)
+        else:
+            self._weights = numpy.ones(self._channels)
+        self._block_size = int(round(self._rate / 10.0))
+        self._tail = numpy.zeros((_IMPULSE_LENGTH - 1, self._channels))
+        self._buffer = buffer[offset:]
+        self._header_done = True
+        return True
+
+    def _to_float(self, data):
+        'Converts little endian PCM samples to floats in [-1, 1).'
+        width = self._sample_width
+        if width == 3:
+            raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+            samples = (raw[:, 0].astype(numpy.int32)
+                       | (raw[:, 1].astype(numpy.int32) << 8)
+                       | (raw[:, 2].astype(numpy.int32) << 16))
+            samples = numpy.where(samples >= 1 << 23,
+                                  samples - (1 << 24), samples)
+        else:
+            samples = numpy.frombuffer(data, dtype='<i{}'.format(width))
+        return samples / float(1 << (8 * width - 1))
+
+    def _response(self, size):
+        'Returns the FFT of the impulse response for an FFT of ``size``.'
+        if size not in self._responses:
+            self._responses[size] = numpy.fft.rfft(
+                _impulse_response(self._rate), size)
+        return self._responses[size]
+
+    def _process(self):
+        '''
+        K-weights the buffered frames with an overlap-add FFT convolution and
+        sums their energy into 100 ms blocks.
+        '''
+        if not self._frames:
+            return
+        frames = numpy.concatenate(self._frames)
+        self._frames = []
+        self._buffered_frames = 0
+        self._peak = max(self._peak, float(numpy.abs(frames).max()))
+
+        count = len(frames)
+        overlap = _IMPULSE_LENGTH - 1
+        size = 1 << (count + overlap - 1).bit_length()
+        spectrum = numpy.fft.rfft(frames, size, axis=0)
+        filtered = numpy.fft.irfft(
+            spectrum * self._response(size)[:, None], size, axis=0
+        )[:count + overlap]
+        filtered[:overlap] += self._tail
+        self._tail = filtered[count:].copy()
+        filtered = filtered[:count]
+
+        energy = (filtered ** 2 * self._weights).sum(axis=1)
+
+        block_size = self._block_size
+        needed = block_size - self._block_count
+        if len(energy) < needed:
+            self._block_energy += energy.sum()
+            self._block_count += len(energy)
+            return
+        self._blocks.append((self._block_energy + energy[:needed].sum())
+                            / block_size)
+        energy = energy[needed:]
+        full = len(energy) // block_size
+        if full:
+            self._blocks.extend(
+                energy[:full * block_size].reshape(full, block_size)
+                .sum(axis=1) / block_size
+            )
+        energy = energy[full * block_size:]
+        self._block_energy = energy.sum()
+        self._block_count = len(energy)
+
+    def result(self):
+        '''
+        Finishes the analysis.
+
+        :Returns:
+            * None: the stream could not be analysed
+            * Loudness: the loudness of the stream
+        '''
+        if self._failed or not self._header_done:
+            return None
+        self._process()
+
+        # 400 ms gating blocks overlapping by 75%
+        blocks = numpy.array(self._blocks)
+        histogram = {}
+        if len(blocks) >= 4:
+            energies = numpy.convolve(blocks, numpy.ones(4) / 4.0, 'valid')
+            energies = energies[energies > 0]
+            loudness = -0.691 + 10.0 * numpy.log10(energies)
+            keep = loudness >= _ABSOLUTE_GATE
+            indexes = numpy.floor(
+                (loudness[keep] - _ABSOLUTE_GATE) * _BINS_PER_LU
+            ).astype(int)
+            energies = energies[keep]
+            bins, inverse = numpy.unique(indexes, return_inverse=True)
+            counts = numpy.bincount(inverse)
+            sums = numpy.bincount(inverse, weights=energies)
+            for index, count, energy in zip(bins, counts, sums):
+                histogram[int(index)] = (int(count), float(energy))
+        return Loudness(histogram, self._peak)
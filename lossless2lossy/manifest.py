@@ -0,0 +1,446 @@
+'''
+Module for keeping a persistent record of what has already been synced.
+
+The manifest is a small SQLite database kept in the root of the destination
+folder. It remembers the size, mtime and inode of every source file that has
+been encoded or copied, along with the encoder settings that were used and a
+checksum of its audio, and the listing of every directory seen during the
+last scan. This allows :class:`sync.Sync` to decide that a file is up to date
+without looking at the destination folder, and to skip listing directories
+whose mtime has not changed.
+
+It also keeps the measured speed of each decoder and encoder combination,
+which is used to estimate how long a run will take.
+
+Files that disappear from a directory's listing are kept for a while, so
+that a file that was moved or renamed in the source folder can be matched
+with the file it was synced to, which is then moved instead of encoded or
+copied again.
+
+Finished files waiting in the staging folder for the rest of their album
+are kept in a journal. An interrupted run leaves them there, and the next
+run uses them instead of encoding or copying the same files again.
+'''
+import os
+import sqlite3
+import threading
+
+
+class Manifest:
+    '''
+    A persistent record of synced files and directory listings.
+
+    Arguments:
+        * path (str): path to the database file. It is created if it does
+            not exist.
+    '''
+    NAME = '.lossless2lossy.db'
+
+    _SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS files (
+               src TEXT PRIMARY KEY,
+               dir TEXT NOT NULL,
+               size INTEGER,
+               mtime INTEGER,
+               inode INTEGER,
+               dest TEXT,
+               settings TEXT,
+               audio TEXT)''',
+        'CREATE INDEX IF NOT EXISTS files_dir ON files (dir)',
+        'CREATE INDEX IF NOT EXISTS files_inode ON files (inode)',
+        'CREATE INDEX IF NOT EXISTS files_audio ON files (audio)',
+        '''CREATE TABLE IF NOT EXISTS vanished (
+               src TEXT PRIMARY KEY,
+               dir TEXT NOT NULL,
+               size INTEGER,
+               mtime INTEGER,
+               inode INTEGER,
+               dest TEXT,
+               settings TEXT,
+               audio TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS dirs (
+               path TEXT PRIMARY KEY,
+               mtime INTEGER NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS listing (
+               dir TEXT NOT NULL,
+               name TEXT NOT NULL,
+               is_dir INTEGER NOT NULL,
+               PRIMARY KEY (dir, name))''',
+        '''CREATE TABLE IF NOT EXISTS loudness (
+               dest TEXT PRIMARY KEY,
+               stats TEXT NOT NULL,
+               applied INTEGER NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS staged (
+               dest TEXT PRIMARY KEY,
+               src TEXT NOT NULL,
+               size INTEGER,
+               mtime INTEGER,
+               inode INTEGER,
+               settings TEXT,
+               audio TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS throughput (
+               decoder TEXT NOT NULL,
+               settings TEXT NOT NULL,
+               audio REAL NOT NULL,
+               seconds REAL NOT NULL,
+               PRIMARY KEY (decoder, settings))''',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            for statement in self._SCHEMA:
+                self._db.execute(statement)
+            columns = [row[1] for row in
+                       self._db.execute('PRAGMA table_info(files)')]
+            if 'audio' not in columns:
+                self._db.execute('ALTER TABLE files ADD COLUMN audio TEXT')
+            self._db.commit()
+
+    @classmethod
+    def in_directory(cls, destdir):
+        '''
+        Opens the manifest stored in the root of ``destdir``.
+        '''
+        return cls(os.path.join(destdir, cls.NAME))
+
+    def listing(self, path, mtime):
+        '''
+        Returns the recorded listing of a directory if its mtime has not
+        changed since it was recorded.
+
+        :Args:
+            * path(str): absolute path to the directory
+            * mtime(int): the current mtime of the directory in nanoseconds
+        :Returns:
+            * None: the directory has not been seen or has changed
+            * tuple(list(str), list(str)): names of the subdirectories and
+                files in the directory
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT mtime FROM dirs WHERE path = ?',
+                                   (path,)).fetchone()
+            if row is None or row[0] != mtime:
+                return None
+            subs, files = [], []
+            for name, is_dir in self._db.execute(
+                    'SELECT name, is_dir FROM listing WHERE dir = ?', (path,)):
+                (subs if is_dir else files).append(name)
+        return (subs, files)
+
+    def set_listing(self, path, mtime, subs, files):
+        '''
+        Records the listing of a directory. Entries for files that are no
+        longer in the directory are forgotten, except by :meth:`moved_from`.
+
+        :Args:
+            * path(str): absolute path to the directory
+            * mtime(int): the mtime of the directory in nanoseconds
+            * subs(iter(str)): names of the subdirectories
+            * files(iter(str)): names of the files
+        '''
+        subs = list(subs)
+        files = list(files)
+        with self._lock:
+            db = self._db
+            db.execute('DELETE FROM listing WHERE dir = ?', (path,))
+            db.executemany('INSERT INTO listing VALUES (?, ?, 1)',
+                           ((path, name) for name in subs))
+            db.executemany('INSERT INTO listing VALUES (?, ?, 0)',
+                           ((path, name) for name in files))
+            current = set(os.path.join(path, name) for name in files)
+            stale = [src for (src,) in db.execute(
+                         'SELECT src FROM files WHERE dir = ?', (path,))
+                     if src not in current]
+            db.executemany('INSERT OR REPLACE INTO vanished SELECT * FROM'
+                           ' files WHERE src = ?', ((src,) for src in stale))
+            db.executemany('DELETE FROM files WHERE src = ?',
+                           ((src,) for src in stale))
+            db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                       (path, mtime))
+
+    def is_current(self, src, stat, settings):
+        '''
+        Tests whether ``src`` was synced with ``settings`` and has not
+        changed since.
+
+        :Args:
+            * src(str): absolute path to the source file
+            * stat(os.stat_result): the current stat of ``src``
+            * settings(str): the settings ``src`` would be synced with
+        :Returns:
+            * None: ``src`` is not in the manifest
+            * bool: True if size, mtime, inode and settings all match
+        '''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime, inode, settings FROM files WHERE src = ?',
+                (src,)).fetchone()
+        if row is None:
+            return None
+        return row == (stat.st_size, stat.st_mtime_ns, stat.st_ino, settings)
+
+    def audio(self, src, settings):
+        '''
+        Returns the audio checksum recorded for ``src``.
+
+        :Args:
+            * src(str): absolute path to the source file
+            * settings(str): the settings ``src`` would be synced with
+        :Returns:
+            * None: ``src`` is unknown, has no recorded checksum or was
+                synced with different settings
+            * str: the checksum
+        '''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT audio FROM files WHERE src = ? AND settings = ?',
+                (src, settings)).fetchone()
+        return row[0] if row else None
+
+    def record(self, src, stat, dest, settings, audio=None):
+        '''
+        Records that ``src`` has been synced to ``dest``.
+
+        :Args:
+            * src(str): absolute path to the source file
+            * stat(os.stat_result): the stat of ``src`` when it was synced
+            * dest(str): absolute path to the file in the destination folder
+            * settings(str): the settings ``src`` was synced with
+            * audio(str): (optional) a checksum of the decoded audio
+        '''
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (src, os.path.dirname(src), stat.st_size, stat.st_mtime_ns,
+                 stat.st_ino, dest, settings, audio))
+
+    def moved_from(self, stat, settings, audio=None):
+        '''
+        Returns the recorded files that a new source file could have been
+        moved or renamed from: files with the same inode, size and mtime,
+        then files with the same audio checksum. Only files synced with
+        ``settings`` are returned. Whether a file is still in the source
+        folder is left to the caller.
+
+        :Args:
+            * stat(os.stat_result): the stat of the new source file
+            * settings(str): the settings it would be synced with
+            * audio(str): (optional) a checksum of its audio
+        :Returns:
+            * list(tuple(str, str, bool)): the source and destination path
+                of each file, and whether it matched by inode, size and
+                mtime
+        '''
+        found = []
+        with self._lock:
+            for table in ('files', 'vanished'):
+                rows = self._db.execute(
+                    '''SELECT src, dest FROM {} WHERE inode = ? AND size = ?
+                           AND mtime = ? AND settings = ?'''.format(table),
+                    (stat.st_ino, stat.st_size, stat.st_mtime_ns, settings))
+                found.extend((src, dest, True) for src, dest in rows)
+            if audio is not None:
+                for table in ('files', 'vanished'):
+                    rows = self._db.execute(
+                        '''SELECT src, dest FROM {} WHERE audio = ?
+                               AND settings = ?'''.format(table),
+                        (audio, settings))
+                    found.extend((src, dest, False) for src, dest in rows)
+        return found
+
+    def forget(self, src):
+        '''
+        Forgets a source file, such as one that was moved.
+
+        :Args:
+            * src(str): absolute path to the source file
+        '''
+        with self._lock:
+            for table in ('files', 'vanished'):
+                self._db.execute('DELETE FROM {} WHERE src = ?'.format(table),
+                                 (src,))
+
+    def forget_vanished(self):
+        '''
+        Forgets the files that are no longer in the source folder, once
+        a whole run has had the chance to match them with moved files.
+        '''
+        with self._lock:
+            self._db.execute('DELETE FROM vanished')
+
+    def loudness(self, dest):
+        '''
+        Returns the loudness analysis recorded for an encoded file.
+
+        :Args:
+            * dest(str): absolute path to the file in the destination folder
+        :Returns:
+            * None: no analysis is recorded
+            * tuple(str, int): the serialized analysis and the gain already
+                applied to the file
+        '''
+        with self._lock:
+            return self._db.execute(
+                'SELECT stats, applied FROM loudness WHERE dest = ?',
+                (dest,)).fetchone()
+
+    def set_loudness(self, dest, stats, applied=0):
+        '''
+        Records the loudness analysis of an encoded file.
+
+        :Args:
+            * dest(str): absolute path to the file in the destination folder
+            * stats(str): the serialized analysis, or None to forget it
+            * applied(int): the gain already applied to the file
+        '''
+        with self._lock:
+            if stats is None:
+                self._db.execute('DELETE FROM loudness WHERE dest = ?',
+                                 (dest,))
+            else:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO loudness VALUES (?, ?, ?)',
+                    (dest, stats, applied))
+
+    def stage(self, src, stat, dest, settings, audio=None):
+        '''
+        Records in the journal that the file for ``dest`` is finished and
+        waiting in the staging folder.
+
+        :Args:
+            * src(str): absolute path to the source file
+            * stat(os.stat_result): the stat of ``src`` when it was synced
+            * dest(str): absolute path the file will have in the
+                destination folder
+            * settings(str): the settings ``src`` was synced with
+            * audio(str): (optional) a checksum of the decoded audio
+        '''
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO staged VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (dest, src, stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                 settings, audio))
+
+    def staged(self, src, stat, settings):
+        '''
+        Tests whether a finished file for ``src`` is waiting in the staging
+        folder, made from the current ``src`` with ``settings``.
+
+        :Args:
+            * src(str): absolute path to the source file
+            * stat(os.stat_result): the current stat of ``src``
+            * settings(str): the settings ``src`` would be synced with
+        :Returns:
+            * None: nothing usable is staged
+            * str: the path the staged file will have in the destination
+                folder
+        '''
+        with self._lock:
+            row = self._db.execute(
+                '''SELECT dest FROM staged WHERE src = ? AND size = ?
+                       AND mtime = ? AND inode = ? AND settings = ?''',
+                (src, stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                 settings)).fetchone()
+        return row[0] if row else None
+
+    def journal(self):
+        '''
+        Returns every entry of the journal.
+
+        :Returns:
+            * list(tuple(str, str)): the destination path and source path of
+                each staged file
+        '''
+        with self._lock:
+            return self._db.execute('SELECT dest, src FROM staged').fetchall()
+
+    def unstage(self, dest, record=True):
+        '''
+        Removes a file from the journal.
+
+        :Args:
+            * dest(str): absolute path to the file in the destination folder
+            * record(bool): (optional) record the file as synced, because it
+                has been moved into the destination folder
+        '''
+        with self._lock:
+            row = self._db.execute(
+                '''SELECT src, size, mtime, inode, settings, audio
+                   FROM staged WHERE dest = ?''', (dest,)).fetchone()
+            if row is None:
+                return
+            src, size, mtime, inode, settings, audio = row
+            if record:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?,'
+                    ' ?)', (src, os.path.dirname(src), size, mtime, inode,
+                            dest, settings, audio))
+            self._db.execute('DELETE FROM staged WHERE dest = ?', (dest,))
+
+    def add_throughput(self, decoder, settings, audio, seconds):
+        '''
+        Adds the timing of one encode to the measured throughput of a
+        decoder and encoder combination.
+
+        :Args:
+            * decoder(str): the decoder, see abstract.Lossless.decoder()
+            * settings(str): the encoder settings
+            * audio(float): the length of the encoded audio in seconds
+            * seconds(float): how long it took to encode
+        '''
+        with self._lock:
+            self._db.execute(
+                'INSERT OR IGNORE INTO throughput VALUES (?, ?, 0, 0)',
+                (decoder, settings))
+            self._db.execute(
+                '''UPDATE throughput SET audio = audio + ?,
+                       seconds = seconds + ?
+                   WHERE decoder = ? AND settings = ?''',
+                (audio, seconds, decoder, settings))
+
+    def throughput(self, decoder, settings):
+        '''
+        Returns the measured throughput of a decoder and encoder
+        combination.
+
+        :Args:
+            * decoder(str): the decoder, see abstract.Lossless.decoder()
+            * settings(str): the encoder settings
+        :Returns:
+            * None: nothing has been measured
+            * float: seconds of audio encoded per second
+        '''
+        with self._lock:
+            row = self._db.execute(
+                '''SELECT audio, seconds FROM throughput
+                   WHERE decoder = ? AND settings = ?''',
+                (decoder, settings)).fetchone()
+        if row is None or row[1] <= 0:
+            return None
+        return row[0] / row[1]
+
+    def clear(self):
+        '''
+        Forgets everything except measured throughput. The next scan will
+        list every directory and compare every file against the destination
+        folder, and staged files are made again.
+        '''
+        with self._lock:
+            for table in ('files', 'vanished', 'dirs', 'listing', 'loudness',
+                          'staged'):
+                self._db.execute('DELETE FROM {}'.format(table))
+            self._db.commit()
+
+    def commit(self):
+        'Writes pending changes to disk.'
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        'Commits pending changes and closes the database.'
+        with self._lock:
+            self._db.commit()
+            self._db.close()
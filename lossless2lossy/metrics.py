@@ -0,0 +1,211 @@
+'''
+Module for measuring where the time of a run goes.
+
+Work is grouped into stages (scan, stat, diff, load, decode, encode, tag,
+post_encode_hook, remote, dedup, cache, move, copy, art, commit, delete).
+The decode stage is split by decoder, e.g. decode_flac and decode_sox, so
+that the fast path can be told apart from resampling.
+For each stage a :class:`Metrics` object adds up the number of calls, wall
+time, CPU time, bytes read and written and seconds of audio processed. CPU time
+includes the codec processes a stage waited for: processes charged with
+:func:`charge_children` have their resource usage charged to the innermost
+stage running in the calling thread.
+
+The totals can be written as a JSON report or as a Prometheus textfile for
+the node exporter's textfile collector.
+'''
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+STAGE_FIELDS = ('calls', 'wall_seconds', 'cpu_seconds', 'bytes_in',
+                'bytes_out', 'audio_seconds')
+
+# Stages running in each thread, innermost last
+_running = threading.local()
+
+
+def _stack():
+    if not hasattr(_running, 'stages'):
+        _running.stages = []
+    return _running.stages
+
+
+def charge_children(seconds):
+    '''
+    Charges the CPU time of a child process that was reaped elsewhere, e.g.
+    by engine.Engine, to the stage running in this thread.
+    '''
+    stack = _stack()
+    if stack:
+        stack[-1].child_cpu += seconds
+
+
+class Stage:
+    '''
+    One measurement in progress, returned by :meth:`Metrics.stage`. Bytes
+    and audio seconds that are only known at the end can be added to it
+    before the ``with`` block ends.
+    '''
+
+    def __init__(self, name, bytes_in=0, bytes_out=0, audio_seconds=0.0):
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.audio_seconds = audio_seconds
+        self.child_cpu = 0.0
+
+
+class Metrics:
+    '''
+    Totals for each stage of a run. Safe to use from several threads.
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages = collections.OrderedDict()
+
+    def add(self, name, calls=1, wall_seconds=0.0, cpu_seconds=0.0,
+            bytes_in=0, bytes_out=0, audio_seconds=0.0):
+        '''
+        Adds measurements to the totals of a stage.
+        '''
+        with self._lock:
+            totals = self._stages.setdefault(
+                name, collections.OrderedDict((field, 0)
+                                              for field in STAGE_FIELDS))
+            totals['calls'] += calls
+            totals['wall_seconds'] += wall_seconds
+            totals['cpu_seconds'] += cpu_seconds
+            totals['bytes_in'] += bytes_in
+            totals['bytes_out'] += bytes_out
+            totals['audio_seconds'] += audio_seconds
+
+    @contextlib.contextmanager
+    def stage(self, name, bytes_in=0, bytes_out=0, audio_seconds=0.0):
+        '''
+        Measures the body of a ``with`` block as one call of a stage.
+
+        :Args:
+            * name(str): the stage
+            * bytes_in(int): bytes read
+            * bytes_out(int): bytes written
+            * audio_seconds(float): seconds of audio processed
+        :Returns:
+            * Stage: more bytes and audio seconds can be added to it
+        '''
+        current = Stage(name, bytes_in, bytes_out, audio_seconds)
+        stack = _stack()
+        stack.append(current)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield current
+        finally:
+            cpu = time.thread_time() - cpu
+            wall = time.perf_counter() - wall
+            stack.pop()
+            self.add(name, 1, wall, cpu + current.child_cpu,
+                     current.bytes_in, current.bytes_out,
+                     current.audio_seconds)
+
+    def iterate(self, name, iterable):
+        '''
+        Measures the time spent producing the items of ``iterable``, leaving
+        out the time the consumer spends between items.
+
+        :Args:
+            * name(str): the stage
+            * iterable(iter): a generator or other iterable
+        :Returns:
+            * generator: the items of ``iterable``
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def to_dict(self):
+        '''
+        Returns the totals as a dictionary that can be serialized to JSON.
+        Stages that processed audio also get their realtime factor, seconds
+        of audio per second of wall time and per second of CPU time.
+        '''
+        with self._lock:
+            stages = collections.OrderedDict(
+                (name, dict(totals)) for name, totals in self._stages.items()
+            )
+        for totals in stages.values():
+            if totals['audio_seconds']:
+                for field in ('wall_seconds', 'cpu_seconds'):
+                    key = 'realtime_per_' + field.split('_')[0]
+                    totals[key] = (totals['audio_seconds'] / totals[field]
+                                   if totals[field] else None)
+        return collections.OrderedDict([
+            ('started', self.started),
+            ('wall_seconds', time.perf_counter() - self._started),
+            ('stages', stages),
+        ])
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix='lossless2lossy'):
+        '''
+        Returns the totals in the Prometheus text exposition format.
+
+        :Args:
+            * prefix(str): prepended to every metric name
+        :Returns:
+            * str
+        '''
+        report = self.to_dict()
+        lines = []
+
+        def metric(name, help_, samples):
+            name = '{}_{}'.format(prefix, name)
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, labels, repr(
+                    float(value))))
+
+        metric('last_run_start_timestamp_seconds',
+               'When the last run started.', [('', report['started'])])
+        metric('last_run_wall_seconds', 'Duration of the last run.',
+               [('', report['wall_seconds'])])
+        for field in STAGE_FIELDS:
+            metric('last_run_stage_' + field,
+                   'Total {} of each stage in the last run.'.format(
+                       field.replace('_', ' ')),
+                   [('{{stage="{}"}}'.format(name), totals[field])
+                    for name, totals in report['stages'].items()])
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        'Writes the JSON report to ``path``.'
+        self._write(path, self.to_json() + '\n')
+
+    def write_textfile(self, path):
+        '''
+        Writes the Prometheus textfile to ``path``. The file is written
+        under a temporary name and renamed, so the node exporter never reads
+        half of it.
+        '''
+        self._write(path, self.to_prometheus())
+
+    @staticmethod
+    def _write(path, text):
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
@@ -8,8 +8,11 @@ import os
 import glob
 
 import mutagenx.mp3
+import mutagenx.id3
+import mutagenx.easyid3
 
 from . import abstract
+from . import engine as engine_module
 
 
 class Mp3(mutagenx.mp3.EasyMP3, abstract.Lossy):
@@ -17,6 +20,9 @@ class Mp3(mutagenx.mp3.EasyMP3, abstract.Lossy):
     TYPE = 'lossy'
     tags = mutagenx.easyid3.EasyID3.valid_keys
     VALID_TAGS = tuple(tags.keys())
+    ENCODE_OPTIONS = ('-V0',)
+    GAIN_STEP = 1.5  # dB, the resolution of mp3 global gain
+    RVA2_MAX_PEAK = 1.999969  # RVA2 frames only hold peaks below 2
 
     def __init__(self, filename, *args, **kwargs):
         '''
@@ -31,6 +37,31 @@ class Mp3(mutagenx.mp3.EasyMP3, abstract.Lossy):
         else:
             raise TypeError('not an mp3 file.')
 
+    # Average bitrates in kbit/s of lame's VBR presets -V0 to -V9
+    VBR_BITRATES = (245, 225, 190, 175, 165, 130, 115, 100, 85, 65)
+
+    @classmethod
+    def estimated_bitrate(cls):
+        '''
+        Returns the average bitrate in kbit/s that ENCODE_OPTIONS are
+        expected to produce, taken from lame's documentation for VBR presets
+        and from the requested bitrate for CBR and ABR.
+        '''
+        bitrate = 128  # lame's default
+        options = list(cls.ENCODE_OPTIONS)
+        for index, option in enumerate(options):
+            value = options[index + 1] if index + 1 < len(options) else ''
+            if option == '-V':
+                option += value
+            match = re.match(r'^-V(\d)', option)
+            if match:
+                bitrate = cls.VBR_BITRATES[int(match.group(1))]
+            elif option in ('-b', '--abr') and value.isdigit():
+                bitrate = int(value)
+            elif re.match(r'^-b\d+$', option):
+                bitrate = int(option[2:])
+        return bitrate
+
     @classmethod
     def encode(self, outfile, popen_object):
         '''
@@ -46,15 +77,7 @@ class Mp3(mutagenx.mp3.EasyMP3, abstract.Lossy):
         :Raises:
             * EXCEPTION: Encoder error
         '''
-        dirname = os.path.dirname(outfile)
-        filename_without_extension = os.path.splitext(outfile)[0]
-        outfile = filename_without_extension + self.EXTENSIONS[0]
-
-        # make directories as needed
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname, exist_ok=True)
-
-        cmd = ['lame', '-V0', '-', outfile]
+        cmd, outfile = self.encode_command(outfile)
         encoded = subprocess.Popen(cmd,
                                    stdin=popen_object.stdout,
                                    stderr=subprocess.PIPE,
@@ -66,28 +89,63 @@ class Mp3(mutagenx.mp3.EasyMP3, abstract.Lossy):
         else:
             raise Exception('lame encoder error')
 
-    def _replaygain_album(self):
+    @classmethod
+    def encode_command(self, outfile):
+        '''
+        Returns the command line of lame reading a PCM stream from stdin,
+        and the file it writes. Creates the file's folder as needed.
+
+        :Args:
+            * outfile(str): output filename. Extensions will be renamed to'
+                ' self.EXTENSION
+        :Returns:
+            * tuple(list(str), str): the command line and the file it writes
+        '''
+        dirname = os.path.dirname(outfile)
+        filename_without_extension = os.path.splitext(outfile)[0]
+        outfile = filename_without_extension + self.EXTENSIONS[0]
+
+        # make directories as needed
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        cmd = ['lame'] + list(self.ENCODE_OPTIONS) + ['-', outfile]
+        return cmd, outfile
+
+    def _replaygain_album(self, engine=None):
         '''
         Calls `mp3gain` to perform an album based analysis on all *.mp3
         files in the current directory.
 
+        :Args:
+            * engine(engine.Engine): (optional) runs mp3gain, so that
+                cancelling the engine kills it
         :Raises:
-            * Exception: mp3gain returned a non 0 exit code
+            * engine.ProcessError: mp3gain returned a non 0 exit code
         '''
         path = os.path.dirname(self.filename)
         mp3files = glob.glob(os.path.join(path, '*' + self.EXTENSIONS[0]))
         cmd = ['mp3gain', '-a', '-c', '-s', 'i', '-s', 'r']
         cmd.extend(mp3files)
-        popen = subprocess.Popen(cmd,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-        result = popen.communicate()
-        if not popen.returncode == 0:
-            raise Exception('mp3gain error', result)
+        engine_module.run_command(cmd, engine)
+
+    @staticmethod
+    def _has_v1_tags(filename):
+        '''
+        Tests whether a file ends with an ID3 v1 tag.
+        '''
+        with open(filename, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 128:
+                return False
+            f.seek(-128, os.SEEK_END)
+            return f.read(3) == b'TAG'
 
     def _add_v11_tags(self):
         '''
-        Calls `eyeD3` to add v1.1 id3 tags to all mp3 files
+        Adds v1.1 id3 tags, generated from the v2 tags, to all mp3 files in
+        the directory that do not have v1 tags yet. Files encoded by
+        lossless2lossy already have them.
 
         :Raises:
             * Exception
@@ -95,18 +153,149 @@ class Mp3(mutagenx.mp3.EasyMP3, abstract.Lossy):
         path = os.path.dirname(self.filename)
         mp3files = glob.glob(os.path.join(path, '*' + self.EXTENSIONS[0]))
         for mp3file in mp3files:
-            cmd = ['eyeD3', '--to-v1.1'] + [mp3file]
-            popen = subprocess.Popen(cmd,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-            result = popen.communicate()
-            if not popen.returncode == 0:
-                raise Exception('eyeD3 error', result)
+            if self._has_v1_tags(mp3file):
+                continue
+            try:
+                tags = mutagenx.id3.ID3(mp3file)
+            except mutagenx.id3.ID3NoHeaderError:
+                continue
+            tags.save(mp3file, v1=2)
 
-    def post_encode_hook(self):
+    def _apply_gain(self, filename, steps, engine=None):
+        '''
+        Calls `mp3gain` to change the volume of a file by ``steps`` without
+        analysing it or touching its tags.
+
+        :Args:
+            * engine(engine.Engine): (optional) runs mp3gain, so that
+                cancelling the engine kills it
+        :Raises:
+            * engine.ProcessError: mp3gain returned a non 0 exit code
+        '''
+        # The applied gain is recorded in the manifest, so mp3gain does not
+        # need to rewrite the tags with its own undo information
+        cmd = ['mp3gain', '-c', '-s', 's', '-g', str(steps), filename]
+        engine_module.run_command(cmd, engine)
+
+    def finalize(self, tags=None, replaygain=None, cover=None, engine=None):
+        '''
+        Copies tags, applies precomputed album gain in whole ``GAIN_STEP``
+        steps, tags the file with the remaining gain, embeds the cover and
+        writes ID3 v2.4 and v1.1 tags, all in one save.
+
+        :Args:
+            * tags(FileClass): (optional) copy every tag this class accepts
+                from this file, and remove those it does not have
+            * replaygain(abstract.ReplayGain): (optional) values for this
+                file
+            * cover(tuple(bytes, str)): (optional) an image and its mime
+                type, written as the only APIC frame
+            * engine(engine.Engine): (optional) runs mp3gain
+        :Returns:
+            * int: the steps now applied to the file when ``replaygain`` was
+                given, otherwise None
+        '''
+        if tags is not None:
+            # Tags removed from the source are removed here too, so a file
+            # retagged in place ends up like a fresh encode
+            for tag in list(self.keys()):
+                if tag in self.VALID_TAGS and tag not in tags:
+                    del self[tag]
+            for tag in tags:
+                if tag in self.VALID_TAGS:
+                    self[tag] = tags[tag]
+        steps = None
+        if replaygain is not None:
+            steps = int(round(replaygain.album_gain / self.GAIN_STEP))
+            if steps != replaygain.applied:
+                # only changes the gain field of each frame, in place
+                self._apply_gain(self.filename, steps - replaygain.applied,
+                                 engine)
+            offset = steps * self.GAIN_STEP
+            scale = 10 ** (offset / 20.0)
+            for scope, gain, peak in (
+                    ('track', replaygain.track_gain - offset,
+                     replaygain.track_peak * scale),
+                    ('album', replaygain.album_gain - offset,
+                     replaygain.album_peak * scale)):
+                gain = '{:+.2f} dB'.format(gain)
+                self[REPLAYGAIN_TXXX[scope + '_gain']] = gain
+                self[REPLAYGAIN_TXXX[scope + '_peak']] = '{:.6f}'.format(peak)
+                self['replaygain_{}_gain'.format(scope)] = gain
+                self['replaygain_{}_peak'.format(scope)] = '{:.6f}'.format(
+                    min(peak, self.RVA2_MAX_PEAK))
+        if cover is not None:
+            self[COVER_KEY] = [tuple(cover)]
+        self.save(v1=2)  # also write ID3 v1.1
+        return steps
+
+    def clear_tags(self):
+        'Removes the ID3 v1 and v2 tags from the file.'
+        self.delete()
+
+    def _replaygain_precomputed(self, replaygain, engine=None):
+        '''
+        Applies precomputed album gain to each file with finalize().
+
+        :Args:
+            * replaygain(dict(str: abstract.ReplayGain)): values for each
+                file
+            * engine(engine.Engine): (optional) runs mp3gain
+        :Returns:
+            * dict(str: int): the steps now applied to each file
+        '''
+        applied = {}
+        for filename, values in replaygain.items():
+            applied[filename] = type(self)(filename).finalize(
+                replaygain=values, engine=engine)
+        return applied
+
+    def post_encode_hook(self, replaygain=None, engine=None):
         '''
         Triggers a replaygain on all mp3 files in the directory
         and adds id3v1.1 tags to all mp3 files.
+
+        When ``replaygain`` values are given, the album gain is applied
+        from them and `mp3gain` does not analyse the audio again. mp3gain
+        runs in ``engine`` when one is given.
         '''
-        self._replaygain_album()
+        applied = None
+        if replaygain:
+            applied = self._replaygain_precomputed(replaygain, engine)
+        else:
+            self._replaygain_album(engine)
         self._add_v11_tags()
+        return applied
+
+
+# EasyID3 stores the replaygain_* keys as RVA2 frames, but most players read
+# the TXXX frames written by foobar2000 and mp3gain. Registered after Mp3, so
+# they are not copied from lossless files.
+REPLAYGAIN_TXXX = dict(
+    (name, 'txxx:replaygain_' + name)
+    for name in ('track_gain', 'track_peak', 'album_gain', 'album_peak'))
+for _key in REPLAYGAIN_TXXX.values():
+    mutagenx.easyid3.EasyID3.RegisterTXXXKey(_key, _key[5:].upper())
+
+
+# The front cover, as a list of (bytes, mime type) tuples
+COVER_KEY = 'apic:cover'
+
+
+def _get_cover(id3, key):
+    return [(frame.data, frame.mime) for frame in id3.getall('APIC')]
+
+
+def _set_cover(id3, key, value):
+    id3.delall('APIC')
+    for data, mime in value:
+        id3.add(mutagenx.id3.APIC(encoding=3, mime=mime, type=3,
+                                  desc='Cover', data=data))
+
+
+def _delete_cover(id3, key):
+    id3.delall('APIC')
+
+
+mutagenx.easyid3.EasyID3.RegisterKey(COVER_KEY, _get_cover, _set_cover,
+                                     _delete_cover)
@@ -0,0 +1,374 @@
+'''
+Module for planning a run without changing any files.
+
+A :class:`Plan` runs the same comparison as :class:`lossless2lossy.Worker`
+and reads the headers of every lossless file that would be encoded, several
+at a time, to report how much work is queued: the number of encodes, moves,
+copies and deletions, the hours of audio, the expected size of the output,
+whether it fits on the destination, and how long the encodes should take. It
+also simulates the order the encodes would run in, to show how much sooner
+the last one finishes when the longest tracks start first.
+
+The time estimate uses the throughput measured by earlier runs and stored
+in each destination's manifest. When nothing has been measured for a
+decoder and encoder combination, one short track is encoded to a temporary
+folder to measure it.
+'''
+import collections
+import concurrent.futures
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from . import concurrency
+from . import scheduler
+from . import sync
+
+
+def _size(path):
+    '''
+    Returns the size in bytes of a file, or of everything below a folder.
+    Missing paths have a size of 0.
+    '''
+    if os.path.isdir(path) and not os.path.islink(path):
+        total = 0
+        for root, __, files in os.walk(path):
+            for name in files:
+                total += _size(os.path.join(root, name))
+        return total
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return 0
+
+
+def format_size(size):
+    'Formats a number of bytes for people.'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1000:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1000.0
+    return '{:.1f} TB'.format(size)
+
+
+def format_duration(seconds):
+    'Formats a number of seconds as H:MM:SS.'
+    seconds = int(round(seconds))
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60,
+                                   seconds % 60)
+
+
+class Plan:
+    '''
+    The work a run would do.
+
+    Arguments:
+        * targets (list(sync.Sync)): the destinations, sharing one source
+            folder, as passed to lossless2lossy.Worker
+        * deletes (bool): (optional) count files that would be deleted
+        * limits (concurrency.Limits): (optional) the budgets the run would
+            use. The I/O budget sets how many headers are read at once and
+            the CPU budget how many encodes the time estimate assumes.
+        * calibrate (bool): (optional) encode a short track to measure the
+            throughput of combinations that have not been measured yet
+        * lookahead (int): (optional) the number of queued jobs the run
+            would choose the longest encode from, see
+            lossless2lossy.Worker
+    '''
+
+    def __init__(self, targets, deletes=False, limits=None, calibrate=True,
+                 lookahead=scheduler.DEFAULT_LOOKAHEAD):
+        self.targets = list(targets)
+        self.deletes = deletes
+        self.limits = limits or concurrency.Limits()
+        self.calibrate = calibrate
+        self.lookahead = lookahead
+        # list(tuple(Lossless, list(sync.Sync))): files to encode
+        self.encodes = []
+        self.unreadable = []
+        self.destinations = collections.OrderedDict(
+            (target, collections.Counter()) for target in self.targets
+        )
+        self._throughput = {}
+
+    def build(self):
+        '''
+        Compares the folders and reads the lossless headers.
+
+        :Returns:
+            * Plan: this plan
+        '''
+        wanted = collections.OrderedDict()
+        for target, action in sync.diff_all(self.targets,
+                                            deletes=self.deletes):
+            counts = self.destinations[target]
+            if action.kind in (sync.DELETE, sync.DELETE_DIR):
+                counts['deletes'] += 1
+                counts['deleted_bytes'] += _size(action.dest)
+            elif target.settings_for(action.src) == 'copy':
+                counts['copies'] += 1
+                counts['copied_bytes'] += _size(action.src)
+                counts['replaced_bytes'] += _size(action.dest)
+            else:
+                wanted.setdefault(action.src, []).append((target, action))
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.limits.io.size) as executor:
+            loaded = executor.map(sync.Sync.load_cls_objs,
+                                  ([src] for src in wanted))
+            for src, files in zip(wanted, loaded):
+                if not files:
+                    self.unreadable.append(src)
+                    continue
+                self._add_lossless(files[0], wanted[src])
+        return self
+
+    def _add_lossless(self, lossless_file, changes):
+        encode_targets = []
+        for target, action in changes:
+            counts = self.destinations[target]
+            if (action.kind == sync.UPDATE
+                and target.audio_unchanged(lossless_file)):
+                counts['retags'] += 1
+                continue
+            if (action.kind == sync.ADD
+                and target.find_move(lossless_file) is not None):
+                counts['moves'] += 1
+                continue
+            encode_targets.append(target)
+            counts['encodes'] += 1
+            counts['replaced_bytes'] += _size(action.dest)
+            bitrate = target.encode_class.estimated_bitrate()
+            if bitrate and lossless_file.duration():
+                counts['encoded_bytes'] += int(
+                    lossless_file.duration() * bitrate * 1000 / 8)
+        if encode_targets:
+            self.encodes.append((lossless_file, encode_targets))
+
+    @property
+    def audio_seconds(self):
+        'The length of all the audio that would be encoded.'
+        return sum(lossless_file.duration() or 0
+                   for lossless_file, __ in self.encodes)
+
+    def throughput(self, decoder, target):
+        '''
+        Returns the seconds of audio per second that ``decoder`` and the
+        encoder of ``target`` manage together, measuring it if needed.
+
+        :Args:
+            * decoder(str): the decoder, see abstract.Lossless.decoder()
+            * target(sync.Sync): the destination
+        :Returns:
+            * None: not measured and calibration is off or failed
+            * float: the throughput
+        '''
+        key = (decoder, target.encode_settings)
+        if key not in self._throughput:
+            measured = None
+            if target.manifest is not None:
+                measured = target.manifest.throughput(*key)
+            if measured is None and self.calibrate:
+                measured = self._calibrate(decoder, target)
+            self._throughput[key] = measured
+        return self._throughput[key]
+
+    def _calibrate(self, decoder, target):
+        '''
+        Encodes the shortest pending track that uses ``decoder`` into a
+        temporary folder and returns the measured throughput.
+        '''
+        samples = [lossless_file for lossless_file, __ in self.encodes
+                   if lossless_file.decoder() == decoder
+                   and lossless_file.duration()]
+        if not samples:
+            return None
+        sample = min(samples, key=lambda lossless_file:
+                     lossless_file.duration())
+        tmpdir = tempfile.mkdtemp(prefix='lossless2lossy-')
+        try:
+            started = time.monotonic()
+            decoded = sample.decode()
+            target.encode_class.encode(os.path.join(tmpdir, 'calibrate'),
+                                       decoded)
+            decoded.wait()
+            elapsed = time.monotonic() - started
+        except Exception:
+            return None
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        if target.manifest is not None:
+            target.manifest.add_throughput(decoder, target.encode_settings,
+                                           sample.duration(), elapsed)
+        return sample.duration() / elapsed if elapsed > 0 else None
+
+    def _encode_seconds(self):
+        '''
+        Returns how long each encode takes and the CPU slots it uses, in
+        the order they are queued, or None if the throughput of some
+        encodes is not known.
+        '''
+        encodes = []
+        for lossless_file, targets in self.encodes:
+            speeds = [self.throughput(lossless_file.decoder(), target)
+                      for target in targets]
+            if None in speeds or not lossless_file.duration():
+                return None
+            # The encoders share one decode, so the slowest sets the pace
+            seconds = lossless_file.duration() / min(speeds)
+            slots = min(1 + len(targets), self.limits.cpu.size)
+            encodes.append((seconds, slots))
+        return encodes
+
+    def eta(self):
+        '''
+        Estimates how long the encodes will take, assuming the CPU budget
+        is kept full. Copies are assumed to overlap with encoding.
+
+        :Returns:
+            * None: the throughput of some encodes is not known
+            * float: seconds
+        '''
+        encodes = self._encode_seconds()
+        if encodes is None:
+            return None
+        slot_seconds = sum(seconds * slots for seconds, slots in encodes)
+        return slot_seconds / self.limits.cpu.size
+
+    def makespan(self):
+        '''
+        Simulates the encodes running on the CPU budget, started in the
+        order they are queued and started longest first, see
+        scheduler.makespan(). Unlike :meth:`eta` this includes the time the
+        last encodes run while other slots are idle.
+
+        :Returns:
+            * None: the throughput of some encodes is not known
+            * dict: ``queued`` and ``longest_first`` seconds
+        '''
+        encodes = self._encode_seconds()
+        if encodes is None:
+            return None
+        slots = max([slots for __, slots in encodes] or [1])
+        workers = max(1, self.limits.cpu.size // slots)
+        durations = [seconds for seconds, __ in encodes]
+        return {
+            'queued': scheduler.makespan(durations, workers),
+            'longest_first': scheduler.makespan(durations, workers,
+                                                self.lookahead),
+        }
+
+    def space(self):
+        '''
+        Compares the space each destination filesystem needs with the space
+        it has. Deletions happen at the end of a run, so they do not help.
+
+        :Returns:
+            * list(dict): ``destdir``, ``required`` and ``free`` bytes for
+                each filesystem
+        '''
+        filesystems = collections.OrderedDict()
+        for target, counts in self.destinations.items():
+            device = os.stat(target.destdir).st_dev
+            required = (counts['encoded_bytes'] + counts['copied_bytes']
+                        - counts['replaced_bytes'])
+            if device not in filesystems:
+                filesystems[device] = {
+                    'destdir': target.destdir,
+                    'required': 0,
+                    'free': shutil.disk_usage(target.destdir).free,
+                }
+            filesystems[device]['required'] += max(0, required)
+        return list(filesystems.values())
+
+    def shortfalls(self):
+        '''
+        Returns the entries of :meth:`space` that do not have enough room.
+        '''
+        return [entry for entry in self.space()
+                if entry['required'] > entry['free']]
+
+    def to_dict(self):
+        '''
+        Returns the plan as a dictionary that can be serialized to JSON.
+        '''
+        decoders = collections.Counter(
+            lossless_file.decoder() for lossless_file, __ in self.encodes)
+        sample_rates = collections.Counter(
+            str(lossless_file.sample_rate())
+            for lossless_file, __ in self.encodes)
+        return {
+            'files_to_encode': len(self.encodes),
+            'decoders': dict(decoders),
+            'sample_rates': dict(sample_rates),
+            'audio_hours': self.audio_seconds / 3600.0,
+            'unreadable': list(self.unreadable),
+            'eta_seconds': self.eta(),
+            'makespan_seconds': self.makespan(),
+            'destinations': [
+                dict(destdir=target.destdir,
+                     settings=target.encode_settings,
+                     **dict((key, counts[key]) for key in (
+                         'encodes', 'moves', 'retags', 'copies', 'deletes',
+                         'encoded_bytes', 'copied_bytes', 'replaced_bytes',
+                         'deleted_bytes')))
+                for target, counts in self.destinations.items()
+            ],
+            'space': self.space(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def report(self):
+        '''
+        Returns the plan as text.
+        '''
+        plan = self.to_dict()
+        lines = ['** Plan **', '',
+                 '\tFiles to Encode: {}'.format(plan['files_to_encode'])]
+        for name, count in sorted(plan['decoders'].items()):
+            lines.append('\t    decoded by {}: {}'.format(name, count))
+        lines.append('\tAudio: {:.1f} hours'.format(plan['audio_hours']))
+        if plan['eta_seconds'] is None:
+            lines.append('\tEstimated Time: unknown')
+        else:
+            lines.append('\tEstimated Time: {}'.format(
+                format_duration(plan['eta_seconds'])))
+        makespan = plan['makespan_seconds']
+        if makespan is not None and makespan['queued'] > 0:
+            lines.append(
+                '\t    longest first: {}, in queue order: {} ({:.0%}'
+                ' less)'.format(
+                    format_duration(makespan['longest_first']),
+                    format_duration(makespan['queued']),
+                    1 - makespan['longest_first'] / makespan['queued']))
+        if plan['unreadable']:
+            lines.append('\tUnreadable Files: {}'.format(
+                len(plan['unreadable'])))
+
+        for destination in plan['destinations']:
+            lines.extend([
+                '',
+                '\t{} ({})'.format(destination['destdir'],
+                                   destination['settings']),
+                '\t    Files to Encode: {}'.format(destination['encodes']),
+                '\t    Files to Move: {}'.format(destination['moves']),
+                '\t    Tags to Update: {}'.format(destination['retags']),
+                '\t    Files to Copy: {}'.format(destination['copies']),
+                '\t    Files to Delete: {}'.format(destination['deletes']),
+                '\t    Estimated Size: {}'.format(format_size(
+                    destination['encoded_bytes']
+                    + destination['copied_bytes'])),
+            ])
+
+        lines.append('')
+        for entry in plan['space']:
+            lines.append('\tSpace on {}: {} needed, {} free{}'.format(
+                entry['destdir'], format_size(entry['required']),
+                format_size(entry['free']),
+                '' if entry['required'] <= entry['free']
+                else '  ** NOT ENOUGH SPACE **'))
+        return '\n'.join(lines) + '\n'
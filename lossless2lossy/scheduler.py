@@ -0,0 +1,322 @@
+'''
+Module for running jobs that depend on each other.
+
+Each job is a node in a graph. A job is handed to the executor as soon as
+every job it depends on has finished, so independent work from different
+albums can run side by side while per-album jobs, such as ReplayGain, still
+wait for all of their album's tracks.
+
+Jobs can be given a priority, such as the length of the track they encode.
+When the graph knows how many jobs the executor runs at once, it holds the
+ready jobs back and starts the one with the highest priority whenever a
+worker is free, so that long tracks start first instead of being left
+until the end of a run (longest processing time first).
+
+A job whose work happens elsewhere, such as an encode whose codec processes
+are driven by an engine.Engine, returns a :class:`Deferred` instead of
+waiting for it. Its worker thread is free again at once, and a short
+continuation finishes the job once the work is done.
+'''
+import concurrent.futures
+import heapq
+import itertools
+import threading
+
+# Unfinished jobs kept in a TaskGraph so that the longest can be started
+# first, see lossless2lossy.Worker
+DEFAULT_LOOKAHEAD = 128
+
+
+def makespan(durations, workers, lookahead=None):
+    '''
+    Simulates running jobs on identical workers, each job starting on the
+    first worker that is free, and returns when the last one finishes.
+
+    :Args:
+        * durations(iter(float)): the time each job takes, in the order the
+            jobs are queued
+        * workers(int): the number of jobs that run at once
+        * lookahead(int): (optional) start the longest of the next
+            ``lookahead`` queued jobs first, as TaskGraph does with
+            priorities. By default jobs start in the order they are queued.
+    :Returns:
+        * float
+    '''
+    queued = iter(durations)
+    order = itertools.count()
+    # (key, order, duration) of the jobs a scheduler can choose from
+    window = []
+
+    def fill(count):
+        for duration in itertools.islice(queued, count):
+            key = -duration if lookahead else 0
+            heapq.heappush(window, (key, next(order), duration))
+
+    fill(lookahead or 1)
+    # when each worker is free
+    free = [0.0] * max(1, workers)
+    finished = 0.0
+    while window:
+        __, __, duration = heapq.heappop(window)
+        end = heapq.heappop(free) + duration
+        heapq.heappush(free, end)
+        finished = max(finished, end)
+        fill(1)
+    return finished
+
+
+class Deferred:
+    '''
+    Returned by a job to finish once ``future`` is done, without a thread
+    waiting for it. The graph then runs ``then(future, *args)`` in the
+    executor, and what that returns is the job's result.
+
+    Arguments:
+        * future (concurrent.futures.Future): the work being waited for
+        * then (callable): finishes the job. Called whether the future
+            succeeded, failed or was cancelled.
+        * args: more arguments passed to ``then``
+    '''
+
+    def __init__(self, future, then, *args):
+        self.future = future
+        self.then = then
+        self.args = args
+
+    def resolve(self):
+        '''
+        Waits for the future in this thread and finishes the job, for
+        callers outside a graph.
+
+        :Returns:
+            * the job's result
+        '''
+        concurrent.futures.wait([self.future])
+        result = self.then(self.future, *self.args)
+        if isinstance(result, Deferred):
+            return result.resolve()
+        return result
+
+
+class TaskGraph:
+    '''
+    Submits callables to an executor once their dependencies have finished.
+
+    Arguments:
+        * executor (concurrent.futures.Executor): runs the jobs
+        * limit (int): (optional) the maximum number of unfinished jobs.
+            :meth:`submit` blocks until a job finishes when the limit has
+            been reached, which keeps the caller from queueing an entire
+            library up front.
+        * workers (int): (optional) the number of jobs the executor runs at
+            once. When given, ready jobs are held back until a worker is
+            free and the job with the highest priority is started first.
+            By default every ready job is handed to the executor at once.
+            A job that returned a :class:`Deferred` keeps its worker until
+            it has finished, but not its thread.
+    '''
+
+    def __init__(self, executor, limit=None, workers=None):
+        self.executor = executor
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._tasks = set()
+        self._failure = None
+        self._cancelled = False
+        # executor futures that have not finished
+        self._inner = set()
+        # futures that jobs returned in a Deferred and that have not
+        # finished, and the executor futures of their continuations
+        self._deferred = set()
+        self._continuations = set()
+        # (key, order, task, fn, args) of ready jobs waiting for a worker
+        self._ready = []
+        self._order = itertools.count()
+        self._slots = threading.BoundedSemaphore(limit) if limit else None
+
+    def submit(self, fn, *args, after=(), priority=None):
+        '''
+        Schedules ``fn(*args)`` to run after every future in ``after``.
+
+        If a dependency fails, ``fn`` is not run and the returned future
+        fails with the dependency's exception.
+
+        :Args:
+            * fn(callable): the job
+            * args: arguments passed to ``fn``
+            * after(iter(concurrent.futures.Future)): jobs that must finish
+                first
+            * priority(float): (optional) ready jobs with a higher priority
+                start first. Jobs without one start before every job that
+                has one, in the order they became ready.
+        :Returns:
+            * concurrent.futures.Future: the result of ``fn``
+        '''
+        if self._slots is not None:
+            self._slots.acquire()
+
+        task = concurrent.futures.Future()
+        task.set_running_or_notify_cancel()
+        with self._lock:
+            self._tasks.add(task)
+        task.add_done_callback(self._finished)
+
+        after = list(after)
+        remaining = [len(after)]
+        remaining_lock = threading.Lock()
+
+        def start():
+            for dependency in after:
+                if dependency.cancelled():
+                    task.set_exception(
+                        concurrent.futures.CancelledError()
+                    )
+                    return
+                if dependency.exception() is not None:
+                    task.set_exception(dependency.exception())
+                    return
+            key = (0, 0) if priority is None else (1, -priority)
+            # Checked under the lock so cancel() cannot miss a job
+            with self._lock:
+                cancelled = self._cancelled
+                if not cancelled:
+                    heapq.heappush(self._ready, (key, next(self._order), task,
+                                                 fn, args))
+            if cancelled:
+                task.set_exception(concurrent.futures.CancelledError())
+                return
+            self._dispatch()
+
+        def dependency_done(__):
+            with remaining_lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                start()
+
+        if not after:
+            start()
+        for dependency in after:
+            dependency.add_done_callback(dependency_done)
+        return task
+
+    def _dispatch(self):
+        'Hands ready jobs to the executor while it has free workers.'
+        started = []
+        with self._lock:
+            while self._ready and (self.workers is None
+                                   or len(self._inner) + len(self._deferred)
+                                   < self.workers):
+                __, __, task, fn, args = heapq.heappop(self._ready)
+                try:
+                    inner = self.executor.submit(fn, *args)
+                except Exception as e:
+                    started.append((None, task, e))
+                    continue
+                self._inner.add(inner)
+                started.append((inner, task, None))
+        # Outside the lock: a callback on a finished future runs at once
+        for inner, task, error in started:
+            if error is not None:
+                task.set_exception(error)
+            else:
+                inner.add_done_callback(
+                    lambda inner, task=task: self._chain(inner, task))
+
+    def _chain(self, inner, task):
+        '''
+        Copies the outcome of the executor future onto the task future, or
+        waits for the future of a Deferred.
+        '''
+        deferred = None
+        if not inner.cancelled() and inner.exception() is None:
+            if isinstance(inner.result(), Deferred):
+                deferred = inner.result()
+        with self._lock:
+            self._inner.discard(inner)
+            self._continuations.discard(inner)
+            if deferred is not None:
+                # The job keeps its worker until it is finished
+                self._deferred.add(deferred.future)
+        if deferred is not None:
+            deferred.future.add_done_callback(
+                lambda __: self._resume(deferred, task))
+            return
+        self._dispatch()
+        if inner.cancelled():
+            task.set_exception(concurrent.futures.CancelledError())
+        elif inner.exception() is not None:
+            task.set_exception(inner.exception())
+        else:
+            task.set_result(inner.result())
+
+    def _resume(self, deferred, task):
+        'Runs the continuation of a job whose Deferred future is done.'
+        error = None
+        with self._lock:
+            self._deferred.discard(deferred.future)
+            try:
+                inner = self.executor.submit(deferred.then, deferred.future,
+                                             *deferred.args)
+            except Exception as e:
+                error = e
+            else:
+                self._inner.add(inner)
+                # Continuations clean up after the work, they are never
+                # cancelled
+                self._continuations.add(inner)
+        if error is not None:
+            self._dispatch()
+            task.set_exception(error)
+            return
+        inner.add_done_callback(
+            lambda inner, task=task: self._chain(inner, task))
+
+    def _finished(self, task):
+        with self._lock:
+            self._tasks.discard(task)
+            if self._failure is None and task.exception() is not None:
+                self._failure = task.exception()
+        if self._slots is not None:
+            self._slots.release()
+
+    def cancel(self):
+        '''
+        Stops every job that has not started yet. They, and the jobs that
+        depend on them, fail with concurrent.futures.CancelledError. Jobs
+        that are running, or waiting for a Deferred, are left to finish.
+        '''
+        with self._lock:
+            self._cancelled = True
+            inner = list(self._inner - self._continuations)
+            ready = [entry[2] for entry in self._ready]
+            self._ready.clear()
+        for future in inner:
+            future.cancel()
+        for task in ready:
+            task.set_exception(concurrent.futures.CancelledError())
+
+    def failure(self):
+        '''
+        Returns the exception of the first job that failed, or None.
+        '''
+        with self._lock:
+            return self._failure
+
+    def wait(self):
+        '''
+        Blocks until every submitted job has finished.
+
+        :Raises:
+            * Exception: the exception of the first job that failed
+        '''
+        while True:
+            with self._lock:
+                tasks = list(self._tasks)
+            if not tasks:
+                break
+            concurrent.futures.wait(tasks)
+
+        failure = self.failure()
+        if failure is not None:
+            raise failure
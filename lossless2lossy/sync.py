@@ -3,13 +3,28 @@ Created on Dec 19, 2013
 
 @author: mike
 '''
+import collections
+import itertools
 import os
-import re
 
 from . import flac
 from . import mp3
 from . import art
 from . import abstract
+from . import manifest as manifest_module
+from . import metrics as metrics_module
+from . import walk
+
+# Kinds of Action produced by Sync.diff()
+ADD = 'add'
+UPDATE = 'update'
+DELETE = 'delete'
+DELETE_DIR = 'delete_dir'
+
+Action = collections.namedtuple('Action', ('kind', 'src', 'dest'))
+# A file that was synced from ``src`` to ``dest`` before its source file was
+# moved, see Sync.find_move()
+Move = collections.namedtuple('Move', ('src', 'dest', 'exact'))
 
 
 class Sync:
@@ -18,8 +33,11 @@ class Sync:
     on the file system.
     '''
     _FILE_CLASSES = (flac.Flac, mp3.Mp3, art.Art)
+    # Folder in the root of the destination folder where files are written
+    # before they are moved into place, see staging_path()
+    STAGING = '.lossless2lossy.staging'
 
-    def __init__(self, srcdir, destdir, encode_class):
+    def __init__(self, srcdir, destdir, encode_class, manifest=None):
         self.srcdir = self.validate_path(srcdir)
         self.destdir = self.validate_path(destdir)
         if self.destdir.startswith(self.srcdir):
@@ -30,10 +48,21 @@ class Sync:
         if not issubclass(self.encode_class, abstract.Lossy):
             raise Exception('encode_class must inherit from abstract.Lossy')
         self.encode_class_extension = encode_class.EXTENSIONS[0]
+        self.encode_settings = '{} {}'.format(
+            encode_class.__name__, ' '.join(encode_class.ENCODE_OPTIONS)
+        ).strip()
         self.lossless_extensions = []
         for class_ in self._FILE_CLASSES:
             if getattr(class_, 'TYPE', None) == 'lossless':
                 self.lossless_extensions.extend(class_.EXTENSIONS)
+        self.manifest = manifest
+        # A cover image written into every album with lossless files, kept
+        # when deleting, see artwork.Artwork
+        self.cover_name = None
+        # Time spent scanning and comparing, see metrics.Metrics
+        self.metrics = metrics_module.Metrics()
+        # Directories listed and stat'd at once by diff_all(), see walk.walk
+        self.scan_jobs = walk.DEFAULT_JOBS
 
     def validate_path(self, path):
         '''
@@ -79,18 +108,39 @@ class Sync:
             raise Exception('\'{}\' not in source path {}'
                             .format(path, s_root))
 
-        new_path = os.path.join(d_root, path[len(s_root):].lstrip('/'))
+        relative = path[len(s_root):].lstrip('/')
+        if not relative:
+            return d_root
+        new_path = os.path.join(d_root, relative)
 
-        if os.path.isdir(path):
-            return new_path
-
-        if os.path.isfile(path):
-            base, ext = os.path.splitext(new_path)
-            if ext in self.lossless_extensions:
-                return base + encoded_extension
+        base, ext = os.path.splitext(new_path)
+        if ext.lower() in self.lossless_extensions:
+            return base + encoded_extension
 
         return new_path
 
+    def staging_path(self, path):
+        '''
+        Converts a path in the destination folder to the path the file is
+        written to first. Files are moved from the staging folder into the
+        destination folder once their whole album is finished, so nothing
+        reading the destination folder sees a half written file or half an
+        album.
+
+        :Args:
+            * path(str): a path in the destination folder
+        :Returns:
+            * str: the same path below the staging folder
+        :Raises:
+            * Exception: path not in the destination folder
+        '''
+        if path != self.destdir and not path.startswith(
+                self.destdir.rstrip('/') + '/'):
+            raise Exception('\'{}\' not in destination path \'{}\''
+                            .format(path, self.destdir))
+        relative = path[len(self.destdir):].lstrip('/')
+        return os.path.join(self.destdir, self.STAGING, relative)
+
     def dest_to_src(self, path):
         '''
         Converts a path in the destination folder to a tuple of possible paths
@@ -133,38 +183,437 @@ class Sync:
 
             return tuple(new_path)
 
+    def settings_for(self, path):
+        '''
+        Returns the settings a source file is synced with. Lossless files are
+        encoded with ``self.encode_settings``, everything else is copied.
+
+        :Args:
+            * path(str): path to a file in the source folder
+        :Returns:
+            * str: a description of the encoder settings
+        '''
+        if os.path.splitext(path)[1].lower() in self.lossless_extensions:
+            return self.encode_settings
+        return 'copy'
+
+    def record(self, path, audio=None):
+        '''
+        Records in the manifest that a source file has been synced. Does
+        nothing if there is no manifest.
+
+        :Args:
+            * path(str): path to a file in the source folder
+            * audio(str): (optional) checksum of the file's audio
+        '''
+        if self.manifest is not None:
+            self.manifest.record(path, os.stat(path), self.src_to_dest(path),
+                                 self.settings_for(path), audio)
+
+    def stage(self, path, audio=None):
+        '''
+        Records in the manifest's journal that the file made from a source
+        file is finished and waiting in the staging folder. Does nothing if
+        there is no manifest.
+
+        :Args:
+            * path(str): path to a file in the source folder
+            * audio(str): (optional) checksum of the file's audio
+        '''
+        if self.manifest is not None:
+            self.manifest.stage(path, os.stat(path), self.src_to_dest(path),
+                                self.settings_for(path), audio)
+            self.manifest.commit()
+
+    def staged(self, path):
+        '''
+        Tests whether the file made from a source file is already finished
+        and waiting in the staging folder, left there by an interrupted run.
+
+        :Args:
+            * path(str): path to a file in the source folder
+        :Returns:
+            * bool
+        '''
+        if self.manifest is None:
+            return False
+        dest = self.manifest.staged(path, os.stat(path),
+                                    self.settings_for(path))
+        return (dest is not None
+                and os.path.isfile(self.staging_path(dest)))
+
+    def clean_staging(self):
+        '''
+        Deletes files from the staging folder that cannot be used: files
+        that were being written when a run stopped, and files whose source
+        file has been deleted. Finished files stay, so that they can be
+        used by the next run.
+
+        :Returns:
+            * int: the number of files deleted
+        '''
+        root = os.path.join(self.destdir, self.STAGING)
+        journal = set()
+        if self.manifest is not None:
+            for dest, src in self.manifest.journal():
+                staged = self.staging_path(dest)
+                if os.path.isfile(staged) and os.path.exists(src):
+                    journal.add(staged)
+                else:
+                    self.manifest.unstage(dest, record=False)
+            self.manifest.commit()
+        if not os.path.isdir(root):
+            return 0
+
+        deleted = 0
+        for folder, subs, files in os.walk(root, topdown=False):
+            for name in files:
+                path = os.path.join(folder, name)
+                if path not in journal:
+                    os.unlink(path)
+                    deleted += 1
+            if folder != root and not os.listdir(folder):
+                os.rmdir(folder)
+        return deleted
+
+    def audio_unchanged(self, lossless_file):
+        '''
+        Tests whether only the tags of a lossless file have changed since it
+        was last encoded: its audio checksum matches the manifest, it would
+        be encoded with the same settings, and the encoded file still exists.
+
+        :Args:
+            * lossless_file(Lossless): the changed source file
+        :Returns:
+            * bool: True if re-copying the tags is enough
+        '''
+        if self.manifest is None:
+            return False
+        src = lossless_file.filename
+        audio = lossless_file.audio_md5()
+        if audio is None:
+            return False
+        return (self.manifest.audio(src, self.settings_for(src)) == audio
+                and os.path.isfile(self.src_to_dest(src)))
+
+    def find_move(self, file_, claimed=()):
+        '''
+        Looks for the file that a new source file was moved or renamed
+        from: a file recorded in the manifest with the same settings that is
+        no longer in the source folder, and whose file in the destination
+        folder is still there. Files are matched by inode, size and mtime,
+        and lossless files also by the MD5 signature of their audio, in
+        which case their tags may have changed.
+
+        :Args:
+            * file_(FileClass): a file that is new in the source folder
+            * claimed(container(str)): (optional) files in the destination
+                folder already taken by other moves
+        :Returns:
+            * None: nothing matches, or there is no manifest
+            * Move: the old source file, its file in the destination folder
+                and whether the source file is unchanged (``exact``)
+        '''
+        if self.manifest is None:
+            return None
+        src = file_.filename
+        audio = None
+        if isinstance(file_, abstract.Lossless):
+            audio = file_.audio_md5()
+        destdir = self.destdir.rstrip('/') + '/'
+        for old_src, old_dest, exact in self.manifest.moved_from(
+                os.stat(src), self.settings_for(src), audio):
+            if (old_src == src or old_dest in claimed
+                or not old_dest.startswith(destdir)
+                or os.path.lexists(old_src)
+                or not os.path.isfile(old_dest)):
+                continue
+            return Move(old_src, old_dest, exact)
+        return None
+
+    def find_folder_move(self, s_root, moves):
+        '''
+        Tests whether a whole directory was moved or renamed in the source
+        folder, so that its folder in the destination folder can be renamed
+        in one step: every file of the new directory was moved from the
+        same directory, which no longer exists, the old folder in the
+        destination folder holds exactly their files under the same names,
+        and the new folder does not exist yet.
+
+        :Args:
+            * s_root(str): a directory in the source folder
+            * moves(list(tuple(str, Move))): every file of the directory
+                that is synced, and the move found for it
+        :Returns:
+            * None: the files have to be moved one by one
+            * str: the folder in the destination folder to rename
+        '''
+        d_root = self.src_to_dest(s_root)
+        if (not moves or os.path.lexists(d_root)
+            or os.path.lexists(self.staging_path(d_root))):
+            return None
+        origins = set(os.path.dirname(move.dest) for __, move in moves)
+        s_origins = set(os.path.dirname(move.src) for __, move in moves)
+        if len(origins) != 1 or len(s_origins) != 1:
+            return None
+        origin = origins.pop()
+        if origin == self.destdir or os.path.isdir(s_origins.pop()):
+            return None
+        names = set()
+        for src, move in moves:
+            name = os.path.basename(move.dest)
+            if name != self._dest_name(os.path.basename(src)):
+                return None
+            names.add(name)
+        try:
+            found = set(os.listdir(origin))
+        except OSError:
+            return None
+        # A cover written by artwork.Artwork goes along with the album
+        found.discard(self.cover_name)
+        return origin if found == names else None
+
+    def _dest_key(self, name):
+        '''
+        Returns the key used to match a file name in the destination folder.
+        Extensions are compared case insensitively.
+        '''
+        base, ext = os.path.splitext(name)
+        return (base, ext.lower())
+
+    def _dest_name(self, name):
+        '''
+        Returns the name a source file will have in the destination folder.
+        '''
+        base, ext = os.path.splitext(name)
+        if ext.lower() in self.lossless_extensions:
+            return base + self.encode_class_extension
+        return name
+
+    def _scan(self, path):
+        '''
+        Lists a directory. The listing recorded in the manifest is used when
+        the directory's mtime has not changed.
+
+        :Args:
+            * path(str): absolute path to a directory
+        :Returns:
+            * None: the directory does not exist
+            * tuple(list(str), list(str), dict(str: os.DirEntry), bool): the
+                names of the subdirectories and files, the ``DirEntry`` of
+                each name, and whether the directory was actually listed
+                rather than taken from the manifest
+        '''
+        manifest = self.manifest
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if not os.path.isdir(path):
+            return None
+
+        if manifest is not None:
+            listing = manifest.listing(path, mtime)
+            if listing is not None:
+                return listing + ({}, False)
+
+        subs, files, entries = [], [], {}
+        with self.metrics.stage('scan'), os.scandir(path) as iterator:
+            for entry in iterator:
+                if entry.is_dir(follow_symlinks=False):
+                    subs.append(entry.name)
+                elif not entry.is_dir():
+                    files.append(entry.name)
+                else:
+                    continue
+                entries[entry.name] = entry
+
+        if manifest is not None:
+            manifest.set_listing(path, mtime, subs, files)
+        return (subs, files, entries, True)
+
+    def _walk_source(self, roots=None, scan=None):
+        '''
+        Walks the source folder, or the given parts of it, scanning
+        ``scan_jobs`` directories at once. Directories are produced as soon
+        as they have been scanned, each before its subdirectories.
+        Directories that no longer exist are skipped.
+
+        :Args:
+            * roots(iter(tuple(str, bool))): (optional) directories to walk,
+                each with whether its subdirectories are walked too
+            * scan(callable): (optional) lists a directory, see walk.walk().
+                Defaults to _scan().
+        :Returns:
+            * generator(str, tuple): each directory and what ``scan``
+                returned for it
+        '''
+        if roots is None:
+            roots = [(self.srcdir, True)]
+        return walk.walk(self.collapse_roots(roots), scan or self._scan,
+                         self.scan_jobs)
+
+    def collapse_roots(self, roots):
+        '''
+        Merges a list of directories to walk so that no directory is walked
+        twice: a directory listed more than once is walked recursively if
+        any entry asks for it, and directories below a recursive one are
+        dropped.
+
+        :Args:
+            * roots(iter(tuple(str, bool))): directories in the source
+                folder, each with whether its subdirectories are walked too
+        :Returns:
+            * list(tuple(str, bool)): the merged list, sorted by path
+        :Raises:
+            * Exception: a directory is not in the source folder
+        '''
+        merged = {}
+        for path, recursive in roots:
+            path = os.path.abspath(path)
+            if (path != self.srcdir
+                and not path.startswith(self.srcdir.rstrip('/') + '/')):
+                raise Exception('\'{}\' not in source path {}'
+                                .format(path, self.srcdir))
+            merged[path] = merged.get(path, False) or recursive
+        trees = [path.rstrip('/') + '/' for path, recursive in merged.items()
+                 if recursive]
+        return [(path, recursive) for path, recursive in sorted(merged.items())
+                if not any(path.startswith(tree) for tree in trees)]
+
+    def _diff_directory(self, s_root, s_subs, s_files, stat, deletes,
+                        d_listing=None):
+        '''
+        Compares one directory of the source folder with its counterpart in
+        the destination folder.
+
+        :Args:
+            * s_root(str): the directory in the source folder
+            * s_subs(list(str)): names of its subdirectories
+            * s_files(list(str)): names of its files
+            * stat(callable): returns the stat of a file in ``s_root`` given
+                its name
+            * deletes(bool): also produce DELETE and DELETE_DIR actions
+            * d_listing(tuple): (optional) the destination directory as
+                returned by _scan(), if it has been listed already
+        :Returns:
+            * generator(Action)
+        '''
+        manifest = self.manifest
+        d_root = self.src_to_dest(s_root)
+        destination = None
+
+        def dest_files():
+            # The destination is only listed when it is actually needed
+            nonlocal destination
+            if destination is None:
+                listing = d_listing or self._scan(d_root) or ([], [], {},
+                                                              False)
+                names = {}
+                for name in listing[1]:
+                    names[self._dest_key(name)] = name
+                destination = (listing[0], names, listing[2])
+            return destination
+
+        expected = set()
+        if self.cover_name is not None and any(
+                os.path.splitext(name)[1].lower() in self.lossless_extensions
+                for name in s_files):
+            expected.add(self._dest_key(self.cover_name))
+        for name in s_files:
+            s_file = os.path.join(s_root, name)
+            d_name = self._dest_name(name)
+            d_file = os.path.join(d_root, d_name)
+            key = self._dest_key(d_name)
+            expected.add(key)
+
+            s_stat = stat(name)
+            settings = self.settings_for(s_file)
+
+            current = None
+            if manifest is not None:
+                current = manifest.is_current(s_file, s_stat, settings)
+
+            # The manifest is only trusted while the file it recorded is
+            # still there. The listing is taken from the manifest too, until
+            # the destination directory's mtime changes.
+            __, d_names, d_entries = dest_files()
+            existing = d_names.get(key)
+            if existing is None:
+                yield Action(ADD, s_file, d_file)
+                continue
+            if current:
+                continue
+
+            if current is None:
+                d_entry = d_entries.get(existing)
+                d_stat = (d_entry.stat() if d_entry
+                          else os.stat(os.path.join(d_root, existing)))
+                # A hard or symbolic link to the source file is always up
+                # to date, whatever its timestamps say.
+                if (os.path.samestat(s_stat, d_stat)
+                    or s_stat.st_mtime <= d_stat.st_mtime):
+                    if manifest is not None:
+                        manifest.record(s_file, s_stat, d_file, settings)
+                    continue
+            yield Action(UPDATE, s_file, d_file)
+
+        if deletes:
+            d_subs, d_names, __ = dest_files()
+            for key, name in sorted(d_names.items()):
+                if key in expected:
+                    continue
+                if (d_root == self.destdir
+                    and name.startswith(manifest_module.Manifest.NAME)):
+                    continue
+                yield Action(DELETE, None, os.path.join(d_root, name))
+            s_sub_names = set(s_subs)
+            for name in sorted(d_subs):
+                if d_root == self.destdir and name == self.STAGING:
+                    continue
+                if name not in s_sub_names:
+                    yield Action(DELETE_DIR, None, os.path.join(d_root, name))
+
+    def diff(self, deletes=True):
+        '''
+        Walks the source and destination folders in lockstep and produces the
+        actions needed to make the destination folder match the source
+        folder. All actions for a directory are produced together, additions
+        and updates first.
+
+        A source file is up to date if the manifest says so and its file in
+        the destination folder still exists. Files unknown to the manifest
+        are compared against the mtime of the matching file in the
+        destination folder, and recorded if they are up to date.
+
+        :Args:
+            * deletes(bool): also produce DELETE and DELETE_DIR actions for
+                files and directories that are not in the source folder
+        :Returns:
+            * generator(Action): ``Action(kind, src, dest)`` tuples
+        '''
+        for __, action in diff_all([self], deletes):
+            yield action
+
     def not_in_destination(self):
         '''
         all files in the source folder that are not in the destination folder
         or that have newer mtimes than in the destination folder.
         Each iteration searches a new subdirectory of the source folder.
 
+        When a manifest is used, files it knows about are compared against
+        their recorded size, mtime, inode and encoder settings instead of
+        against the destination folder.
+
         :Returns:
             * tuple(str): a list of filenames in the source directory that
                 are either not present in the destination folder, or have
                 modification times older than those in the source directory.
         '''
-        walker = os.walk(self.srcdir)
-
-        for root, __, files in walker:
-            source_files = []
-            files_not_in_dest = []
-
-            for file in files:
-                absolute_path = os.path.join(root, file)
-                source_files.append(absolute_path)
-
-            for s_file in source_files:
-                destination_file = self.src_to_dest(s_file)
-                if not os.path.isfile(destination_file):
-                    files_not_in_dest.append(s_file)
-                else:  # if source file has been modified
-                    if (os.path.getmtime(s_file)
-                        > os.path.getmtime(destination_file)):
-                        files_not_in_dest.append(s_file)
-
-            if files_not_in_dest:
-                yield tuple(files_not_in_dest)
+        actions = self.diff(deletes=False)
+        for __, group in itertools.groupby(
+                actions, key=lambda action: os.path.dirname(action.src)):
+            yield tuple(action.src for action in group)
 
     def not_in_source(self):
         '''
@@ -177,50 +626,15 @@ class Sync:
                 paths pointing to subdirectories and files in the destination
                 folder but not in the source folder
         '''
-        walker = os.walk(self.destdir)
-
-        for root, subs, files in walker:
-            subs_not_in_src = []
-            files_not_in_src = []
-
-            if subs:
-                for sub in subs:
-                    sub_abs_path = os.path.join(root, sub)
-                    if not os.path.isdir(
-                        self.dest_to_src(sub_abs_path)[0]
-                    ):
-                        subs_not_in_src.append(sub_abs_path)
-
-            if files:
-                for file in files:
-                    file_abs_path = os.path.join(root, file)
-                    file_dir = os.path.dirname(file_abs_path)
-                    src_dir = self.dest_to_src(file_dir)[0]
-                    file_exists = False
-
-                    if os.path.isdir(src_dir):
-                        possible_files = self.dest_to_src(file_abs_path)
-                        if possible_files:
-                            possible_base_ext = (os.path.splitext(pf)
-                                                 for pf in possible_files)
-                            src_files = (os.path.join(src_dir, f)
-                                         for f in os.listdir(src_dir))
-                            source_file_base_ext = [os.path.splitext(p)
-                                                    for p in src_files]
-                            # Test if possible source file exits using a
-                            # case insensitive file extension
-                            for p_base, p_ext in possible_base_ext:
-                                for sf_base, sf_ext in source_file_base_ext:
-                                    if (sf_base == p_base
-                                        and re.search(p_ext,
-                                                      sf_ext,
-                                                      re.IGNORECASE)):
-                                        file_exists = True
-
-                    if not file_exists:
-                        files_not_in_src.append(file_abs_path)
-            if (subs_not_in_src) or (files_not_in_src):
-                yield (tuple(subs_not_in_src), tuple(files_not_in_src))
+        actions = (action for action in self.diff()
+                   if action.kind in (DELETE, DELETE_DIR))
+        for __, group in itertools.groupby(
+                actions, key=lambda action: os.path.dirname(action.dest)):
+            group = list(group)
+            yield (tuple(action.dest for action in group
+                         if action.kind == DELETE_DIR),
+                   tuple(action.dest for action in group
+                         if action.kind == DELETE))
 
     @classmethod
     def load_cls_objs(self, paths):
@@ -250,3 +664,81 @@ class Sync:
     def load_file(self, path):
         path = self.load_cls_objs([path])
         return path[0]
+
+
+def diff_all(syncs, deletes=True, roots=None):
+    '''
+    Compares one source folder against several destination folders. The
+    source folder is walked and stat'd once and each directory is compared
+    with its counterpart in every destination folder in turn, so all actions
+    for a source directory are produced together.
+
+    ``roots`` limits the comparison to the directories that are known to
+    have changed. A directory that was deleted or moved away is removed
+    from the destination folders by comparing its parent.
+
+    :Args:
+        * syncs(list(Sync)): Sync objects sharing the same source folder.
+            The manifest of the first one is used to skip listing unchanged
+            source directories, and its ``scan_jobs`` sets how many
+            directories are listed and stat'd at once.
+        * deletes(bool): also produce DELETE and DELETE_DIR actions
+        * roots(iter(tuple(str, bool))): (optional) directories of the
+            source folder to compare, each with whether its subdirectories
+            are compared too. Defaults to the whole source folder.
+    :Returns:
+        * generator(Sync, Action): each action and the Sync it belongs to
+    :Raises:
+        * Exception: the Sync objects do not share a source folder
+    '''
+    # Listing directories is also counted separately as the scan stage
+    return syncs[0].metrics.iterate('diff', _diff_all(syncs, deletes, roots))
+
+
+def _diff_all(syncs, deletes, roots):
+    primary = syncs[0]
+    for sync_obj in syncs[1:]:
+        if sync_obj.srcdir != primary.srcdir:
+            raise Exception('"{}" and "{}" are different source folders'
+                            .format(sync_obj.srcdir, primary.srcdir))
+
+    def scan(s_root):
+        # Runs in the walker's threads, so that every call that waits on the
+        # filesystem overlaps with the others
+        listing = primary._scan(s_root)
+        if listing is None:
+            return None
+        s_subs, s_files, s_entries, fresh = listing
+        if fresh:
+            mtime = os.stat(s_root).st_mtime_ns
+            for sync_obj in syncs[1:]:
+                if sync_obj.manifest is not None:
+                    sync_obj.manifest.set_listing(s_root, mtime,
+                                                  s_subs, s_files)
+        stats = {}
+        with primary.metrics.stage('stat'):
+            for name in s_files:
+                entry = s_entries.get(name)
+                try:
+                    stats[name] = (entry.stat() if entry
+                                   else os.stat(os.path.join(s_root, name)))
+                except FileNotFoundError:
+                    pass  # raised again when it is compared
+        # Every destination directory is listed when looking for deletions
+        d_listings = [(sync_obj._scan(sync_obj.src_to_dest(s_root))
+                       or ([], [], {}, False)) if deletes else None
+                      for sync_obj in syncs]
+        return (s_subs, s_files, stats, d_listings)
+
+    for s_root, (s_subs, s_files, stats, d_listings) in primary._walk_source(
+            roots, scan):
+
+        def stat(name, s_root=s_root, stats=stats):
+            if name not in stats:
+                stats[name] = os.stat(os.path.join(s_root, name))
+            return stats[name]
+
+        for sync_obj, d_listing in zip(syncs, d_listings):
+            for action in sync_obj._diff_directory(s_root, s_subs, s_files,
+                                                   stat, deletes, d_listing):
+                yield sync_obj, action
@@ -0,0 +1,108 @@
+import unittest
+import os
+import shutil
+import io
+import threading
+
+from .. import artwork
+
+
+class _Track:
+    'A lossless file with an embedded cover.'
+
+    def __init__(self, filename, cover=None):
+        self.filename = filename
+        self._cover = cover
+
+    def cover(self):
+        return self._cover
+
+
+@unittest.skipIf(artwork.Image is None, 'Pillow is not installed')
+class Test_Artwork(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    album_art = os.path.join(resources, 'album_art')
+    tmp = os.path.join(resources, 'tmp')
+    cache_dir = os.path.join(tmp, 'cache')
+
+    def setUp(self):
+        os.mkdir(self.tmp)
+        with open(os.path.join(self.album_art, 'folder.jpg'), 'rb') as f:
+            self.jpeg = artwork.Cover(f.read(), 'image/jpeg')
+        with open(os.path.join(self.album_art, 'folder.gif'), 'rb') as f:
+            self.gif = artwork.Cover(f.read(), 'image/gif')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def size_of(self, cover):
+        return artwork.Image.open(io.BytesIO(cover.data)).size
+
+    def test_folder_cover(self):
+        self.assertEqual(artwork.folder_cover(self.album_art), self.jpeg)
+        self.assertIsNone(artwork.folder_cover(self.tmp))
+        self.assertIsNone(artwork.folder_cover(os.path.join(self.tmp, 'no')))
+
+    def test_mime_type(self):
+        self.assertEqual(artwork.mime_type(self.jpeg.data), 'image/jpeg')
+        self.assertEqual(artwork.mime_type(self.gif.data), 'image/gif')
+
+    def test_process(self):
+        work = artwork.Artwork(100, cache_dir=self.cache_dir)
+        resized = work.process(self.jpeg)
+        self.assertEqual(self.size_of(resized), (100, 100))
+        self.assertEqual(resized.mime, 'image/jpeg')
+        gif = work.process(self.gif)
+        self.assertEqual(gif.mime, 'image/gif', 'the format should be kept')
+        self.assertEqual(self.size_of(gif), (100, 100))
+
+        as_jpeg = work.process(self.gif, jpeg=True)
+        self.assertEqual(as_jpeg.mime, 'image/jpeg')
+
+        larger = artwork.Artwork(1000, cache_dir=self.cache_dir)
+        self.assertEqual(larger.process(self.jpeg).data, self.jpeg.data,
+                         'small images should not be re-encoded')
+        as_is = artwork.Artwork(cache_dir=self.cache_dir)
+        self.assertIs(as_is.process(self.jpeg), self.jpeg)
+
+    def test_process_cached(self):
+        work = artwork.Artwork(100, cache_dir=self.cache_dir)
+        threads = [threading.Thread(target=work.process, args=(self.jpeg,))
+                   for __ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stages = work.metrics.to_dict()['stages']
+        self.assertEqual(stages['art']['calls'], 1,
+                         'the image should be resized once')
+
+        # a later run reads it from the cache
+        again = artwork.Artwork(100, cache_dir=self.cache_dir)
+        self.assertEqual(again.process(self.jpeg), work.process(self.jpeg))
+        self.assertNotIn('art', again.metrics.to_dict()['stages'])
+
+    def test_cover(self):
+        work = artwork.Artwork(100, cache_dir=self.cache_dir)
+        embedded = _Track(os.path.join(self.tmp, 'a.flac'),
+                          (self.gif.data, self.gif.mime))
+        self.assertEqual(work.cover(embedded).mime, 'image/gif',
+                         'the embedded cover should come first')
+        in_folder = _Track(os.path.join(self.album_art, 'a.flac'))
+        self.assertEqual(work.cover(in_folder).mime, 'image/jpeg')
+        self.assertIsNone(work.cover(_Track(os.path.join(self.tmp,
+                                                         'a.flac'))))
+
+    def test_folder_image(self):
+        work = artwork.Artwork(cache_dir=self.cache_dir)
+        embedded = _Track(os.path.join(self.tmp, 'a.flac'),
+                          (self.gif.data, self.gif.mime))
+        data = work.folder_image([_Track(os.path.join(self.tmp, 'b.flac')),
+                                  embedded])
+        self.assertEqual(artwork.mime_type(data), 'image/jpeg')
+        self.assertIsNone(work.folder_image([]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+import asyncio
+import os
+import shutil
+import threading
+
+from .. import concurrency
+
+
+class Test_Concurrency(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    tmp = os.path.join(resources, 'tmp')
+
+    def setUp(self):
+        os.mkdir(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_cgroup_cpu_limit_v2(self):
+        missing = os.path.join(self.tmp, 'missing')
+        cpu_max = self.write('cpu.max', '150000 100000\n')
+        self.assertEqual(
+            concurrency.cgroup_cpu_limit(cpu_max, missing, missing), 2)
+
+        cpu_max = self.write('cpu.max', 'max 100000\n')
+        self.assertIsNone(
+            concurrency.cgroup_cpu_limit(cpu_max, missing, missing))
+
+    def test_cgroup_cpu_limit_v1(self):
+        missing = os.path.join(self.tmp, 'missing')
+        quota = self.write('cpu.cfs_quota_us', '300000')
+        period = self.write('cpu.cfs_period_us', '100000')
+        self.assertEqual(
+            concurrency.cgroup_cpu_limit(missing, quota, period), 3)
+
+        quota = self.write('cpu.cfs_quota_us', '-1')
+        self.assertIsNone(concurrency.cgroup_cpu_limit(missing, quota, period))
+
+    def test_available_cpus(self):
+        self.assertGreaterEqual(concurrency.available_cpus(), 1)
+
+    def test_Budget(self):
+        budget = concurrency.Budget(3)
+        self.assertEqual(budget.acquire(2), 2)
+        acquired = threading.Event()
+
+        def take():
+            budget.acquire(2)
+            acquired.set()
+
+        thread = threading.Thread(target=take)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1), 'only one slot is free')
+        budget.release(2)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def test_Budget_acquire_async(self):
+        budget = concurrency.Budget(2)
+        budget.acquire(2)
+
+        async def take():
+            return await budget.acquire_async(5)
+
+        async def main():
+            task = asyncio.ensure_future(take())
+            await asyncio.sleep(0.1)
+            self.assertFalse(task.done(), 'no slot is free')
+            # released from another thread
+            threading.Thread(target=budget.release, args=(2,)).start()
+            return await asyncio.wait_for(task, 5)
+
+        self.assertEqual(asyncio.run(main()), 2)
+
+    def test_Budget_trims_large_requests(self):
+        budget = concurrency.Budget(2)
+        self.assertEqual(budget.acquire(5), 2)
+        budget.release(2)
+        with budget.slots(2):
+            pass
+        self.assertEqual(budget.acquire(2), 2)
+
+    def test_Limits(self):
+        limits = concurrency.Limits(jobs=3, io_jobs=2)
+        self.assertEqual(limits.cpu.size, 3)
+        self.assertEqual(limits.io.size, 2)
+        self.assertEqual(limits.threads, 5)
+        self.assertRaises(ValueError, concurrency.Limits, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
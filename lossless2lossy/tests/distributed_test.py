@@ -0,0 +1,285 @@
+import unittest
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+
+from .. import agent
+from .. import distributed
+from .. import lossless2lossy
+from .. import mp3
+from .. import sync
+
+
+class Test_Distributed(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    workdir = os.path.join(resources, 'distributed')
+    srcdir = os.path.join(workdir, 'srcdir')
+    destdir = os.path.join(workdir, 'destdir')
+    flacfile = os.path.join(resources, r'flac/silence_16_44100.flac')
+    mp3file = os.path.join(resources,
+                           r'mp3/silence_16_44100_id3v11_id3v23.mp3')
+
+    def setUp(self):
+        os.makedirs(self.srcdir)
+        os.makedirs(self.destdir)
+        self.coordinator = distributed.Coordinator('localhost', 0,
+                                                   timeout=5,
+                                                   secret='secret')
+        self.agents = []
+        self.threads = []
+
+    def tearDown(self):
+        for agent_ in self.agents:
+            agent_.stop()
+        self.coordinator.close()
+        for thread in self.threads:
+            thread.join(5)
+        shutil.rmtree(self.workdir)
+
+    def start_agent(self, name, process, slots=2):
+        'Connects an agent that runs ``process`` for every job.'
+        agent_ = agent.Agent('localhost', self.coordinator.address[1],
+                             self.resources, self.destdir, slots=slots,
+                             name=name, process=process, heartbeat=0.5,
+                             secret='secret')
+        thread = threading.Thread(target=agent_.run,
+                                  kwargs={'reconnect': None})
+        thread.start()
+        self.agents.append(agent_)
+        self.threads.append(thread)
+        for __ in range(100):
+            if name in self.coordinator.agents:
+                return agent_
+            time.sleep(0.05)
+        self.fail('agent {} did not connect'.format(name))
+
+    def encoder(self, seen=None, name=None, delay=0.0):
+        'A stand-in for agent.encode() that copies an mp3 file.'
+        def process(job):
+            time.sleep(delay)
+            for output in job['outputs']:
+                os.makedirs(os.path.dirname(output['path']), exist_ok=True)
+                shutil.copyfile(self.mp3file, output['path'])
+            if seen is not None:
+                seen.append(name)
+            return None
+        return process
+
+    def outputs(self, name):
+        return [(mp3.Mp3, os.path.join(self.destdir, name + '.mp3'))]
+
+    def connect(self, secret='secret', hello=None):
+        '''
+        Connects a socket that answers the challenge with ``secret``, or
+        sends ``hello`` instead. Returns the socket, a reader for it and the
+        hello sent.
+        '''
+        sock = socket.create_connection(('localhost',
+                                         self.coordinator.address[1]))
+        self.addCleanup(sock.close)
+        sock.settimeout(5)
+        reader = sock.makefile('rb')
+        self.addCleanup(reader.close)
+        challenge = json.loads(reader.readline())
+        self.assertEqual(challenge['type'], 'challenge')
+        if hello is None:
+            nonces = (challenge['nonce'], distributed.new_nonce())
+            hello = {'type': 'hello', 'name': 'raw', 'slots': 1,
+                     'protocol': distributed.PROTOCOL, 'nonce': nonces[1],
+                     'proof': distributed.proof(secret, 'agent', nonces)}
+        sock.sendall(json.dumps(hello).encode('utf-8') + b'\n')
+        return sock, reader, hello
+
+    def test_secret(self):
+        with self.assertRaises(ValueError):
+            distributed.Coordinator('localhost', 0)
+        sock, __, __ = self.connect('wrong')
+        self.assertEqual(sock.recv(1), b'',
+                         'agents without the secret should be dropped')
+        self.assertEqual(self.coordinator.agents, [])
+
+    def test_replayed_hello(self):
+        __, reader, hello = self.connect()
+        welcome = json.loads(reader.readline())
+        self.assertEqual(welcome['type'], 'welcome')
+        self.assertNotIn('secret', json.dumps(hello) + json.dumps(welcome),
+                         'the secret should never be sent')
+
+        replayed, __, __ = self.connect(hello=hello)
+        self.assertEqual(replayed.recv(1), b'',
+                         'a hello overheard before should be refused')
+
+    def test_fake_coordinator(self):
+        server = socket.create_server(('localhost', 0))
+        self.addCleanup(server.close)
+        jobs = []
+
+        def fake():
+            sock, __ = server.accept()
+            with sock:
+                reader = sock.makefile('rb')
+                distributed.send(sock, threading.Lock(), {
+                    'type': 'challenge', 'protocol': distributed.PROTOCOL,
+                    'nonce': distributed.new_nonce()})
+                reader.readline()
+                distributed.send(sock, threading.Lock(), {
+                    'type': 'welcome', 'proof': 'guessed'})
+                distributed.send(sock, threading.Lock(), {
+                    'type': 'job', 'id': 1, 'src': self.flacfile,
+                    'outputs': []})
+                reader.readline()
+        thread = threading.Thread(target=fake)
+        thread.start()
+        agent_ = agent.Agent('localhost', server.getsockname()[1],
+                             self.resources, self.destdir,
+                             process=jobs.append, secret='secret')
+        with self.assertRaisesRegex(ConnectionError, 'secret'):
+            agent_.serve()
+        thread.join(5)
+        self.assertEqual(jobs, [], 'no job should be run')
+
+    def test_check_job(self):
+        job = {'type': 'job', 'id': 1, 'src': self.flacfile,
+               'outputs': [{'format': 'mp3', 'path': os.path.join(
+                   self.destdir, 'a.mp3')}]}
+        agent.check_job(job, self.resources, self.destdir)
+        for src, path in ((self.flacfile, '/tmp/a.mp3'),
+                          (self.flacfile,
+                           os.path.join(self.destdir, '..', 'a.mp3')),
+                          ('/etc/passwd', job['outputs'][0]['path']),
+                          (self.flacfile, 'a.mp3')):
+            refused = dict(job, src=src, outputs=[{'format': 'mp3',
+                                                   'path': path}])
+            with self.assertRaises(ValueError):
+                agent.check_job(refused, self.resources, self.destdir)
+
+    def test_refused_job(self):
+        jobs = []
+        self.coordinator.retries = 0
+        self.start_agent('careful', jobs.append)
+        future = self.coordinator.submit(
+            self.flacfile, [(mp3.Mp3, os.path.join(self.workdir, 'a.mp3'))])
+        with self.assertRaisesRegex(Exception, 'outside'):
+            future.result(10)
+        self.assertEqual(jobs, [])
+
+    def test_invalid_message(self):
+        sock, reader, __ = self.connect()
+        self.assertEqual(json.loads(reader.readline())['type'], 'welcome')
+        for __ in range(100):
+            if self.coordinator.agents:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.coordinator.agents, ['raw'])
+        sock.sendall(b'[]\n')
+        self.assertEqual(sock.recv(1), b'',
+                         'a message that is not an object ends the connection')
+        self.assertEqual(self.coordinator.agents, [])
+
+    def test_address(self):
+        self.assertEqual(distributed.parse_address('host:1234'),
+                         ('host', 1234))
+        self.assertEqual(distributed.parse_address('1234', 'default'),
+                         ('default', 1234))
+        with self.assertRaises(ValueError):
+            distributed.parse_address('host:port')
+
+    def test_encode_class_for(self):
+        self.assertIs(distributed.encode_class_for(
+            {'format': 'mp3', 'options': ['-V0']}), mp3.Mp3)
+        custom = distributed.encode_class_for(
+            {'format': 'mp3', 'options': ['-V2']})
+        self.assertEqual(custom.ENCODE_OPTIONS, ('-V2',))
+        self.assertEqual(distributed.format_of(custom), 'mp3')
+        with self.assertRaises(Exception):
+            distributed.format_of(object)
+
+    def test_spread_over_agents(self):
+        seen = []
+        self.start_agent('one', self.encoder(seen, 'one', 0.2))
+        self.start_agent('two', self.encoder(seen, 'two', 0.2))
+        futures = [self.coordinator.submit(self.flacfile,
+                                           self.outputs(str(i)))
+                   for i in range(8)]
+        for future in futures:
+            self.assertIsNone(future.result(10))
+        self.assertEqual(sorted(os.listdir(self.destdir)),
+                         sorted('{}.mp3'.format(i) for i in range(8)),
+                         'no attempt folders should be left behind')
+        self.assertEqual(set(seen), {'one', 'two'},
+                         'both agents should have been used')
+
+    def test_lost_agent(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def hang(job):
+            self.encoder()(job)
+            started.set()
+            release.wait(10)
+            return None
+
+        lost = self.start_agent('lost', hang, slots=1)
+        future = self.coordinator.submit(self.flacfile, self.outputs('a'))
+        self.assertTrue(started.wait(5))
+        seen = []
+        self.start_agent('spare', self.encoder(seen, 'spare'))
+        lost.stop()
+        self.assertIsNone(future.result(10))
+        release.set()
+        self.assertEqual(seen, ['spare'])
+        self.assertEqual(os.listdir(self.destdir), ['a.mp3'],
+                         'the lost attempt should be removed')
+
+    def test_failed_job(self):
+        attempts = []
+
+        def fail(job):
+            attempts.append(job['id'])
+            raise Exception('broken encoder')
+
+        self.coordinator.retries = 1
+        self.start_agent('broken', fail)
+        future = self.coordinator.submit(self.flacfile, self.outputs('a'))
+        with self.assertRaisesRegex(Exception, 'broken encoder'):
+            future.result(10)
+        self.assertEqual(len(attempts), 2, 'the job should be retried once')
+        self.assertEqual(os.listdir(self.destdir), [])
+
+    def test_cancel(self):
+        future = self.coordinator.submit(self.flacfile, self.outputs('a'))
+        self.coordinator.cancel()
+        with self.assertRaises(Exception):
+            future.result(5)
+
+    def test_Worker_remote(self):
+        album = os.path.join(self.srcdir, 'artist', 'album')
+        os.makedirs(album)
+        for track in range(4):
+            shutil.copyfile(self.flacfile,
+                            os.path.join(album, '{:02} track.flac'.format(
+                                track)))
+        seen = []
+        self.start_agent('one', self.encoder(seen, 'one'))
+        self.start_agent('two', self.encoder(seen, 'two'))
+
+        compare = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        worker = lossless2lossy.Worker(compare, delete=False,
+                                       remote=self.coordinator)
+        totals = worker.process()
+        self.assertEqual(sum(totals.values()), 4)
+        # the tracks have identical audio, which is only encoded once
+        self.assertEqual(len(seen), totals['flac'])
+        encoded = os.listdir(os.path.join(self.destdir, 'artist', 'album'))
+        self.assertEqual(sorted(encoded),
+                         ['{:02} track.mp3'.format(i) for i in range(4)])
+        self.assertFalse(os.listdir(os.path.join(self.destdir,
+                                                 sync.Sync.STAGING)))
+
+
+if __name__ == '__main__':
+    unittest.main()
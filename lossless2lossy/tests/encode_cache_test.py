@@ -0,0 +1,64 @@
+import unittest
+import os
+import shutil
+import time
+
+from .. import encode_cache
+
+
+class Test_EncodeCache(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    tmp = os.path.join(resources, 'tmp')
+    cache_dir = os.path.join(tmp, 'cache')
+    mp3file = os.path.join(resources,
+                           r'mp3/silence_16_44100_id3v11_id3v23.mp3')
+
+    def setUp(self):
+        os.mkdir(self.tmp)
+        self.encoded = os.path.join(self.tmp, 'encoded.mp3')
+        shutil.copyfile(self.mp3file, self.encoded)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def key(self, n):
+        return ('md5-{}'.format(n), 44100, 'Mp3 -V0')
+
+    def test_get_put(self):
+        cache = encode_cache.EncodeCache(self.cache_dir)
+        copy = os.path.join(self.tmp, 'copy.mp3')
+        self.assertIsNone(cache.get(self.key(1), copy))
+        self.assertFalse(os.path.exists(copy))
+
+        cache.put(self.key(1), self.encoded, '{"loudness": 1}')
+        self.assertEqual(cache.get(self.key(1), copy),
+                         {'loudness': '{"loudness": 1}'})
+        with open(copy, 'rb') as f, open(self.mp3file, 'rb') as original:
+            self.assertEqual(f.read(), original.read())
+        self.assertEqual(cache.hits, 1)
+        self.assertIsNone(cache.get(('md5-1', 44100, 'Mp3 -V2'), copy),
+                          'other settings should not match')
+        self.assertIn('cache', cache.metrics.to_dict()['stages'])
+
+    def test_evict(self):
+        size = os.path.getsize(self.encoded)
+        cache = encode_cache.EncodeCache(self.cache_dir,
+                                         max_bytes=size * 2.5)
+        copy = os.path.join(self.tmp, 'copy.mp3')
+        cache.put(self.key(1), self.encoded)
+        cache.put(self.key(2), self.encoded)
+        # the first file was used last
+        past = time.time() - 60
+        os.utime(cache._path(self.key(2)), (past, past))
+        self.assertIsNotNone(cache.get(self.key(1), copy))
+        cache.put(self.key(3), self.encoded)
+
+        self.assertIsNone(cache.get(self.key(2), copy),
+                          'the least recently used file should be removed')
+        for n in (1, 3):
+            self.assertIsNotNone(cache.get(self.key(n), copy))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import unittest
+import asyncio
+import concurrent.futures
+import os
+import shutil
+import sys
+import threading
+import time
+
+from .. import engine
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+# Writes 1 MB to stdout
+PRODUCE = python('import sys; sys.stdout.buffer.write(b"x" * 1000000)')
+SLEEP = python('import time; time.sleep(60)')
+
+
+def consume(path):
+    return python('import sys, shutil; shutil.copyfileobj(sys.stdin.buffer,'
+                  ' open({!r}, "wb"))'.format(path))
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class Test_Pipeline(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    tmp = os.path.join(resources, 'tmp')
+
+    def setUp(self):
+        os.mkdir(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def output(self, n):
+        return os.path.join(self.tmp, 'out{}'.format(n))
+
+    def test_Pipeline_pipe(self):
+        pipeline = engine.Pipeline(PRODUCE, [consume(self.output(1))])
+        asyncio.run(pipeline.run())
+        self.assertEqual(os.path.getsize(self.output(1)), 1000000)
+        self.assertEqual([process.returncode
+                          for process in pipeline.processes], [0, 0])
+        self.assertGreater(pipeline.processes[0].cpu_seconds, 0)
+
+    def test_Pipeline_copy(self):
+        heard = []
+        pipeline = engine.Pipeline(
+            PRODUCE, [consume(self.output(1)), consume(self.output(2))],
+            [lambda data: heard.append(len(data))])
+        asyncio.run(pipeline.run())
+        for n in (1, 2):
+            self.assertEqual(os.path.getsize(self.output(n)), 1000000)
+        self.assertEqual(sum(heard), 1000000)
+        self.assertEqual(pipeline.bytes, 1000000)
+
+    def test_Pipeline_listeners_off_loop(self):
+        threads = set()
+        pipeline = engine.Pipeline(
+            PRODUCE, [consume(self.output(1))],
+            [lambda data: threads.add(threading.get_ident())])
+
+        async def run():
+            await pipeline.run()
+            return threading.get_ident()
+        loop_thread = asyncio.run(run())
+        self.assertTrue(threads)
+        self.assertNotIn(loop_thread, threads,
+                         'listeners should run in the executor')
+
+    def test_Pipeline_failure(self):
+        fail = python('import sys; sys.stderr.write("bad input\\n");'
+                      ' sys.exit(3)')
+        pipeline = engine.Pipeline(SLEEP, [fail, consume(self.output(1))],
+                                   [lambda data: None])
+        started = time.monotonic()
+        with self.assertRaises(engine.ProcessError) as raised:
+            asyncio.run(pipeline.run())
+        self.assertLess(time.monotonic() - started, 30,
+                        'the decoder should be killed')
+        self.assertEqual(raised.exception.returncode, 3)
+        self.assertIn('bad input', str(raised.exception))
+        for process in pipeline.processes:
+            self.assertIsNotNone(process.returncode,
+                                 'every process should be reaped')
+            self.assertFalse(alive(process.popen.pid))
+
+
+class Test_Engine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = engine.Engine()
+
+    def tearDown(self):
+        self.engine.close()
+
+    def test_Engine_cancel(self):
+        pipelines = [engine.Pipeline(SLEEP, [python('pass')])
+                     for __ in range(3)]
+        futures = [self.engine.submit(pipeline.run)
+                   for pipeline in pipelines]
+        time.sleep(0.5)
+        self.engine.cancel()
+        for future in futures:
+            with self.assertRaises(concurrent.futures.CancelledError):
+                future.result(timeout=30)
+        for pipeline in pipelines:
+            for process in pipeline.processes:
+                self.assertIsNotNone(process.returncode)
+
+        with self.assertRaises(concurrent.futures.CancelledError):
+            self.engine.run(asyncio.sleep, 0)
+        self.engine.reset()
+        self.assertEqual(self.engine.run(asyncio.sleep, 0, 'done'), 'done')
+
+    def test_Engine_close(self):
+        pipeline = engine.Pipeline(SLEEP, [python('pass')])
+        self.engine.submit(pipeline.run)
+        time.sleep(0.5)
+        self.engine.close()
+        self.assertTrue(pipeline.processes)
+        for process in pipeline.processes:
+            self.assertIsNotNone(process.returncode,
+                                 'close should reap every process')
+
+    def test_run_command_failure(self):
+        with self.assertRaises(engine.ProcessError) as raised:
+            engine.run_command(python('import sys; sys.exit(2)'),
+                               self.engine)
+        self.assertEqual(raised.exception.returncode, 2)
+        engine.run_command(python('pass'))
+
+    def test_run_command_cancel(self):
+        processes = []
+        real = engine.Process
+
+        def record(*args, **kwargs):
+            processes.append(real(*args, **kwargs))
+            return processes[-1]
+        raised = []
+
+        def run():
+            try:
+                engine.run_command(SLEEP, self.engine)
+            except concurrent.futures.CancelledError as e:
+                raised.append(e)
+        engine.Process = record
+        try:
+            thread = threading.Thread(target=run)
+            thread.start()
+            time.sleep(0.5)
+            self.engine.cancel()
+            thread.join(30)
+        finally:
+            engine.Process = real
+        self.assertTrue(raised)
+        self.assertIsNotNone(processes[0].returncode,
+                             'cancel should kill the command')
+        self.assertFalse(alive(processes[0].popen.pid))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import shutil
+
+from .. import fileops
+
+
+class Test_Fileops(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    tmp = os.path.join(resources, 'tmp')
+    artfile = os.path.join(resources, 'album_art', 'folder.jpg')
+
+    def setUp(self):
+        os.mkdir(self.tmp)
+        self.src = os.path.join(self.tmp, 'src.jpg')
+        self.dst = os.path.join(self.tmp, 'dst.jpg')
+        shutil.copyfile(self.artfile, self.src)
+        os.utime(self.src, ns=(1000000000, 2000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_copy_file(self):
+        fileops.copy_file(self.src, self.dst)
+        with open(self.src, 'rb') as f:
+            expected = f.read()
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        self.assertEqual(os.stat(self.dst).st_mtime_ns, 2000000000,
+                         'timestamps should be preserved')
+
+    def test_copy_file_replaces(self):
+        with open(self.dst, 'wb') as f:
+            f.write(b'\0' * (os.path.getsize(self.src) * 2))
+        fileops.copy_file(self.src, self.dst)
+        self.assertEqual(os.path.getsize(self.dst),
+                         os.path.getsize(self.src))
+
+    def test_same_content(self):
+        self.assertFalse(fileops.same_content(self.src, self.dst),
+                         'missing destination')
+        fileops.copy_file(self.src, self.dst)
+        self.assertTrue(fileops.same_content(self.src, self.dst))
+
+        with open(self.dst, 'r+b') as f:
+            f.write(b'\0')
+        self.assertFalse(fileops.same_content(self.src, self.dst),
+                         'same size, different contents')
+
+    def test_move(self):
+        with open(self.dst, 'wb') as f:
+            f.write(b'old')
+        inode = os.stat(self.src).st_ino
+        fileops.move(self.src, self.dst)
+        self.assertFalse(os.path.exists(self.src))
+        self.assertEqual(os.stat(self.dst).st_ino, inode,
+                         'a file should be renamed, not copied')
+
+    def test_link_file_hardlink(self):
+        mode = fileops.link_file(self.src, self.dst, fileops.fallbacks(
+            fileops.HARDLINK))
+        self.assertEqual(mode, fileops.HARDLINK)
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+        self.assertTrue(fileops.is_link(self.src, self.dst))
+
+    def test_link_file_symlink(self):
+        mode = fileops.link_file(self.src, self.dst, [fileops.SYMLINK])
+        self.assertEqual(mode, fileops.SYMLINK)
+        self.assertEqual(os.readlink(self.dst), self.src)
+
+    def test_link_file_reflink(self):
+        mode = fileops.link_file(self.src, self.dst)
+        self.assertIn(mode, fileops.LINK_MODES,
+                      'reflink should fall back when not supported')
+        self.assertTrue(fileops.same_content(self.src, self.dst))
+
+    def test_copy_file_over_link(self):
+        fileops.link_file(self.src, self.dst, [fileops.HARDLINK])
+        fileops.copy_file(self.src, self.dst)
+        self.assertFalse(fileops.is_link(self.src, self.dst),
+                         'the link should be replaced, not written through')
+        self.assertTrue(fileops.same_content(self.src, self.dst))
+
+
+if __name__ == "__main__":
+    unittest.main()
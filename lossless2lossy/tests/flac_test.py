@@ -36,6 +36,13 @@ class Test_Flac(unittest.TestCase):
             self.assertTrue(os.path.isfile(out_file), 'out_file should exist')
             self.assertEqual(mimetypes.guess_type(out_file)[0], 'audio/x-wav', 'outfile should be a wav file')
 
+    def test_flac_decoder(self):
+        cd_quality = flac.Flac(os.path.join(self.flac_path, 'silence_16_44100.flac'))
+        self.assertEqual(cd_quality.decoder(), 'flac', 'should not need resampling')
+        for name in ('silence_16_48000.flac', 'silence_24_44100.flac', 'silence_24_96000.flac'):
+            hi_res = flac.Flac(os.path.join(self.flac_path, name))
+            self.assertEqual(hi_res.decoder(), 'sox', 'should be resampled or dithered')
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -2,9 +2,14 @@ import unittest
 import os
 import shutil
 
+from .. import artwork
+from .. import encode_cache
+from .. import engine
 from .. import lossless2lossy
 from .. import flac
+from .. import manifest
 from .. import mp3
+from .. import scheduler
 from .. import sync
 
 
@@ -13,6 +18,7 @@ class Test_Lossless2lossy(unittest.TestCase):
     resources = os.path.join(testdir, 'resources')
     srcdir = os.path.join(resources, 'srcdir')
     destdir = os.path.join(resources, 'destdir')
+    destdir2 = os.path.join(resources, 'destdir2')
     mp3file = os.path.join(resources, r'mp3/silence_16_44100_id3v11_id3v23.mp3')
     flacfile = os.path.join(resources, r'flac/silence_16_44100.flac')
     album_art_dir = os.path.join(resources, 'album_art')
@@ -22,7 +28,7 @@ class Test_Lossless2lossy(unittest.TestCase):
 
 
     def setUp(self):
-        for path in [self.srcdir, self.destdir]:
+        for path in [self.srcdir, self.destdir, self.destdir2]:
             os.mkdir(path)
 
         def mkalbum(name, path, file, tracks):
@@ -51,6 +57,17 @@ class Test_Lossless2lossy(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.srcdir)
         shutil.rmtree(self.destdir)
+        shutil.rmtree(self.destdir2)
+
+    def commit(self, worker, dst, target=None, src=None):
+        '''
+        Tags ``dst`` with the tags of ``src`` and moves its album out of the
+        staging folder.
+        '''
+        folder = os.path.dirname(dst)
+        if src is not None:
+            worker.finalize_album(folder, target, [(dst, src)])
+        return worker.commit_album(folder, target)
 
     def test_Worker_copy(self):
         worker = lossless2lossy.Worker(self.sync_obj, delete=False)
@@ -59,21 +76,207 @@ class Test_Lossless2lossy(unittest.TestCase):
 
         expected_dst = self.sync_obj.src_to_dest(mp3file)
         src, dst, lossy = worker.copy(mp3file)
+        self.commit(worker, dst)
 
         self.assertEqual(mp3file.filename, src, 'src files should match')
         self.assertEqual(expected_dst, dst, 'dst files should match')
         self.assertTrue(os.path.isfile(lossy), 'file should have been copied')
 
+    def test_Worker_copy_unchanged(self):
+        worker = lossless2lossy.Worker(self.sync_obj, delete=False)
+        mp3file = self.sync_obj.load_file(self.s_mp3[1][0])
+        __, dst, __ = worker.copy(mp3file)
+        self.commit(worker, dst)
+        self.assertEqual(worker.copies_skipped, 0)
+
+        src, dst, lossy = worker.copy(mp3file)
+        self.assertEqual(worker.copies_skipped, 1,
+                         'an identical file should not be copied again')
+        self.assertEqual(os.stat(src).st_mtime, os.stat(dst).st_mtime)
+
+    def test_Worker_copy_link_mode(self):
+        worker = lossless2lossy.Worker(self.sync_obj, delete=False,
+                                       link_mode='hardlink')
+        art = self.sync_obj.load_file(self.s_mp3[2])
+        __, dst, __ = worker.copy(art)
+        self.commit(worker, dst)
+        self.assertTrue(os.path.samefile(art.filename, dst))
+
+        mp3file = self.sync_obj.load_file(self.s_mp3[1][0])
+        __, dst, __ = worker.copy(mp3file)
+        self.commit(worker, dst)
+        self.assertFalse(os.path.samefile(mp3file.filename, dst),
+                         'lossy files should never be hard linked')
+
     def test_Worker_encode(self):
         worker = lossless2lossy.Worker(self.sync_obj, delete=False)
         flacfile = self.s_new[1][0]
         flacfile = self.sync_obj.load_file(flacfile)
 
         dst, encoded = worker.encode(flacfile)
+        self.commit(worker, dst)
 
         self.assertIsInstance(encoded, mp3.Mp3, 'encoded file should be an MP3')
         self.assertTrue(os.path.isfile(dst), 'encoded file should exist on the filesystem')
 
+    def test_Worker_retag(self):
+        worker = lossless2lossy.Worker(self.sync_obj, delete=False)
+        flacfile = self.sync_obj.load_file(self.s_new[1][0])
+        dst, encoded = worker.encode(flacfile)
+        self.commit(worker, dst)
+
+        flacfile['title'] = 'retagged'
+        flacfile.save()
+        flacfile = self.sync_obj.load_file(flacfile.filename)
+        dst, retagged = worker.retag(flacfile)
+        self.commit(worker, dst, src=flacfile)
+
+        self.assertEqual(mp3.Mp3(dst)['title'], ['retagged'])
+
+    def test_Worker_encode_many(self):
+        other = sync.Sync(self.srcdir, self.destdir2,
+                          mp3.Mp3.with_options(['-V2']))
+        worker = lossless2lossy.Worker(self.sync_obj, targets=[other])
+        flacfile = self.sync_obj.load_file(self.s_new[1][0])
+
+        results = worker.encode_many(flacfile, worker.targets)
+
+        self.assertEqual([dst for dst, __ in results],
+                         [self.sync_obj.src_to_dest(flacfile.filename),
+                          other.src_to_dest(flacfile.filename)])
+        for target, (dst, encoded) in zip(worker.targets, results):
+            self.commit(worker, dst, target)
+            self.assertIsInstance(encoded, mp3.Mp3)
+            self.assertTrue(os.path.isfile(dst))
+
+    def test_Worker_start_encode(self):
+        worker = lossless2lossy.Worker(self.sync_obj)
+        flacfile = self.sync_obj.load_file(self.s_new[1][0])
+
+        deferred = worker.start_encode(flacfile, worker.targets)
+
+        self.assertIsInstance(deferred, scheduler.Deferred,
+                              'no thread should wait for the codecs')
+        [(dst, encoded)] = deferred.resolve()
+        self.commit(worker, dst)
+        self.assertIsInstance(encoded, mp3.Mp3)
+        self.assertTrue(os.path.isfile(dst))
+        self.assertEqual(worker.limits.cpu._free, worker.limits.cpu.size,
+                         'the CPU slots should be released')
+
+    def test_Worker_finalize_album(self):
+        worker = lossless2lossy.Worker(self.sync_obj)
+        sources = []
+        for track in self.s_new[1][:2]:
+            flacfile = self.sync_obj.load_file(track)
+            flacfile['title'] = os.path.basename(track)
+            flacfile.save()
+            flacfile = self.sync_obj.load_file(track)
+            dst, __ = worker.encode(flacfile)
+            sources.append((dst, flacfile))
+        folder = os.path.dirname(sources[0][0])
+
+        worker.finalize_album(folder, sources=sources)
+
+        for dst, __ in sources:
+            self.assertFalse(os.path.exists(dst),
+                             'tags should be written before the commit')
+        self.assertEqual(worker.commit_album(folder),
+                         [dst for dst, __ in sources])
+        for dst, flacfile in sources:
+            self.assertEqual(mp3.Mp3(dst)['title'], flacfile['title'])
+            self.assertTrue(mp3.Mp3._has_v1_tags(dst))
+
+    def test_Worker_staging(self):
+        self.sync_obj.manifest = manifest.Manifest.in_directory(self.destdir)
+        worker = lossless2lossy.Worker(self.sync_obj)
+        flacfile = self.sync_obj.load_file(self.s_new[1][0])
+        dst, encoded = worker.encode(flacfile)
+
+        self.assertFalse(os.path.exists(dst),
+                         'nothing should be visible before the album is done')
+        self.assertEqual(encoded.filename, self.sync_obj.staging_path(dst))
+        self.assertTrue(self.sync_obj.staged(flacfile.filename))
+
+        self.assertEqual(self.commit(worker, dst), [dst])
+        self.assertTrue(os.path.isfile(dst))
+        self.assertFalse(os.path.exists(encoded.filename))
+        self.assertFalse(self.sync_obj.staged(flacfile.filename))
+        self.assertTrue(self.sync_obj.manifest.is_current(
+            flacfile.filename, os.stat(flacfile.filename),
+            self.sync_obj.encode_settings))
+        worker.close()
+
+    def test_Worker_loudness_without_numpy(self):
+        self.sync_obj.manifest = manifest.Manifest.in_directory(self.destdir)
+        worker = lossless2lossy.Worker(self.sync_obj)
+        dst = self.sync_obj.src_to_dest(self.s_new[1][0])
+        # stored by an earlier run that had numpy
+        self.sync_obj.manifest.set_loudness(dst, '{"blocks": []}', 2)
+        installed = lossless2lossy.loudness
+        lossless2lossy.loudness = None
+        try:
+            self.assertIsNone(worker._get_loudness(dst, self.sync_obj))
+        finally:
+            lossless2lossy.loudness = installed
+            worker.close()
+
+    def test_Worker_process_resume(self):
+        self.sync_obj.manifest = manifest.Manifest.in_directory(self.destdir)
+        worker = lossless2lossy.Worker(self.sync_obj)
+        # an interrupted run: one track finished, one half written
+        finished = self.sync_obj.load_file(self.s_new[1][0])
+        dst, __ = worker.encode(finished)
+        partial = self.sync_obj.staging_path(
+            self.sync_obj.src_to_dest(self.s_new[1][1]))
+        with open(partial, 'wb') as f:
+            f.write(b'half an mp3')
+
+        try:
+            totals = worker.process()
+        finally:
+            worker.close()
+
+        self.assertEqual(totals['resumed'], 1)
+        # the tracks are copies of one file, so most of them are copied
+        self.assertEqual(totals['flac'] + totals['deduplicated'],
+                         len(self.s_new[1]) - 1 + len(self.s_new2[1]))
+        for track in self.s_new[1]:
+            self.assertTrue(os.path.isfile(self.sync_obj.src_to_dest(track)))
+        self.assertGreater(os.path.getsize(self.sync_obj.src_to_dest(
+            self.s_new[1][1])), len(b'half an mp3'))
+        self.assertEqual(os.listdir(os.path.join(self.destdir,
+                                                 sync.Sync.STAGING)), [],
+                         'the staging folder should be emptied')
+
+    def test_Worker_stop(self):
+        worker = lossless2lossy.Worker(self.sync_obj, delete=True)
+        worker.stop()
+        try:
+            self.assertRaises(lossless2lossy.Stopped, worker.process)
+        finally:
+            worker.close()
+        self.assertEqual(os.listdir(self.destdir), ['artist-deleted'],
+                         'nothing should be started after stop()')
+
+    def test_Worker_process_encode_error(self):
+        class Failing(mp3.Mp3):
+            @classmethod
+            def encode_command(cls, outfile):
+                __, outfile = super().encode_command(outfile)
+                return ['sh', '-c', 'echo "bad stream" >&2; exit 2'], outfile
+
+        target = sync.Sync(self.srcdir, self.destdir, Failing)
+        worker = lossless2lossy.Worker(target)
+        try:
+            with self.assertRaisesRegex(engine.ProcessError, 'bad stream'):
+                worker.process()
+        finally:
+            worker.close()
+        self.assertFalse(os.path.exists(os.path.join(self.destdir,
+                                                     'artist-new')),
+                         'no album with a failed encode should be committed')
+
     def test_Worker_delete_files(self):
         worker = lossless2lossy.Worker(self.sync_obj, delete=False)
         flacfile = self.d_deleted[1][0]
@@ -141,6 +344,172 @@ class Test_Lossless2lossy(unittest.TestCase):
         |           `-- folder.jpg
         '''
 
+    def test_Worker_run_targets(self):
+        other = sync.Sync(self.srcdir, self.destdir2,
+                          mp3.Mp3.with_options(['-V2']))
+        worker = lossless2lossy.Worker(self.sync_obj, targets=[other])
+        self.assertRaises(SystemExit, worker.run)
+
+        for track in self.s_new[1] + self.s_new2[1] + self.s_mp3[1]:
+            for target in worker.targets:
+                self.assertTrue(os.path.isfile(target.src_to_dest(track)),
+                                'every target should be synced')
+
+    def test_Worker_process_roots(self):
+        worker = lossless2lossy.Worker(self.sync_obj, delete=True)
+        try:
+            totals = worker.process([(self.s_mp3[0][0], True)])
+        finally:
+            worker.close()
+
+        self.assertEqual(totals['copied'], 9)
+        for track in self.s_mp3[1]:
+            self.assertTrue(os.path.isfile(self.sync_obj.src_to_dest(track)))
+        for track in self.s_new[1]:
+            self.assertFalse(os.path.isfile(self.sync_obj.src_to_dest(track)),
+                             'folders outside the roots should be left alone')
+        self.assertTrue(os.path.isdir(self.d_deleted[0][0]))
+
+    @unittest.skipIf(artwork.Image is None, 'Pillow is not installed')
+    def test_Worker_process_artwork(self):
+        # an album with a cover.jpg but no folder.jpg
+        os.rename(self.s_new2[2], os.path.join(self.s_new2[0][1],
+                                               'cover.jpg'))
+        cache_dir = os.path.join(self.destdir2, 'cache')
+        work = artwork.Artwork(100, embed=True, folder=True,
+                               cache_dir=cache_dir)
+        worker = lossless2lossy.Worker(self.sync_obj, delete=True,
+                                       artwork=work)
+        try:
+            worker.process()
+            worker.process()  # the folder image should be kept
+        finally:
+            worker.close()
+
+        d_new2 = self.sync_obj.src_to_dest(self.s_new2[0][1])
+        small = work.process_file(self.artfile)
+        for name in ('folder.jpg', 'cover.jpg'):
+            with open(os.path.join(d_new2, name), 'rb') as f:
+                self.assertEqual(f.read(), small)
+        with open(self.sync_obj.src_to_dest(self.s_new[2]), 'rb') as f:
+            self.assertEqual(f.read(), small, 'art should be downscaled')
+        for track in self.s_new2[1]:
+            encoded = mp3.Mp3(self.sync_obj.src_to_dest(track))
+            self.assertEqual(encoded[mp3.COVER_KEY],
+                             [(small, 'image/jpeg')])
+
+    def test_Worker_process_dedup(self):
+        # every lossless track is a copy of the same file
+        for number, track in enumerate(self.s_new[1] + self.s_new2[1]):
+            tagged = flac.Flac(track)
+            tagged['title'] = 'track {}'.format(number)
+            tagged.save()
+        worker = lossless2lossy.Worker(self.sync_obj)
+        try:
+            totals = worker.process()
+        finally:
+            worker.close()
+
+        self.assertEqual(totals['flac'], 1, 'the audio should be encoded once')
+        self.assertEqual(totals['deduplicated'], 7)
+        self.assertGreaterEqual(worker.dedup_seconds, 0.0)
+        for number, track in enumerate(self.s_new[1] + self.s_new2[1]):
+            encoded = mp3.Mp3(self.sync_obj.src_to_dest(track))
+            self.assertEqual(encoded['title'], ['track {}'.format(number)],
+                             'every copy should get its own tags')
+        self.assertEqual(os.listdir(os.path.join(self.destdir,
+                                                 sync.Sync.STAGING)), [])
+
+    def run_with_manifest(self, delete=True):
+        compare = sync.Sync(self.srcdir, self.destdir, mp3.Mp3,
+                            manifest.Manifest.in_directory(self.destdir))
+        worker = lossless2lossy.Worker(compare, delete=delete)
+        try:
+            return worker, worker.process()
+        finally:
+            worker.close()
+
+    def test_Worker_process_move_album(self):
+        self.run_with_manifest()
+        album = self.s_new[0][1]
+        renamed = os.path.join(os.path.dirname(album), 'album-renamed')
+        os.rename(album, renamed)
+        worker, totals = self.run_with_manifest()
+
+        self.assertEqual(totals['moved'], 6, 'every file should be moved')
+        self.assertNotIn('flac', totals)
+        self.assertEqual(worker.metrics.to_dict()['stages']['move']['calls'],
+                         1, 'the folder should be renamed in one step')
+        self.assertFalse(os.path.exists(self.sync_obj.src_to_dest(album)))
+        for track in self.s_new[1]:
+            moved = os.path.join(renamed, os.path.basename(track))
+            self.assertTrue(os.path.isfile(self.sync_obj.src_to_dest(moved)))
+
+        __, totals = self.run_with_manifest()
+        self.assertEqual(sum(totals.values()), 0,
+                         'the moved files should be recorded as synced')
+
+    def test_Worker_process_move(self):
+        self.run_with_manifest()
+        track = self.s_new[1][0]
+        moved = os.path.join(self.s_new2[0][1], 'moved.flac')
+        os.rename(track, moved)
+        worker, totals = self.run_with_manifest()
+
+        self.assertEqual(totals['moved'], 1)
+        self.assertNotIn('flac', totals, 'nothing should be encoded')
+        self.assertFalse(os.path.exists(self.sync_obj.src_to_dest(track)))
+        self.assertTrue(os.path.isfile(self.sync_obj.src_to_dest(moved)))
+
+        # without --delete the old file stays
+        os.rename(moved, track)
+        __, totals = self.run_with_manifest(delete=False)
+        self.assertEqual(totals['moved'], 1)
+        self.assertTrue(os.path.isfile(self.sync_obj.src_to_dest(track)))
+        self.assertTrue(os.path.isfile(self.sync_obj.src_to_dest(moved)))
+
+    def test_Worker_process_encode_cache(self):
+        cache_dir = os.path.join(self.destdir2, 'cache')
+        worker = lossless2lossy.Worker(
+            self.sync_obj, encode_cache=encode_cache.EncodeCache(cache_dir))
+        try:
+            worker.process()
+        finally:
+            worker.close()
+
+        # a new device
+        shutil.rmtree(self.destdir)
+        os.mkdir(self.destdir)
+        cache = encode_cache.EncodeCache(cache_dir)
+        compare = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        worker = lossless2lossy.Worker(compare, encode_cache=cache)
+        try:
+            totals = worker.process()
+        finally:
+            worker.close()
+
+        self.assertEqual(totals['flac'], 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertFalse([stage for stage in worker.metrics.to_dict()['stages']
+                          if stage.startswith('decode')],
+                         'nothing should be decoded')
+        for track in self.s_new[1] + self.s_new2[1]:
+            self.assertTrue(os.path.isfile(self.sync_obj.src_to_dest(track)))
+
+    def test_Worker_run_metrics(self):
+        worker = lossless2lossy.Worker(self.sync_obj, delete=True)
+        self.assertRaises(SystemExit, worker.run)
+
+        stages = worker.metrics.to_dict()['stages']
+        for stage in ('scan', 'diff', 'load', 'decode_flac', 'encode', 'tag',
+                      'copy', 'delete'):
+            self.assertIn(stage, stages)
+        self.assertEqual(stages['encode']['calls'] + stages['dedup']['calls'],
+                         8)
+        self.assertGreater(stages['decode_flac']['audio_seconds'], 0)
+        self.assertNotIn('decode_sox', stages,
+                         '16 bit / 44.1 kHz files should not be resampled')
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
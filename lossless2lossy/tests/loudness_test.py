@@ -0,0 +1,71 @@
+import unittest
+import os
+import math
+import struct
+
+try:
+    from .. import loudness
+except ImportError:
+    loudness = None
+
+
+def sine_wav(level, seconds, rate=44100, channels=2):
+    'Returns a 16 bit WAV stream of a 1 kHz sine at ``level`` dBFS.'
+    amplitude = 10 ** (level / 20.0) * 32767
+    frames = b''.join(
+        struct.pack('<h', int(amplitude * math.sin(2 * math.pi * 1000 * n / rate)))
+        * channels
+        for n in range(int(rate * seconds))
+    )
+    header = (b'RIFF' + struct.pack('<I', 36 + len(frames)) + b'WAVE'
+              + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, rate,
+                                      rate * channels * 2, channels * 2, 16)
+              + b'data' + struct.pack('<I', len(frames)))
+    return header + frames
+
+
+@unittest.skipIf(loudness is None, 'numpy is not installed')
+class Test_Loudness(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    wav_file = os.path.join(resources, 'wav', 'silence_16_44100.wav')
+
+    def measure(self, data, chunk_size=10000):
+        meter = loudness.Meter()
+        for start in range(0, len(data), chunk_size):
+            meter.feed(data[start:start + chunk_size])
+        return meter.result()
+
+    def test_Meter_sine(self):
+        # EBU Tech 3341: a -23 dBFS stereo sine measures -23 LUFS
+        result = self.measure(sine_wav(-23, 5))
+        self.assertAlmostEqual(result.integrated, -23.0, delta=0.1)
+        self.assertAlmostEqual(result.gain, 5.0, delta=0.1)
+        self.assertAlmostEqual(result.peak, 10 ** (-23 / 20.0), delta=0.001)
+
+    def test_Meter_silence(self):
+        with open(self.wav_file, 'rb') as f:
+            result = self.measure(f.read())
+        self.assertIsNone(result.integrated)
+        self.assertEqual(result.gain, 0.0)
+
+    def test_Meter_not_wav(self):
+        self.assertIsNone(self.measure(b'not a wav stream' * 100))
+
+    def test_Loudness_album(self):
+        quiet = self.measure(sine_wav(-40, 5))
+        loud = self.measure(sine_wav(-20, 5))
+        album = loudness.Loudness.album([quiet, loud])
+        self.assertAlmostEqual(album.peak, loud.peak)
+        # the quiet track is below the relative gate
+        self.assertAlmostEqual(album.integrated, loud.integrated, delta=0.1)
+
+    def test_Loudness_json(self):
+        result = self.measure(sine_wav(-23, 2))
+        restored = loudness.Loudness.from_json(result.to_json())
+        self.assertEqual(restored.histogram, result.histogram)
+        self.assertEqual(restored.peak, result.peak)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+import os
+import shutil
+
+from .. import manifest
+
+
+class Test_Manifest(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    tmp = os.path.join(resources, 'tmp')
+    artfile = os.path.join(resources, 'album_art', 'folder.jpg')
+
+    def setUp(self):
+        os.mkdir(self.tmp)
+        self.manifest = manifest.Manifest.in_directory(self.tmp)
+        self.srcfile = os.path.join(self.tmp, 'folder.jpg')
+        shutil.copyfile(self.artfile, self.srcfile)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmp)
+
+    def test_Manifest_in_directory(self):
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.tmp, manifest.Manifest.NAME)))
+
+    def test_Manifest_listing_unknown(self):
+        self.assertIsNone(self.manifest.listing(self.tmp, 1))
+
+    def test_Manifest_listing(self):
+        self.manifest.set_listing(self.tmp, 1, ['album'], ['folder.jpg'])
+        self.assertEqual(self.manifest.listing(self.tmp, 1),
+                         (['album'], ['folder.jpg']))
+        self.assertIsNone(self.manifest.listing(self.tmp, 2),
+                          'a changed mtime should invalidate the listing')
+
+    def test_Manifest_is_current(self):
+        stat = os.stat(self.srcfile)
+        self.assertIsNone(self.manifest.is_current(self.srcfile, stat, 'copy'))
+
+        self.manifest.record(self.srcfile, stat, '/dest/folder.jpg', 'copy')
+        self.assertTrue(self.manifest.is_current(self.srcfile, stat, 'copy'))
+        self.assertFalse(self.manifest.is_current(self.srcfile, stat, 'Mp3'),
+                         'changed settings should not be current')
+
+        with open(self.srcfile, 'ab') as f:
+            f.write(b'\0')
+        self.assertFalse(self.manifest.is_current(
+            self.srcfile, os.stat(self.srcfile), 'copy'))
+
+    def test_Manifest_audio(self):
+        stat = os.stat(self.srcfile)
+        self.assertIsNone(self.manifest.audio(self.srcfile, 'Mp3'))
+        self.manifest.record(self.srcfile, stat, '/dest/folder.mp3', 'Mp3',
+                             'abc123')
+        self.assertEqual(self.manifest.audio(self.srcfile, 'Mp3'), 'abc123')
+        self.assertIsNone(self.manifest.audio(self.srcfile, 'Mp3 -V2'),
+                          'other settings should not match')
+
+    def test_Manifest_loudness(self):
+        dest = '/dest/folder.mp3'
+        self.assertIsNone(self.manifest.loudness(dest))
+        self.manifest.set_loudness(dest, '{}', 2)
+        self.assertEqual(self.manifest.loudness(dest), ('{}', 2))
+        self.manifest.set_loudness(dest, None)
+        self.assertIsNone(self.manifest.loudness(dest))
+
+    def test_Manifest_staged(self):
+        stat = os.stat(self.srcfile)
+        dest = os.path.join(self.tmp, 'dest', 'folder.jpg')
+        self.assertIsNone(self.manifest.staged(self.srcfile, stat, 'copy'))
+        self.manifest.stage(self.srcfile, stat, dest, 'copy', 'md5')
+        self.assertEqual(self.manifest.staged(self.srcfile, stat, 'copy'),
+                         dest)
+        self.assertIsNone(self.manifest.staged(self.srcfile, stat, 'other'))
+        self.assertEqual(self.manifest.journal(), [(dest, self.srcfile)])
+
+        self.manifest.unstage(dest)
+        self.assertEqual(self.manifest.journal(), [])
+        self.assertTrue(self.manifest.is_current(self.srcfile, stat, 'copy'),
+                        'an unstaged file should be recorded as synced')
+        self.assertEqual(self.manifest.audio(self.srcfile, 'copy'), 'md5')
+
+    def test_Manifest_throughput(self):
+        self.assertIsNone(self.manifest.throughput('flac', 'Mp3 -V0'))
+        self.manifest.add_throughput('flac', 'Mp3 -V0', 60.0, 2.0)
+        self.manifest.add_throughput('flac', 'Mp3 -V0', 40.0, 3.0)
+        self.assertEqual(self.manifest.throughput('flac', 'Mp3 -V0'), 20.0)
+        self.manifest.clear()
+        self.assertEqual(self.manifest.throughput('flac', 'Mp3 -V0'), 20.0,
+                         'measurements should survive a rescan')
+
+    def test_Manifest_set_listing_forgets_removed_files(self):
+        self.manifest.record(self.srcfile, os.stat(self.srcfile),
+                             '/dest/folder.jpg', 'copy')
+        self.manifest.set_listing(self.tmp, 1, [], [])
+        self.assertIsNone(self.manifest.is_current(
+            self.srcfile, os.stat(self.srcfile), 'copy'))
+
+    def test_Manifest_moved_from(self):
+        stat = os.stat(self.srcfile)
+        self.manifest.record(self.srcfile, stat, '/dest/folder.jpg', 'copy',
+                             'md5')
+        self.manifest.set_listing(self.tmp, 1, [], [])
+        self.assertEqual(self.manifest.moved_from(stat, 'copy'),
+                         [(self.srcfile, '/dest/folder.jpg', True)],
+                         'a file that vanished should still be found')
+        self.assertEqual(self.manifest.moved_from(stat, 'Mp3'), [])
+        moved = os.stat(self.artfile)
+        self.assertEqual(self.manifest.moved_from(moved, 'copy', 'md5'),
+                         [(self.srcfile, '/dest/folder.jpg', False)])
+
+        self.manifest.forget_vanished()
+        self.assertEqual(self.manifest.moved_from(stat, 'copy'), [])
+
+    def test_Manifest_persists(self):
+        self.manifest.record(self.srcfile, os.stat(self.srcfile),
+                             '/dest/folder.jpg', 'copy')
+        self.manifest.close()
+        self.manifest = manifest.Manifest.in_directory(self.tmp)
+        self.assertTrue(self.manifest.is_current(
+            self.srcfile, os.stat(self.srcfile), 'copy'))
+
+    def test_Manifest_clear(self):
+        self.manifest.set_listing(self.tmp, 1, [], ['folder.jpg'])
+        self.manifest.clear()
+        self.assertIsNone(self.manifest.listing(self.tmp, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import os
+import shutil
+import json
+import sys
+import threading
+
+from .. import engine
+from .. import metrics
+
+
+class Test_Metrics(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    tmp = os.path.join(resources, 'tmp')
+
+    def setUp(self):
+        os.mkdir(self.tmp)
+        self.metrics = metrics.Metrics()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_Metrics_stage(self):
+        with self.metrics.stage('encode', bytes_in=10,
+                                audio_seconds=2.0) as stage:
+            stage.bytes_out = 5
+        with self.metrics.stage('encode', audio_seconds=2.0):
+            pass
+        totals = self.metrics.to_dict()['stages']['encode']
+
+        self.assertEqual(totals['calls'], 2)
+        self.assertEqual(totals['bytes_in'], 10)
+        self.assertEqual(totals['bytes_out'], 5)
+        self.assertEqual(totals['audio_seconds'], 4.0)
+        self.assertGreater(totals['wall_seconds'], 0)
+        self.assertIn('realtime_per_cpu', totals)
+
+    def test_Metrics_stage_threads(self):
+        def work():
+            with self.metrics.stage('copy', bytes_in=1):
+                pass
+        threads = [threading.Thread(target=work) for __ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.metrics.to_dict()['stages']['copy']['calls'], 8)
+
+    def test_Metrics_iterate(self):
+        items = list(self.metrics.iterate('diff', range(3)))
+        self.assertEqual(items, [0, 1, 2])
+        self.assertEqual(self.metrics.to_dict()['stages']['diff']['calls'], 4)
+
+    def test_run_command_charges_child_cpu(self):
+        script = 'sum(range(3000000))'
+        with self.metrics.stage('post_encode_hook'):
+            engine.run_command([sys.executable, '-c', script])
+        totals = self.metrics.to_dict()['stages']['post_encode_hook']
+        self.assertGreater(totals['cpu_seconds'], 0.01,
+                           'the CPU time of the child should be counted')
+
+    def test_Metrics_write(self):
+        with self.metrics.stage('scan'):
+            pass
+        report = os.path.join(self.tmp, 'report.json')
+        textfile = os.path.join(self.tmp, 'lossless2lossy.prom')
+        self.metrics.write_json(report)
+        self.metrics.write_textfile(textfile)
+
+        with open(report) as f:
+            self.assertIn('scan', json.load(f)['stages'])
+        with open(textfile) as f:
+            text = f.read()
+        self.assertIn('# TYPE lossless2lossy_last_run_stage_calls gauge', text)
+        self.assertIn('lossless2lossy_last_run_stage_calls{stage="scan"} 1.0',
+                      text)
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['lossless2lossy.prom', 'report.json'])
+
+
+if __name__ == "__main__":
+    unittest.main()
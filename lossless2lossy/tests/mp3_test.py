@@ -11,6 +11,7 @@ import mimetypes
 import subprocess
 import glob
 
+from .. import abstract
 from .. import mp3
 
 class Test_Mp3(unittest.TestCase):
@@ -38,6 +39,14 @@ class Test_Mp3(unittest.TestCase):
         self.assertTrue(os.path.isfile(encoded_file.filename), 'encoded_file should exist')
         self.assertEqual(mimetypes.guess_type(encoded_file.filename)[0], 'audio/mpeg', 'encoded_file should be a mp3 file')
 
+    def test_mp3_estimated_bitrate(self):
+        self.assertEqual(mp3.Mp3.estimated_bitrate(), 245)
+        self.assertEqual(mp3.Mp3.with_options(['-V', '5']).estimated_bitrate(),
+                         130)
+        self.assertEqual(
+            mp3.Mp3.with_options(['--cbr', '-b', '320']).estimated_bitrate(),
+            320)
+
     def test_mp3__replaygain_album(self):
         tmp_mp3 = os.path.join(self.tmp, 'mp3')
         os.mkdir(tmp_mp3)
@@ -50,6 +59,52 @@ class Test_Mp3(unittest.TestCase):
             replay_gained_mp3 = mp3.Mp3(file)
             self.assertIn('replaygain_album_gain', replay_gained_mp3.pprint(), 'should have id3 tags from mp3gain')
 
+    def test_mp3_finalize(self):
+        tmp_mp3 = os.path.join(self.tmp, 'track.mp3')
+        shutil.copy(os.path.join(self.mp3_path, 'silence_16_44100_id3v24.mp3'),
+                    tmp_mp3)
+        values = abstract.ReplayGain(track_gain=-2.0, track_peak=0.5,
+                                     album_gain=-4.5, album_peak=0.6,
+                                     applied=0)
+        applied = mp3.Mp3(tmp_mp3).finalize({'title': ['finalized']}, values)
+
+        self.assertEqual(applied, -3, 'album gain should be applied in steps')
+        finalized = mp3.Mp3(tmp_mp3)
+        self.assertEqual(finalized['title'], ['finalized'])
+        self.assertEqual(
+            finalized[mp3.REPLAYGAIN_TXXX['album_gain']], ['+0.00 dB'],
+            'only the gain that was not applied should be left in the tags')
+        self.assertEqual(
+            finalized[mp3.REPLAYGAIN_TXXX['track_gain']], ['+2.50 dB'])
+        self.assertTrue(mp3.Mp3._has_v1_tags(tmp_mp3),
+                        'should have id3v1 tags')
+
+    def test_mp3_finalize_removed_tag(self):
+        tmp_mp3 = os.path.join(self.tmp, 'track.mp3')
+        shutil.copy(os.path.join(self.mp3_path, 'silence_16_44100_id3v24.mp3'),
+                    tmp_mp3)
+        tagged = mp3.Mp3(tmp_mp3)
+        tagged['title'] = 'old'
+        tagged['artist'] = 'removed'
+        tagged.save()
+
+        mp3.Mp3(tmp_mp3).finalize({'title': ['new']})
+
+        finalized = mp3.Mp3(tmp_mp3)
+        self.assertEqual(finalized['title'], ['new'])
+        self.assertNotIn('artist', finalized,
+                         'tags removed from the source should be removed')
+
+    def test_mp3_clear_tags(self):
+        tmp_mp3 = os.path.join(self.tmp, 'track.mp3')
+        shutil.copy(os.path.join(self.mp3_path, 'silence_16_44100_id3v24.mp3'),
+                    tmp_mp3)
+        tagged = mp3.Mp3(tmp_mp3)
+        tagged['title'] = 'old'
+        tagged.save()
+        mp3.Mp3(tmp_mp3).clear_tags()
+        self.assertNotIn('title', mp3.Mp3(tmp_mp3))
+
     def test_mp3__add_v11_tags(self):
         tmp_mp3 = os.path.join(self.tmp, 'mp3')
         os.mkdir(tmp_mp3)
@@ -58,7 +113,14 @@ class Test_Mp3(unittest.TestCase):
             shutil.copy(file, tmp_mp3)
         mp3_files = glob.glob(os.path.join(tmp_mp3, '*.mp3'))
         mp3.Mp3(mp3_files[0])._add_v11_tags()
-        self.assertTrue(True, 'no way to test...')
+        for file in mp3_files:
+            self.assertTrue(mp3.Mp3._has_v1_tags(file), 'should have id3v1 tags')
+
+    def test_mp3__has_v1_tags(self):
+        self.assertTrue(mp3.Mp3._has_v1_tags(
+            os.path.join(self.mp3_path, 'silence_16_44100_id3v11.mp3')))
+        self.assertFalse(mp3.Mp3._has_v1_tags(
+            os.path.join(self.wav_path, 'silence_16_44100.wav')))
 
 
 if __name__ == "__main__":
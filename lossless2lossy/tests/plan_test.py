@@ -0,0 +1,92 @@
+import unittest
+import os
+import shutil
+import json
+
+from .. import plan
+from .. import mp3
+from .. import sync
+from .. import manifest
+
+
+class Test_Plan(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    srcdir = os.path.join(resources, 'srcdir')
+    destdir = os.path.join(resources, 'destdir')
+    mp3file = os.path.join(resources, r'mp3/silence_16_44100_id3v11_id3v23.mp3')
+    flacfile = os.path.join(resources, r'flac/silence_16_44100.flac')
+    artfile = os.path.join(resources, 'album_art', 'folder.jpg')
+
+    def setUp(self):
+        for path in [self.srcdir, self.destdir]:
+            os.mkdir(path)
+        album = os.path.join(self.srcdir, 'artist', 'album')
+        os.makedirs(album)
+        self.tracks = []
+        for track in range(3):
+            track = os.path.join(album, '{:02} track.flac'.format(track))
+            shutil.copyfile(self.flacfile, track)
+            self.tracks.append(track)
+        shutil.copyfile(self.mp3file, os.path.join(album, 'bonus.mp3'))
+        shutil.copyfile(self.artfile, os.path.join(album, 'folder.jpg'))
+        os.mkdir(os.path.join(self.destdir, 'deleted'))
+        self.sync_obj = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+
+    def tearDown(self):
+        shutil.rmtree(self.srcdir)
+        shutil.rmtree(self.destdir)
+
+    def test_Plan(self):
+        work = plan.Plan([self.sync_obj], deletes=True,
+                         calibrate=False).build()
+        counts = work.to_dict()['destinations'][0]
+
+        self.assertEqual(len(work.encodes), 3)
+        self.assertEqual(counts['encodes'], 3)
+        self.assertEqual(counts['copies'], 2)
+        self.assertEqual(counts['deletes'], 1)
+        self.assertGreater(counts['encoded_bytes'], 0)
+        self.assertIsNone(work.eta(), 'nothing has been measured')
+        self.assertIsNone(work.makespan())
+        self.assertEqual(os.listdir(os.path.join(self.destdir)), ['deleted'],
+                         'planning should not change any files')
+
+    def test_Plan_eta(self):
+        self.sync_obj.manifest = manifest.Manifest.in_directory(self.destdir)
+        work = plan.Plan([self.sync_obj], calibrate=False).build()
+        decoder = work.encodes[0][0].decoder()
+        self.sync_obj.manifest.add_throughput(
+            decoder, self.sync_obj.encode_settings, 10.0, 1.0)
+
+        audio = work.audio_seconds
+        slots = work.limits.cpu.size
+        expected = audio / 10.0 * min(2, slots) / slots
+        self.assertAlmostEqual(work.eta(), expected)
+
+        makespan = work.makespan()
+        self.assertLessEqual(makespan['longest_first'], makespan['queued'])
+        self.assertGreaterEqual(makespan['longest_first'], work.eta())
+        self.assertIn('longest first', work.report())
+        self.sync_obj.manifest.close()
+
+    def test_Plan_to_json(self):
+        work = plan.Plan([self.sync_obj], calibrate=False).build()
+        data = json.loads(work.to_json())
+        self.assertEqual(data['files_to_encode'], 3)
+        self.assertIn('space', data)
+        self.assertIn('Files to Encode: 3', work.report())
+
+    def test_Plan_shortfalls(self):
+        work = plan.Plan([self.sync_obj], calibrate=False).build()
+        self.assertEqual(work.shortfalls(), [])
+        work.destinations[self.sync_obj]['encoded_bytes'] = 1 << 62
+        self.assertEqual(len(work.shortfalls()), 1)
+
+    def test_format(self):
+        self.assertEqual(plan.format_size(1500), '1.5 KB')
+        self.assertEqual(plan.format_duration(3725), '1:02:05')
+
+
+if __name__ == "__main__":
+    unittest.main()
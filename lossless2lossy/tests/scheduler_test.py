@@ -0,0 +1,158 @@
+import concurrent.futures
+import unittest
+import threading
+from concurrent.futures import ThreadPoolExecutor as Executor
+
+from .. import scheduler
+
+
+class Test_TaskGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = Executor(max_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+
+    def test_TaskGraph_submit(self):
+        graph = scheduler.TaskGraph(self.executor)
+        task = graph.submit(pow, 2, 3)
+        graph.wait()
+        self.assertEqual(task.result(), 8)
+
+    def test_TaskGraph_dependencies(self):
+        graph = scheduler.TaskGraph(self.executor)
+        release = threading.Event()
+        order = []
+
+        def track(n):
+            release.wait(5)
+            order.append(n)
+
+        tracks = [graph.submit(track, n) for n in range(3)]
+        album = graph.submit(order.append, 'album', after=tracks)
+        self.assertFalse(album.done(), 'album should wait for its tracks')
+        release.set()
+        graph.wait()
+        self.assertEqual(order[-1], 'album')
+        self.assertEqual(len(order), 4)
+
+    def test_TaskGraph_independent_albums(self):
+        graph = scheduler.TaskGraph(self.executor)
+        release = threading.Event()
+        slow = graph.submit(release.wait, 5)
+        graph.submit(lambda: None, after=[slow])
+        other = graph.submit(lambda: 'other')
+        self.assertEqual(other.result(timeout=5), 'other',
+                         'other jobs should not wait for an unrelated album')
+        release.set()
+        graph.wait()
+
+    def test_TaskGraph_failure(self):
+        graph = scheduler.TaskGraph(self.executor)
+        failed = graph.submit(int, 'not a number')
+        dependent = graph.submit(lambda: 'never', after=[failed])
+        self.assertRaises(ValueError, graph.wait)
+        self.assertIsInstance(dependent.exception(), ValueError)
+        self.assertIsInstance(graph.failure(), ValueError)
+
+    def test_TaskGraph_cancel(self):
+        graph = scheduler.TaskGraph(Executor(max_workers=1))
+        release = threading.Event()
+        running = graph.submit(release.wait, 5)
+        queued = graph.submit(lambda: 'never')
+        dependent = graph.submit(lambda: 'never', after=[running])
+        graph.cancel()
+        release.set()
+        self.assertRaises(concurrent.futures.CancelledError, graph.wait)
+        self.assertTrue(running.result(), 'running jobs should finish')
+        for task in (queued, dependent):
+            self.assertIsInstance(task.exception(),
+                                  concurrent.futures.CancelledError)
+        graph.executor.shutdown()
+
+    def test_TaskGraph_limit(self):
+        graph = scheduler.TaskGraph(self.executor, limit=2)
+        release = threading.Event()
+        graph.submit(release.wait, 5)
+        graph.submit(release.wait, 5)
+        submitted = threading.Event()
+
+        def submit_third():
+            graph.submit(lambda: None)
+            submitted.set()
+
+        threading.Thread(target=submit_third).start()
+        self.assertFalse(submitted.wait(0.2), 'submit should block at the limit')
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        graph.wait()
+
+    def test_TaskGraph_priority(self):
+        graph = scheduler.TaskGraph(self.executor, workers=1)
+        release = threading.Event()
+        order = []
+        graph.submit(release.wait, 5)
+        for n in (1, 3, 2):
+            graph.submit(order.append, n, priority=n)
+        graph.submit(order.append, 'album')
+        release.set()
+        graph.wait()
+        self.assertEqual(order, ['album', 3, 2, 1],
+                         'jobs without a priority and then the highest'
+                         ' priority should start first')
+
+    def test_TaskGraph_cancel_ready(self):
+        graph = scheduler.TaskGraph(self.executor, workers=1)
+        release = threading.Event()
+        running = graph.submit(release.wait, 5)
+        waiting = graph.submit(lambda: 'never', priority=1)
+        graph.cancel()
+        release.set()
+        self.assertRaises(concurrent.futures.CancelledError, graph.wait)
+        self.assertTrue(running.result())
+        self.assertIsInstance(waiting.exception(),
+                              concurrent.futures.CancelledError)
+
+    def test_TaskGraph_deferred(self):
+        executor = Executor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        graph = scheduler.TaskGraph(executor, workers=2)
+        work = concurrent.futures.Future()
+        threads = []
+
+        def finish(future, suffix):
+            threads.append(threading.current_thread())
+            return future.result() + suffix
+
+        def start():
+            threads.append(threading.current_thread())
+            return scheduler.Deferred(work, finish, '!')
+
+        deferred = graph.submit(start)
+        other = graph.submit(lambda: 'other')
+        self.assertEqual(other.result(timeout=5), 'other',
+                         'the thread should be free while the work runs')
+        self.assertFalse(deferred.done())
+        work.set_result('done')
+        graph.wait()
+        self.assertEqual(deferred.result(), 'done!')
+        self.assertEqual(len(threads), 2)
+
+        failed = concurrent.futures.Future()
+        failed.set_exception(ValueError('failed'))
+        task = graph.submit(lambda: scheduler.Deferred(failed, finish, '!'))
+        self.assertRaises(ValueError, graph.wait)
+        self.assertIsInstance(task.exception(), ValueError)
+
+    def test_makespan(self):
+        durations = [1, 1, 1, 1, 4]
+        self.assertEqual(scheduler.makespan(durations, 2), 6)
+        self.assertEqual(scheduler.makespan(durations, 2, lookahead=5), 4)
+        self.assertEqual(scheduler.makespan(durations, 2, lookahead=2), 5,
+                         'only the next jobs in the queue can be chosen')
+        self.assertEqual(scheduler.makespan([], 2), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,6 +15,7 @@ from .. import sync
 from .. import flac
 from .. import mp3
 from .. import art
+from .. import manifest
 
 class Test_Sync(unittest.TestCase):
     testdir = os.path.abspath(os.path.dirname(__file__))
@@ -115,6 +116,182 @@ class Test_Sync(unittest.TestCase):
 
                 self.assertEqual(set(i[1]), set(self.d_deleted[1]), 'should not exist and should be diff')
 
+    def test_Sync_diff(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        actions = list(s.diff())
+        adds = set(a.src for a in actions if a.kind == sync.ADD)
+        updates = set(a.src for a in actions if a.kind == sync.UPDATE)
+        deletes = set(a.dest for a in actions if a.kind == sync.DELETE_DIR)
+
+        self.assertEqual(adds, set(self.s_new[1]))
+        self.assertEqual(updates, set(self.s_modified[1]))
+        self.assertEqual(deletes, set([self.d_deleted[0][0]]),
+                         'only the top deleted folder should be reported')
+        for action in actions:
+            if action.src:
+                self.assertEqual(action.dest, s.src_to_dest(action.src))
+
+    def test_Sync_diff_scan_jobs(self):
+        serial = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        serial.scan_jobs = 1
+        parallel = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        parallel.scan_jobs = 4
+        self.assertEqual(set(parallel.diff()), set(serial.diff()))
+        stages = parallel.metrics.to_dict()['stages']
+        self.assertEqual(stages['stat']['calls'],
+                         len(list(os.walk(self.srcdir))),
+                         'every source directory should be stat\'d once')
+
+    def test_Sync_diff_linked(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        art = os.path.join(self.s_old[0][1], 'folder.jpg')
+        shutil.copyfile(os.path.join(self.album_art_dir, 'folder.jpg'), art)
+        os.link(art, s.src_to_dest(art))
+        os.utime(art, (time.time() + 10, time.time() + 10))
+        for action in s.diff():
+            self.assertNotEqual(action.src, art,
+                                'a hard link is always up to date')
+
+    def test_Sync_diff_roots(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        new_artist, new_album = self.s_new[0]
+        roots = [(new_artist, False), (new_album, False), (new_album, True)]
+        actions = [action for __, action in sync.diff_all([s], roots=roots)]
+        self.assertEqual(set(a.src for a in actions), set(self.s_new[1]),
+                         'only the given folders should be compared, once')
+
+        # a folder removed from the source is found through its parent
+        gone = os.path.join(self.srcdir, 'artist-deleted')
+        actions = [action for __, action in sync.diff_all(
+            [s], roots=[(self.srcdir, False), (gone, True)])]
+        self.assertEqual([(a.kind, a.dest) for a in actions],
+                         [(sync.DELETE_DIR, self.d_deleted[0][0])])
+
+        self.assertEqual(s.collapse_roots([(new_album, False),
+                                           (self.srcdir, True)]),
+                         [(self.srcdir, True)])
+        self.assertRaises(Exception, s.collapse_roots, [(self.destdir, True)])
+
+    def test_Sync_staging(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3,
+                      manifest.Manifest.in_directory(self.destdir))
+        track = self.s_new[1][0]
+        staged = s.staging_path(s.src_to_dest(track))
+        self.assertEqual(staged, os.path.join(
+            self.destdir, sync.Sync.STAGING,
+            os.path.relpath(s.src_to_dest(track), self.destdir)))
+        self.assertRaises(Exception, s.staging_path, track)
+
+        os.makedirs(os.path.dirname(staged))
+        for path in (staged, staged + '.partial'):
+            with open(path, 'wb') as f:
+                f.write(b'mp3')
+        self.assertFalse(s.staged(track))
+        s.stage(track)
+        self.assertTrue(s.staged(track))
+
+        self.assertEqual(s.clean_staging(), 1,
+                         'only files missing from the journal are deleted')
+        self.assertTrue(os.path.isfile(staged))
+        for action in s.diff():
+            self.assertNotIn(sync.Sync.STAGING, action.dest,
+                             'the staging folder is not a deleted folder')
+
+        os.utime(track, (time.time() + 10, time.time() + 10))
+        self.assertFalse(s.staged(track), 'the source file changed')
+        s.manifest.close()
+
+    def test_Sync_diff_no_deletes(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        for action in s.diff(deletes=False):
+            self.assertIn(action.kind, (sync.ADD, sync.UPDATE))
+
+    def test_Sync_diff_extension_case(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        album = self.s_old[0][1]
+        for track in self.s_old[1]:
+            os.rename(track, os.path.splitext(track)[0] + '.FLAC')
+        for action in s.diff():
+            self.assertNotIn(os.path.dirname(action.dest or action.src),
+                             (album, self.d_old[0][1]))
+
+    def test_Sync_not_in_dest_manifest(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3,
+                      manifest.Manifest.in_directory(self.destdir))
+        diff = [set(album_tracks) for album_tracks in s.not_in_destination()]
+        self.assertNotIn(set(self.s_old[1]), diff, 'old album should be recorded')
+        self.assertIn(set(self.s_new[1]), diff)
+        self.assertIn(set(self.s_modified[1]), diff)
+
+        # the old album is now trusted from the manifest, not from mtimes
+        for track in self.d_old[1]:
+            os.utime(track, (0, 0))
+        diff = [set(album_tracks) for album_tracks in s.not_in_destination()]
+        self.assertNotIn(set(self.s_old[1]), diff, 'manifest should be trusted')
+        s.manifest.close()
+
+    def test_Sync_diff_manifest_missing_dest(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3,
+                      manifest.Manifest.in_directory(self.destdir))
+        list(s.diff())  # records the old album
+        os.unlink(self.d_old[1][0])
+        actions = [action for action in s.diff()
+                   if os.path.dirname(action.dest) == self.d_old[0][1]]
+        self.assertEqual(actions, [sync.Action(sync.ADD, self.s_old[1][0],
+                                               self.d_old[1][0])],
+                         'a lost destination file should be added again')
+        s.manifest.close()
+
+    def test_Sync_audio_unchanged(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3,
+                      manifest.Manifest.in_directory(self.destdir))
+        track = flac.Flac(self.s_modified[1][0])
+        self.assertFalse(s.audio_unchanged(track), 'unknown file')
+
+        s.record(track.filename, track.audio_md5())
+        self.assertTrue(s.audio_unchanged(track))
+
+        s.record(track.filename, 'ffffffffffffffffffffffffffffffff')
+        self.assertFalse(s.audio_unchanged(track), 'different audio')
+        s.manifest.close()
+
+    def test_Sync_not_in_src_ignores_manifest(self):
+        s = sync.Sync(self.srcdir, self.destdir, mp3.Mp3,
+                      manifest.Manifest.in_directory(self.destdir))
+        for __, files in s.not_in_source():
+            self.assertNotIn(s.manifest.path, files)
+        s.manifest.close()
+
+    def test_diff_all(self):
+        other = os.path.join(self.resources, 'destdir2')
+        os.mkdir(other)
+        try:
+            first = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+            second = sync.Sync(self.srcdir, other,
+                               mp3.Mp3.with_options(['-V2']))
+            actions = list(sync.diff_all([first, second]))
+            # Directories are produced in the order they are scanned
+            key = lambda action: (action.kind, action.src or '', action.dest)
+            for target in (first, second):
+                self.assertEqual(
+                    sorted((action for s, action in actions if s is target),
+                           key=key),
+                    sorted(target.diff(), key=key),
+                    'each destination should get its own actions'
+                )
+            self.assertEqual(
+                set(a.src for s, a in actions if s is second),
+                set(self.s_new[1] + self.s_modified[1] + self.s_old[1]),
+                'an empty destination needs every source file'
+            )
+        finally:
+            shutil.rmtree(other)
+
+    def test_diff_all_different_sources(self):
+        first = sync.Sync(self.srcdir, self.destdir, mp3.Mp3)
+        second = sync.Sync(self.s_new[0][0], self.destdir, mp3.Mp3)
+        self.assertRaises(Exception, list, sync.diff_all([first, second]))
+
     def test_Sync__load_files_flac(self):
         paths = glob.glob(os.path.join(self.flac_dir, '*'))
         opened_files = sync.Sync.load_cls_objs(paths)
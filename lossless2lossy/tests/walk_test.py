@@ -0,0 +1,87 @@
+import unittest
+import os
+import shutil
+import threading
+
+from .. import walk
+
+
+class Test_walk(unittest.TestCase):
+    testdir = os.path.abspath(os.path.dirname(__file__))
+    resources = os.path.join(testdir, 'resources')
+    tmp = os.path.join(resources, 'walk')
+
+    def setUp(self):
+        self.folders = [self.tmp]
+        for artist in range(3):
+            for album in range(4):
+                folder = os.path.join(self.tmp, 'artist{}'.format(artist),
+                                      'album{}'.format(album))
+                os.makedirs(folder)
+                self.folders.extend([folder, os.path.dirname(folder)])
+        self.folders = sorted(set(self.folders))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @staticmethod
+    def scan(path):
+        if not os.path.isdir(path):
+            return None
+        return (sorted(os.listdir(path)),)
+
+    def test_walk_serial(self):
+        walked = [path for path, __ in walk.walk([(self.tmp, True)],
+                                                 self.scan, jobs=1)]
+        self.assertEqual(walked, self.folders, 'should walk top down')
+
+    def test_walk(self):
+        walked = [path for path, __ in walk.walk([(self.tmp, True)],
+                                                 self.scan, jobs=4)]
+        self.assertEqual(sorted(walked), self.folders)
+        for path in walked:
+            if path != self.tmp:
+                self.assertLess(walked.index(os.path.dirname(path)),
+                                walked.index(path),
+                                'a directory should come before its children')
+
+    def test_walk_roots(self):
+        artist = os.path.join(self.tmp, 'artist0')
+        missing = os.path.join(self.tmp, 'missing')
+        walked = [path for path, __ in walk.walk(
+            [(artist, False), (missing, True)], self.scan, jobs=4)]
+        self.assertEqual(walked, [artist])
+
+    def test_walk_bounded(self):
+        running = [0, 0]
+        lock = threading.Lock()
+
+        def scan(path):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            try:
+                return self.scan(path)
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        walked = walk.walk([(self.tmp, True)], scan, jobs=2)
+        next(walked)
+        walked.close()
+        self.assertLessEqual(running[1], 2, 'at most jobs scans at once')
+        self.assertEqual(running[0], 0,
+                         'no scan should outlive a walk that was closed')
+
+    def test_walk_error(self):
+        def scan(path):
+            if path.endswith('album2'):
+                raise OSError('unreachable')
+            return self.scan(path)
+
+        with self.assertRaisesRegex(OSError, 'unreachable'):
+            list(walk.walk([(self.tmp, True)], scan, jobs=4))
+
+
+if __name__ == '__main__':
+    unittest.main()
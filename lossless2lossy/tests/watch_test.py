@@ -0,0 +1,190 @@
+import ctypes
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from .. import watch
+
+
+class FakeWorker:
+
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def process(self, roots=None):
+        self.calls.append(roots)
+        if self.fail:
+            raise Exception('failed')
+        return {}
+
+    def print_summary(self, totals):
+        pass
+
+
+class FakeWatcher:
+    'Returns one list of changes per read, then nothing.'
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.closed = False
+
+    def read(self, timeout=None):
+        return self.batches.pop(0) if self.batches else []
+
+    def close(self):
+        self.closed = True
+
+
+class Test_Watch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='lossless2lossy-test-')
+        self.album = os.path.join(self.tmpdir, 'artist', 'album')
+        os.makedirs(self.album)
+        self.track = os.path.join(self.album, '01 track.flac')
+        with open(self.track, 'wb') as f:
+            f.write(b'one')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_until(self, watcher, expected, seconds=5):
+        'Collects changes until all of ``expected`` have been seen.'
+        seen = set()
+        deadline = time.monotonic() + seconds
+        while not expected <= seen and time.monotonic() < deadline:
+            seen.update(watcher.read(0.2))
+        return seen
+
+    def check_watcher(self, watcher):
+        try:
+            # a new file dirties its folder
+            with open(os.path.join(self.album, '02 track.flac'), 'wb') as f:
+                f.write(b'two')
+            expected = {(self.album, False)}
+            self.assertLessEqual(expected, self.read_until(watcher, expected))
+
+            # a new folder is compared with everything below it
+            new = os.path.join(self.tmpdir, 'artist', 'new album')
+            os.makedirs(os.path.join(new, 'cd1'))
+            expected = {(new, True)}
+            self.assertLessEqual(expected, self.read_until(watcher, expected))
+
+            # moving a folder dirties both parents
+            moved = os.path.join(self.tmpdir, 'moved')
+            os.rename(self.album, moved)
+            expected = {(os.path.join(self.tmpdir, 'artist'), False),
+                        (moved, True)}
+            self.assertLessEqual(expected, self.read_until(watcher, expected))
+
+            # changes below the moved folder are still seen
+            with open(os.path.join(moved, '01 track.flac'), 'ab') as f:
+                f.write(b'more')
+            expected = {(moved, False)}
+            self.assertLessEqual(expected, self.read_until(watcher, expected))
+
+            # deleting a folder dirties its parent
+            shutil.rmtree(moved)
+            expected = {(self.tmpdir, False)}
+            self.assertLessEqual(expected, self.read_until(watcher, expected))
+        finally:
+            watcher.close()
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'needs inotify')
+    def test_Inotify(self):
+        self.check_watcher(watch.Inotify(self.tmpdir))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'needs inotify')
+    def test_Inotify_watch_limit(self):
+        watcher = watch.Inotify(self.tmpdir, interval=0.05)
+
+        def add_watch(fd, path, mask):
+            ctypes.set_errno(errno.ENOSPC)
+            return -1
+
+        watcher._add_watch = add_watch
+        try:
+            new = os.path.join(self.tmpdir, 'artist', 'new album')
+            os.makedirs(new)
+            expected = {(self.tmpdir, True)}
+            self.assertLessEqual(expected, self.read_until(watcher, expected),
+                                 'the whole tree should be compared')
+            self.assertIsNone(watcher.fileno(), 'should scan from now on')
+
+            # changes in the folder that could not be watched are seen
+            with open(os.path.join(new, '01 track.flac'), 'wb') as f:
+                f.write(b'new')
+            expected = {(new, False)}
+            self.assertLessEqual(expected, self.read_until(watcher, expected))
+        finally:
+            watcher.close()
+
+    def test_Poller(self):
+        self.check_watcher(watch.Poller(self.tmpdir, interval=0.05))
+
+    def test_Poller_modified(self):
+        watcher = watch.Poller(self.tmpdir, interval=0)
+        self.assertEqual(watcher.read(0), [])
+        os.utime(self.track, (0, 0))
+        self.assertEqual(watcher.read(0), [(self.album, False)])
+
+    def test_watcher_poll(self):
+        watcher = watch.watcher(self.tmpdir, poll=True, interval=5)
+        self.assertIsInstance(watcher, watch.Poller)
+        watcher.close()
+
+    def test_Pending(self):
+        pending = watch.Pending(quiet=10, longest=30)
+        self.assertIsNone(pending.due())
+        pending.add([(self.album, False)], now=0)
+        self.assertEqual(pending.due(), 10)
+        pending.add([(self.album, True)], now=5)
+        self.assertEqual(pending.due(), 15, 'changes restart the wait')
+        pending.add([(self.tmpdir, False)], now=25)
+        self.assertEqual(pending.due(), 30, 'changes wait at most longest')
+
+        self.assertEqual(pending.take(), [(self.album, True),
+                                          (self.tmpdir, False)])
+        self.assertFalse(pending)
+        self.assertIsNone(pending.due())
+
+    def test_Watch_run(self):
+        now = [0.0]
+
+        def clock():
+            now[0] += 1.0
+            return now[0]
+
+        worker = FakeWorker()
+        watcher = FakeWatcher([[(self.album, False)], [(self.album, False)]])
+        watcher_read = watcher.read
+
+        def read(timeout=None):
+            if len(worker.calls) >= 3:
+                runner.stop()
+            return watcher_read(timeout)
+
+        watcher.read = read
+        runner = watch.Watch(worker, watcher, quiet=3, reconcile=20)
+        runner.run(clock=clock)
+
+        self.assertIsNone(worker.calls[0], 'the first sync is a full one')
+        self.assertEqual(worker.calls[1], [(self.album, False)],
+                         'bursts of changes are synced once')
+        self.assertIsNone(worker.calls[2], 'the tree is reconciled')
+        self.assertTrue(watcher.closed)
+
+    def test_Watch_sync_failure(self):
+        after = []
+        runner = watch.Watch(FakeWorker(fail=True), FakeWatcher([]),
+                             after=lambda: after.append(True))
+        self.assertFalse(runner.sync([(self.album, False)]))
+        self.assertEqual(after, [True], 'metrics are written after failures')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+'''
+Module for walking directory trees on filesystems where every call is slow.
+
+On network filesystems such as NFS each directory listing and each stat is
+a round trip to the server, so walking a large library one directory at a
+time mostly waits. :func:`walk` scans several directories at once in a
+small thread pool and hands each one to the caller as soon as it is done,
+in whatever order they finish. Only a bounded number of directories is
+scanned ahead of the caller, so memory use does not grow with the size of
+the tree, and directories are taken depth first so the list of directories
+still to scan stays short too.
+'''
+import concurrent.futures
+import os
+
+# Directories scanned at once
+DEFAULT_JOBS = 8
+# Directories scanned ahead of the caller, for every job
+AHEAD = 4
+
+
+def walk(roots, scan, jobs=DEFAULT_JOBS):
+    '''
+    Scans directory trees, several directories at a time.
+
+    :Args:
+        * roots(iter(tuple(str, bool))): directories to walk, each with
+            whether its subdirectories are walked too
+        * scan(callable): called with the path of each directory, in a
+            worker thread. Returns None to skip the directory, or a tuple
+            whose first item is the list of the names of its subdirectories.
+        * jobs(int): (optional) directories scanned at once. With 1 the
+            trees are walked top down in the calling thread.
+    :Returns:
+        * generator(str, tuple): each directory and what ``scan`` returned
+            for it. A directory comes before its subdirectories.
+    :Raises:
+        * Exception: the first exception raised by ``scan``
+    '''
+    # Directories still to scan, taken from the end
+    pending = [(path, recursive) for path, recursive in reversed(list(roots))]
+    if jobs <= 1:
+        while pending:
+            path, recursive = pending.pop()
+            result = scan(path)
+            if result is None:
+                continue
+            yield path, result
+            if recursive:
+                pending.extend((os.path.join(path, sub), True)
+                               for sub in reversed(result[0]))
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=jobs, thread_name_prefix='walk')
+    # future: (path, recursive)
+    running = {}
+
+    def fill():
+        while pending and len(running) < jobs * AHEAD:
+            path, recursive = pending.pop()
+            running[executor.submit(scan, path)] = (path, recursive)
+
+    try:
+        fill()
+        while running:
+            done, __ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            finished = []
+            for future in done:
+                path, recursive = running.pop(future)
+                result = future.result()
+                if result is None:
+                    continue
+                if recursive:
+                    pending.extend((os.path.join(path, sub), True)
+                                   for sub in reversed(result[0]))
+                finished.append((path, result))
+            # Keep the pool busy while the caller handles these
+            fill()
+            for item in finished:
+                yield item
+    finally:
+        # Also when the caller stops early: no scan outlives the walk
+        executor.shutdown(wait=True, cancel_futures=True)
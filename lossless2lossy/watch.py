@@ -0,0 +1,485 @@
+'''
+Module for keeping the destination folders in sync as the source folder
+changes.
+
+A watcher reports which directories of the source folder changed. On Linux
+the kernel tells us through inotify; elsewhere, when the inotify watch limit
+is reached, or on network filesystems, the tree is scanned every few
+seconds instead. Each change is reported as a directory and whether its
+subdirectories need comparing too: a file that changed dirties the
+directory holding it, and a directory that was created or moved in dirties
+everything below it. A directory that was deleted or moved away dirties its
+parent, whose comparison then removes it from the destination folders.
+
+:class:`Watch` collects the changes until the source folder has been quiet
+for a while, so an album being ripped or copied in is synced once, as a
+whole, and then hands only the dirty directories to
+:meth:`lossless2lossy.Worker.process`. Every so often it compares the whole
+source folder anyway, in case a change was missed.
+'''
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+# Seconds the source folder must be quiet before changes are synced
+DEFAULT_QUIET = 10.0
+# Changes are synced after this many seconds even if the folder is never
+# quiet, e.g. while a large library is being copied in
+DEFAULT_LONGEST = 300.0
+# Seconds between comparisons of the whole source folder
+DEFAULT_RECONCILE = 6 * 3600.0
+# Seconds between scans of the source folder when polling
+DEFAULT_POLL_INTERVAL = 30.0
+
+# inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+               | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+               | IN_ONLYDIR)
+_EVENT = struct.Struct('iIII')
+
+
+def _subdirectories(root):
+    '''
+    Returns ``root`` and every directory below it, not following symbolic
+    links. Directories that vanish while being listed are left out.
+    '''
+    found = []
+    pending = [root]
+    while pending:
+        path = pending.pop()
+        try:
+            with os.scandir(path) as iterator:
+                subs = [entry.path for entry in iterator
+                        if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            continue
+        found.append(path)
+        pending.extend(subs)
+    return found
+
+
+class Inotify:
+    '''
+    Watches a directory tree with inotify.
+
+    Arguments:
+        * root (str): the directory to watch, with everything below it
+        * interval (float): (optional) seconds between scans once the
+            watch limit (``fs.inotify.max_user_watches``) is reached while
+            watching, see :meth:`read`
+
+    :Raises:
+        * OSError: inotify is not available, or there are too many
+            directories for the user's watch limit
+    '''
+
+    def __init__(self, root, interval=DEFAULT_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        # Takes over when new directories cannot be watched
+        self._poller = None
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name, use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # watch descriptor -> directory
+        self._paths = {}
+        try:
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def fileno(self):
+        return self.fd if self._poller is None else None
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_tree(self, top):
+        '''
+        Watches ``top`` and every directory below it. Watching a directory
+        twice is harmless.
+
+        :Raises:
+            * OSError: the watch limit was reached
+        '''
+        for path in _subdirectories(top):
+            wd = self._add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    continue  # gone again, or unreadable
+                raise OSError(err, os.strerror(err), path)
+            self._paths[wd] = path
+
+    def _forget_tree(self, top):
+        'Stops watching ``top`` and everything below it.'
+        prefix = top.rstrip('/') + '/'
+        for wd, path in list(self._paths.items()):
+            if path == top or path.startswith(prefix):
+                del self._paths[wd]
+                self._rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        '''
+        Waits for changes. When a new directory cannot be watched because
+        the watch limit was reached, the tree is scanned from then on, see
+        :class:`Poller`, and the whole tree is reported as changed.
+
+        :Args:
+            * timeout(float): (optional) seconds to wait, forever if None
+        :Returns:
+            * list(tuple(str, bool)): the directories that changed, each
+                with whether its subdirectories changed too. Empty if
+                nothing happened before the timeout.
+        '''
+        if self._poller is not None:
+            return self._poller.read(timeout)
+        ready, __, __ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = b''
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        try:
+            return self._changes(data)
+        except OSError as e:
+            print('** cannot watch every directory of "{}" ({}), scanning'
+                  ' it every {} seconds instead **'.format(self.root, e,
+                                                           self.interval))
+            self.close()
+            self._poller = Poller(self.root, self.interval)
+            # Changes in the directories that were not watched were missed
+            return [(self.root, True)]
+
+    def _changes(self, data):
+        '''
+        Returns the directories changed by a batch of events, watching the
+        new ones.
+
+        :Raises:
+            * OSError: the watch limit was reached
+        '''
+        changes = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, __, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: watch any directory we did not hear
+                # about and compare everything
+                self.add_tree(self.root)
+                changes.append((self.root, True))
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            folder = self._paths.get(wd)
+            if folder is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # The parent reports the change; only the root has none
+                if folder == self.root:
+                    changes.append((self.root, True))
+                continue
+
+            changes.append((folder, False))
+            if name and mask & IN_ISDIR:
+                path = os.path.join(folder, os.fsdecode(name))
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                    changes.append((path, True))
+                elif mask & IN_MOVED_FROM:
+                    self._forget_tree(path)
+        return changes
+
+
+class Poller:
+    '''
+    Watches a directory tree by scanning it and comparing the names, sizes
+    and mtimes of everything in it with the previous scan.
+
+    Arguments:
+        * root (str): the directory to watch, with everything below it
+        * interval (float): (optional) seconds between scans
+    '''
+
+    def __init__(self, root, interval=DEFAULT_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self._next = time.monotonic() + interval
+        self._snapshot = self.scan()
+
+    def fileno(self):
+        return None
+
+    def close(self):
+        pass
+
+    def scan(self):
+        '''
+        Returns every directory below the root and the size and mtime of
+        each of its files.
+
+        :Returns:
+            * dict(str: dict(str: tuple(int, int))): the files of each
+                directory, with subdirectories as ``None``
+        '''
+        snapshot = {}
+        for path in _subdirectories(self.root):
+            entries = {}
+            try:
+                with os.scandir(path) as iterator:
+                    for entry in iterator:
+                        if entry.is_dir(follow_symlinks=False):
+                            entries[entry.name] = None
+                        else:
+                            try:
+                                stat = entry.stat()
+                            except OSError:
+                                continue
+                            entries[entry.name] = (stat.st_size,
+                                                   stat.st_mtime_ns)
+            except OSError:
+                continue
+            snapshot[path] = entries
+        return snapshot
+
+    def read(self, timeout=None):
+        '''
+        Scans the tree if a scan is due within ``timeout`` and reports the
+        changes like :meth:`Inotify.read`.
+        '''
+        wait = self._next - time.monotonic()
+        if timeout is not None and wait > timeout:
+            time.sleep(max(0, timeout))
+            return []
+        time.sleep(max(0, wait))
+        self._next = time.monotonic() + self.interval
+
+        previous, current = self._snapshot, self.scan()
+        self._snapshot = current
+        changes = []
+        for path, entries in current.items():
+            if path not in previous:
+                changes.append((path, True))
+            elif previous[path] != entries:
+                changes.append((path, False))
+        for path in previous:
+            if path not in current:
+                changes.append((os.path.dirname(path), False))
+        return changes
+
+
+def watcher(root, poll=False, interval=DEFAULT_POLL_INTERVAL):
+    '''
+    Returns an :class:`Inotify` watcher for ``root``, or a :class:`Poller`
+    when polling was asked for or inotify cannot be used.
+
+    :Args:
+        * root(str): the directory to watch
+        * poll(bool): (optional) always poll
+        * interval(float): (optional) seconds between scans when polling
+    '''
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return Inotify(root, interval)
+        except OSError as e:
+            print('** inotify is not available ({}), scanning "{}" every {}'
+                  ' seconds instead **'.format(e, root, interval))
+    return Poller(root, interval)
+
+
+class Pending:
+    '''
+    Collects changed directories until they have been quiet for ``quiet``
+    seconds, or until the oldest has waited ``longest`` seconds.
+
+    Arguments:
+        * quiet (float): seconds without changes before syncing
+        * longest (float): the longest a change waits
+    '''
+
+    def __init__(self, quiet=DEFAULT_QUIET, longest=DEFAULT_LONGEST):
+        self.quiet = quiet
+        self.longest = longest
+        self._roots = collections.OrderedDict()
+        self._first = None
+        self._last = None
+
+    def __bool__(self):
+        return bool(self._roots)
+
+    def add(self, changes, now):
+        '''
+        :Args:
+            * changes(iter(tuple(str, bool))): changed directories, each with
+                whether its subdirectories changed too
+            * now(float): the time of the changes
+        '''
+        for path, recursive in changes:
+            self._roots[path] = self._roots.get(path, False) or recursive
+            if self._first is None:
+                self._first = now
+            self._last = now
+
+    def due(self):
+        '''
+        Returns the time the collected changes should be synced, or None if
+        there are none.
+        '''
+        if not self._roots:
+            return None
+        return min(self._last + self.quiet, self._first + self.longest)
+
+    def take(self):
+        '''
+        Returns the collected changes and forgets them.
+
+        :Returns:
+            * list(tuple(str, bool))
+        '''
+        roots = list(self._roots.items())
+        self.clear()
+        return roots
+
+    def clear(self):
+        self._roots.clear()
+        self._first = self._last = None
+
+
+class Watch:
+    '''
+    Syncs the source folder once, then keeps syncing the directories that
+    change until :meth:`stop` is called or the process is interrupted.
+
+    Arguments:
+        * worker (lossless2lossy.Worker): does the syncing
+        * watcher (Inotify or Poller): reports changes in the source folder,
+            see :func:`watcher`
+        * quiet (float): (optional) seconds the source folder must be quiet
+            before changes are synced
+        * longest (float): (optional) the longest a change waits
+        * reconcile (float): (optional) seconds between comparisons of the
+            whole source folder
+        * after (callable): (optional) called after every sync, e.g. to
+            write metrics
+    '''
+
+    def __init__(self, worker, watcher, quiet=DEFAULT_QUIET,
+                 longest=DEFAULT_LONGEST, reconcile=DEFAULT_RECONCILE,
+                 after=None):
+        self.worker = worker
+        self.watcher = watcher
+        self.pending = Pending(quiet, longest)
+        self.reconcile = reconcile
+        self.after = after
+        self._stopped = threading.Event()
+
+    def stop(self):
+        'Makes :meth:`run` return after the sync in progress.'
+        self._stopped.set()
+
+    def sync(self, roots=None):
+        '''
+        Syncs ``roots``, or everything. Failures are reported and do not
+        stop watching: the next change or reconcile retries.
+
+        :Returns:
+            * bool: True if the sync succeeded
+        '''
+        try:
+            totals = self.worker.process(roots)
+        except Exception as e:
+            if self._stopped.is_set():
+                print('** Stopped **')
+            else:
+                print('** Encountered an Error **')
+            print(e)
+            return False
+        else:
+            self.worker.print_summary(totals)
+            return True
+        finally:
+            if self.after is not None:
+                self.after()
+
+    def run(self, clock=time.monotonic):
+        '''
+        Watches until stopped. The watcher is closed when done, the worker
+        is left open.
+
+        :Args:
+            * clock(callable): (optional) returns the current time
+        '''
+        try:
+            next_reconcile = clock()
+            while not self._stopped.is_set():
+                now = clock()
+                if now >= next_reconcile:
+                    # Everything is compared, so pending changes are done too
+                    self.pending.clear()
+                    self.sync()
+                    next_reconcile = clock() + self.reconcile
+                    continue
+                due = self.pending.due()
+                if due is not None and now >= due:
+                    self.sync(self.pending.take())
+                    continue
+
+                # Wake up for the next sync, and now and then to notice stop()
+                timeout = min(next_reconcile - now, 1.0)
+                if due is not None:
+                    timeout = min(timeout, due - now)
+                changes = self.watcher.read(max(0, timeout))
+                if changes:
+                    self.pending.add(changes, clock())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
@@ -4,7 +4,7 @@ setup(
     name="lossless2lossy",
     version="1.0.0",
     packages=['lossless2lossy'],
-    scripts=['scripts/lossless2lossy'],
+    scripts=['scripts/lossless2lossy', 'scripts/lossless2lossy-agent'],
 
     # metadata for upload to PyPI
     author="Mike Lenzen",